@@ -24,18 +24,17 @@ __author__ = 'jeffpickhardt@google.com (Jeff Pickhardt)'
 __version__ = '1.1.7'
 __license__ = 'Apache License 2.0 (http://www.apache.org/licenses/LICENSE-2.0)'
 
-import sys, os, time, datetime, random, cgi, socket, urllib, csv
+import sys, os, re, errno, time, datetime, random, cgi, socket, urllib, csv, threading, json, shlex, pipes, getopt, Queue, httplib, SocketServer, traceback, signal, cProfile, pstats, array
 from sys import exit
-import gdata.apps.service
-import gdata.apps.emailsettings.service
-import gdata.apps.adminsettings.service
-import gdata.apps.groups.service
-import gdata.apps.audit.service
-import gdata.apps.multidomain.service
-import gdata.apps.orgs.service
-import gdata.apps.res_cal.service
+import gdata # the gdata.apps modules are imported when a command first needs them (see load_api)
+import atom.http
 from hashlib import sha1
 import getpass
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, where only one GAS process at a time should log in
+import gas_client
 
 ## VARIOUS HELPER FUNCTIONS ##
 def str_to_bool(string, case_sensitive=False, true_words=['true', 'on'],
@@ -50,30 +49,982 @@ def str_to_bool(string, case_sensitive=False, true_words=['true', 'on'],
         raise Exception('Could not convert %s to a boolean.' % string)
 
 def expand_cmd_template(cmds_template, entries=None):
+    cmds = []
+    for row in iter_cmd_template_rows(cmds_template, entries):
+        cmds.extend(row)
+    return cmds
+
+def iter_cmd_template_rows(cmds_template, entries=None):
+    """Yields the commands of each entry as they are needed, so entries can be a stream (e.g. a csv.reader) of any length."""
     if not entries:
         entries = ['']
 
     # This could be done in a single expression using a bunch
     # of generators, but that would be harder to read :-)
 
-    cmds = []
-
     for entry in entries:
+        cmds = []
         for cmd in cmds_template:
-            cmd = cmd.strip()
-            if not cmd:
-                continue
-
             for index, col in enumerate(entry):
                 # Replace {x} with the x^th column.
                 # Note that columns are 1-indexed for humans...
                 cmd = cmd.replace('{%d}' % (index+1), col.strip())
 
+            cmd = cmd.strip()
+            if not cmd:
+                continue # e.g. a template of just {2}, for a line with an empty second column
             cmds.append(cmd)
+        yield cmds
 
-    return cmds
+def read_template_entries(path):
+    """Yields the columns of each non-empty line of the CSV file at path, reading one line at a time."""
+    input_file = open(path, 'rb')
+    try:
+        for entry in csv.reader(input_file):
+            if entry:
+                yield entry
+    finally:
+        input_file.close()
+
+def write_file_atomically(path, data, mode=0666):
+    """Replaces the file at path with data, via a temporary file, so readers never see half of it.
+    
+    A new file gets mode, less the umask (e.g. 0600 for a file only its owner may read)."""
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(temp_path):
+        os.remove(temp_path) # left by a crashed process with the same pid, maybe with another mode
+    temp_file = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), mode), 'wb')
+    try:
+        temp_file.write(data)
+    finally:
+        temp_file.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path) # os.rename does not overwrite on Windows
+    os.rename(temp_path, path)
+
+## GDATA MODULES ##
+
+# The gdata module of each API. It is only imported (by load_api) when the first command that uses it runs,
+# so commands that don't need an API don't pay for loading it.
+api_modules = {
+    'provisioning': 'gdata.apps.service',
+    'email_settings': 'gdata.apps.emailsettings.service',
+    'groups': 'gdata.apps.groups.service',
+    'orgs': 'gdata.apps.orgs.service'
+    }
+
+# The APIs each command uses, besides the Provisioning API that every login uses.
+command_apis = {
+    ## Email settings ##
+    'create_label': ['email_settings'],
+    'create_filter': ['email_settings'],
+    'create_send_as': ['email_settings'],
+    'update_web_clips': ['email_settings'],
+    'update_forwarding': ['email_settings'],
+    'update_pop': ['email_settings'],
+    'update_imap': ['email_settings'],
+    'update_vacation': ['email_settings'],
+    'update_signature': ['email_settings'],
+    'update_language': ['email_settings'],
+    ## Organization units ##
+    'create_org': ['orgs'],
+    'update_org': ['orgs'],
+    'add_users_to_org': ['orgs'],
+    'read_org': ['orgs'],
+    'delete_org': ['orgs'],
+    ## Groups ##
+    'create_group': ['groups'],
+    'read_group': ['groups'],
+    'update_group': ['groups'],
+    'delete_group': ['groups'],
+    'list_groups': ['groups'],
+    'list_group_members': ['groups'],
+    'list_group_owners': ['groups'],
+    'list_user_groups': ['groups'],
+    'group_overlap': ['groups'],
+    'sync_group_members': ['groups'],
+    'add_member_to_group': ['groups'],
+    'remove_member_from_group': ['groups'],
+    'add_owner_to_group': ['groups'],
+    'remove_owner_from_group': ['groups'],
+    ## Directory cache ##
+    'update_directory_cache': ['groups', 'orgs']
+    }
+
+def load_api(api_family):
+    """Imports the gdata module of api_family, if it isn't already, and returns it."""
+    module_name = api_modules[api_family]
+    # Always go through __import__, which waits for another thread that is still importing the module.
+    __import__(module_name)
+    return sys.modules[module_name]
+
+def load_command_apis(call_function):
+    """Imports the gdata modules the command uses."""
+    load_api('provisioning')
+    for api_family in command_apis.get(call_function, []):
+        load_api(api_family)
+
+# The server every API (and ClientLogin) is called on. Empty means Google's servers; to test GAS
+# offline, run gas_fake_server.py and set e.g. GAS_API_SERVER=http://localhost:8089
+API_SERVER = os.environ.get('GAS_API_SERVER', '')
+
+def new_service(service_class, **kwargs):
+    """Returns a new gdata service_class object, calling API_SERVER if it is set."""
+    service = service_class(**kwargs)
+    if API_SERVER:
+        (scheme, server) = API_SERVER.rstrip('/').split('://', 1)
+        service.server = server
+        service.ssl = (scheme == 'https')
+        service.auth_service_url = API_SERVER.rstrip('/') + '/accounts/ClientLogin'
+    if not proxy_configured():
+        service.http_client = pooled_http_client
+    return service
+
+def proxy_configured():
+    """Returns whether an HTTP(S) proxy is set, in which case gdata's own ProxiedHttpClient is left to connect through it."""
+    return bool([name for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY') if os.environ.get(name)])
+
+## HTTP CONNECTIONS ##
+
+# How many idle keep-alive connections are kept open to each host (--pool-size changes it).
+HTTP_POOL_SIZE = 10
+
+class ConnectionPool:
+    """Keeps the HTTP and HTTPS connections to each host open between requests, so that every service
+    object and thread reuses them instead of connecting (and, for HTTPS, negotiating TLS) for every request.
+    
+    A request takes an idle connection to its host, or opens a new one if there is none, so the pool
+    never makes a request wait. Afterwards, the connection is kept for the next request unless the server
+    is closing it or size connections to the host are already idle."""
+    def __init__(self, size=HTTP_POOL_SIZE):
+        self.size = size
+        self.idle = {} # (protocol, host, port) -> idle connections, the most recently used last
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Starts counting the connections again, keeping the open ones."""
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self.stale = 0
+    
+    def get(self, key):
+        """Returns (connection, reused): an idle connection to key's host, or a new one."""
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if idle:
+                self.reused += 1
+                connection = idle.pop()
+            else:
+                self.opened += 1
+                connection = None
+        finally:
+            self.lock.release()
+        metrics.count('gas_http_connections_total', {'host': key[1], 'reused': str(connection is not None).lower()})
+        if connection is not None:
+            return (connection, True)
+        (protocol, host, port) = key
+        if protocol == 'https':
+            connection = httplib.HTTPSConnection(host, port)
+        else:
+            connection = httplib.HTTPConnection(host, port)
+        connection.connect()
+        # atom sends a request's headers and body in separate writes, which Nagle's algorithm would hold
+        # back until the server acknowledges the headers, adding up to 40ms to every request on a kept-alive connection
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (connection, False)
+    
+    def put(self, key, connection):
+        """Keeps connection for the next request to key's host, or closes it if enough are idle already."""
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+            self.discarded += 1
+        finally:
+            self.lock.release()
+        connection.close()
+    
+    def count_stale(self):
+        """Counts a kept-alive connection that the server had closed."""
+        self.lock.acquire()
+        try:
+            self.stale += 1
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        """Closes every idle connection."""
+        self.lock.acquire()
+        try:
+            (idle, self.idle) = (self.idle, {})
+        finally:
+            self.lock.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+    
+    def report(self):
+        """Writes a summary of the connections used to stderr, if any requests were sent."""
+        requests = self.opened + self.reused
+        if not requests:
+            return
+        sys.stderr.write('Sent %d request(s) over %d new connection(s), reusing a kept-alive connection for %d (%d%%); '
+                         '%d were stale and %d closed because the pool was full.\n' %
+                         (requests, self.opened, self.reused, 100*self.reused/requests, self.stale, self.discarded))
+
+connection_pool = ConnectionPool()
+
+class PooledHttpClient(atom.http.HttpClient):
+    """The atom HttpClient every gdata service object sends its requests with, taking its connections
+    from connection_pool instead of opening a new one for every request.
+    
+    The response body is read before the response is returned, so the connection goes back to the pool
+    straight away. A kept-alive connection may have been closed by the server while it was idle. A request
+    is sent again on a new connection only when that clearly happened before the server got it: sending
+    failed with a reset or broken pipe, or the server closed the connection without answering. Any other
+    failure is raised, for call_with_retries to decide about, since the server may have acted on the request."""
+    def __init__(self, pool):
+        atom.http.HttpClient.__init__(self)
+        self.pool = pool
+    
+    def request(self, operation, url, data=None, headers=None):
+        # Like atom.http.HttpClient.request, but the connection comes from the pool and stays in this call,
+        # so concurrent requests (on threads or greenlets) never see each other's connections.
+        all_headers = self.headers.copy()
+        if headers:
+            all_headers.update(headers)
+        if data and 'Content-Length' not in all_headers:
+            if not isinstance(data, basestring):
+                raise atom.http_interface.ContentLengthRequired('Unable to calculate the length of the data parameter. '
+                                                                'Specify a value for Content-Length')
+            all_headers['Content-Length'] = str(len(data))
+        all_headers.setdefault('Content-Type', atom.http.DEFAULT_CONTENT_TYPE)
+        if not isinstance(url, atom.url.Url):
+            url = atom.url.parse_url(str(url))
+        key = (url.protocol, url.host, url.port and int(url.port))
+        resendable = data is None or isinstance(data, basestring) # a file can't be read again
+        while True:
+            (connection, reused) = self.pool.get(key)
+            try:
+                self.send(connection, operation, url, data, all_headers)
+            except socket.error, e:
+                connection.close()
+                if reused and resendable and e.args and e.args[0] in (errno.ECONNRESET, errno.EPIPE):
+                    self.pool.count_stale()
+                    continue # the server closed the idle connection; send it on a new one
+                raise
+            except:
+                connection.close()
+                raise
+            try:
+                response = connection.getresponse()
+                will_close = response.will_close
+                response = BufferedResponse(response)
+            except httplib.BadStatusLine, e:
+                connection.close()
+                if reused and resendable and closed_without_response(e):
+                    self.pool.count_stale()
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            if will_close:
+                connection.close()
+            else:
+                self.pool.put(key, connection)
+            return response
+    
+    def send(self, connection, operation, url, data, headers):
+        """Sends the request line, headers and data of a request on connection."""
+        if self.debug:
+            connection.debuglevel = 1
+        connection.putrequest(operation, self._get_access_url(url), skip_host=True)
+        if url.port is not None:
+            connection.putheader('Host', '%s:%s' % (url.host, url.port))
+        else:
+            connection.putheader('Host', url.host)
+        for (name, value) in headers.items():
+            connection.putheader(name, value)
+        connection.endheaders()
+        if not data:
+            return
+        if not isinstance(data, list):
+            data = [data]
+        for data_part in data:
+            atom.http._send_data_part(data_part, connection)
+
+def closed_without_response(error):
+    """Returns whether an httplib.BadStatusLine means the server closed the connection before sending a byte.
+    
+    httplib says so with an empty line, or a message in place of the line, depending on the Python version."""
+    line = getattr(error, 'line', '')
+    return line in ('', "''") or line.startswith('No status line received')
+
+pooled_http_client = PooledHttpClient(connection_pool)
+
+## RATE LIMITING ##
+
+# Requests per second allowed for each API family when a run starts (--max-rate sets them all). Each limit is lowered
+# when Google reports that a quota was exceeded, and raised back towards this value while requests succeed.
+API_RATE_LIMITS = {
+    'provisioning': 20.0,
+    'email_settings': 20.0,
+    'groups': 20.0,
+    'orgs': 20.0,
+    }
+
+# The lowest rate (requests per second) a limiter backs off to.
+MINIMUM_API_RATE = 0.5
+
+# How many times a request rejected because of a quota is sent again before QuotaExceeded is raised.
+QUOTA_RETRIES = 6
+
+class QuotaExceeded(Exception):
+    """A request was still rejected for a quota after QUOTA_RETRIES resends.
+    
+    The resends are the request's whole retry budget, so call_with_retries doesn't run the command again."""
+    def __init__(self, api_family, status):
+        Exception.__init__(self, 'The %s API quota was still exceeded after %d retries (HTTP %s).' % (api_family, QUOTA_RETRIES, status))
+        self.reason = 'QuotaExceeded'
+
+class RateLimiter:
+    """A token bucket limiting the requests sent to one API family.
+    
+    The rate adapts to Google's quota additively-increase, multiplicatively-decrease (AIMD): it is
+    halved whenever a quota error comes back, and grows by about one request per second, each second,
+    while requests succeed, up to the configured maximum."""
+    def __init__(self, max_rate, min_rate=MINIMUM_API_RATE):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.rate = self.max_rate
+        self.tokens = self.max_rate # allow one second's worth of requests as a burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+    
+    def refill(self):
+        """Adds the tokens earned since the last refill. Must be called with the lock held."""
+        now = time.time()
+        # the bucket holds a second's worth of requests, but always room for one, or a rate below 1 would never send
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+    
+    def acquire(self):
+        """Waits until a request may be sent."""
+        while True:
+            self.lock.acquire()
+            try:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+    
+    def backoff(self):
+        """Halves the rate after a quota error, and empties the bucket so the next request waits."""
+        self.lock.acquire()
+        try:
+            self.rate = max(self.min_rate, self.rate/2)
+            self.tokens = 0
+        finally:
+            self.lock.release()
+    
+    def increase(self):
+        """Raises the rate a little after a successful request."""
+        self.lock.acquire()
+        try:
+            self.rate = min(self.max_rate, self.rate + 1/self.rate)
+        finally:
+            self.lock.release()
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def set_max_rate(rate):
+    """Allows rate requests per second for every API family, including the limiters already in use."""
+    rate_limiters_lock.acquire()
+    try:
+        for api_family in API_RATE_LIMITS:
+            API_RATE_LIMITS[api_family] = rate
+        for limiter in rate_limiters.values():
+            limiter.lock.acquire()
+            try:
+                limiter.max_rate = limiter.rate = float(rate)
+            finally:
+                limiter.lock.release()
+    finally:
+        rate_limiters_lock.release()
+
+def get_rate_limiter(api_family):
+    """Returns the process-wide RateLimiter for api_family."""
+    rate_limiters_lock.acquire()
+    try:
+        if api_family not in rate_limiters:
+            rate_limiters[api_family] = RateLimiter(API_RATE_LIMITS[api_family])
+        return rate_limiters[api_family]
+    finally:
+        rate_limiters_lock.release()
+
+class BufferedResponse:
+    """An HTTP response whose body has already been read, so it can be inspected and still be read by gdata."""
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.getheaders()
+        self.body = response.read()
+    
+    def read(self, amt=None):
+        body = self.body
+        self.body = ''
+        return body
+    
+    def getheader(self, name, default=None):
+        for (header, value) in self.headers:
+            if header.lower() == name.lower():
+                return value
+        return default
+    
+    def getheaders(self):
+        return self.headers
+
+def is_quota_response(response):
+    """Returns whether the (buffered) response says a quota or rate limit was exceeded, or the service is overloaded."""
+    if response.status == 503:
+        return True
+    if response.status in (403, 429):
+        body = response.body.lower()
+        return 'quota' in body or 'rate limit' in body or 'ratelimitexceeded' in body
+    return False
+
+## METRICS ##
+
+# Upper bounds (in seconds) of the latency histogram buckets, as in Prometheus.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Path segments of the API feeds that name a kind of resource; any other segment is an id (a domain,
+# user, group...), replaced by {id} so that the requests to one endpoint are counted together.
+FEED_SEGMENTS = set(['a', 'feeds', '2.0', 'user', 'nickname', 'emailList', 'recipient', 'emailsettings', 'group',
+                     'member', 'owner', 'orgunit', 'orguser', 'customer', 'customerId', 'label', 'filter', 'sendas',
+                     'webclip', 'forwarding', 'pop', 'imap', 'vacation', 'signature', 'language', 'general'])
+
+class Histogram:
+    """Counts observations in LATENCY_BUCKETS, and keeps their sum."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # the last bucket is everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        index = 0
+        while index < len(LATENCY_BUCKETS) and value > LATENCY_BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+    
+    def cumulative_counts(self):
+        """Returns (upper bound, number of observations up to it) pairs, the last bound being '+Inf'."""
+        total = 0
+        result = []
+        for (bound, count) in zip(list(LATENCY_BUCKETS) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Metrics:
+    """Counters and latency histograms of a run, keyed by metric name and labels.
+    
+    Labels are given as a dictionary, e.g. metrics.count('gas_commands_total', {'command': 'read_user', 'status': 'ok'})."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters = {} # (name, labels) -> count
+            self.histograms = {} # (name, labels) -> Histogram
+        finally:
+            self.lock.release()
+    
+    def count(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        finally:
+            self.lock.release()
+    
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+        finally:
+            self.lock.release()
+    
+    def snapshot(self):
+        """Returns the metrics as a dictionary that can be written as JSON."""
+        self.lock.acquire()
+        try:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for ((name, labels), value) in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                           'buckets': [[str(bound), count] for (bound, count) in histogram.cumulative_counts()]}
+                          for ((name, labels), histogram) in sorted(self.histograms.items())]
+        finally:
+            self.lock.release()
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+    
+    def prometheus_text(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                   for (name, value) in pairs]) + '}'
+        lines = []
+        self.lock.acquire()
+        try:
+            typed = set()
+            for ((name, labels), value) in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, label_text(labels), value))
+            for ((name, labels), histogram) in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                for (bound, count) in histogram.cumulative_counts():
+                    lines.append('%s_bucket%s %d' % (name, label_text(labels, [('le', bound)]), count))
+                lines.append('%s_sum%s %f' % (name, label_text(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, label_text(labels), histogram.count))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+    
+    def write(self, path):
+        """Writes the metrics to path: a JSON snapshot if it ends in .json, otherwise Prometheus text."""
+        if path.endswith('.json'):
+            text = json.dumps(self.snapshot(), sort_keys=True)
+        else:
+            text = self.prometheus_text()
+        write_file_atomically(path, text) # so a scraper never reads half a file
+
+metrics = Metrics()
+
+class MetricsWriter:
+    """Writes the metrics to a file every interval seconds (if interval is set) and when stopped."""
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        if interval:
+            self.thread = threading.Thread(target=self.write_periodically)
+            self.thread.setDaemon(True)
+            self.thread.start()
+    
+    def write_periodically(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                return
+            metrics.write(self.path)
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        metrics.write(self.path)
+
+def endpoint_name(url):
+    """Returns the endpoint of an API request URL, with the ids in its path replaced by {id}."""
+    path = str(url).split('?', 1)[0]
+    if '://' in path:
+        path = '/' + path.split('://', 1)[1].partition('/')[2]
+    segments = path.split('/')
+    for (index, segment) in enumerate(segments):
+        if segment and segment not in FEED_SEGMENTS:
+            segments[index] = '{id}'
+    return '/'.join(segments)
+
+def error_reason(e):
+    """Returns a short reason for an error, for counting errors by reason."""
+    if getattr(e, 'reason', None) and isinstance(e.reason, basestring):
+        return e.reason # e.g. EntityDoesNotExist
+    if e.args and isinstance(e.args[0], dict) and 'status' in e.args[0]:
+        apps_error = re.search(r'reason="(\w+)"', str(e.args[0].get('body', '')))
+        if apps_error:
+            return apps_error.group(1) # an AppsForYourDomainErrors body
+        return 'HTTP %s' % e.args[0]['status']
+    return e.__class__.__name__
+
+## TRACING ##
+
+# What the command and request records of the trace log belong to: the row and command being run by this thread.
+trace_context = threading.local()
+
+# The TraceWriter of the run, if it is being traced (see start_trace).
+tracer = None
+
+class TraceWriter:
+    """Writes trace records to a JSON-lines file from a background thread.
+    
+    trace() only queues the record, so tracing every request costs the batch next to nothing;
+    the writer serializes and writes the records in bulk, flushing whenever the queue runs dry."""
+    def __init__(self, path):
+        self.path = path
+        self.run_id = '%s-%06x' % (time.strftime('%Y%m%d%H%M%S'), random.getrandbits(24))
+        self.records = Queue.Queue()
+        self.trace_file = open(path, 'a', 65536)
+        self.thread = threading.Thread(target=self.write_records)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def write_records(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self.trace_file.write(json.dumps(record) + '\n')
+            if self.records.empty():
+                self.trace_file.flush()
+        self.trace_file.close()
+    
+    def trace(self, record):
+        record['run'] = self.run_id
+        record['row'] = getattr(trace_context, 'row', None)
+        self.records.put(record)
+    
+    def close(self):
+        """Writes the records still queued, and closes the file."""
+        self.records.put(None)
+        self.thread.join()
+
+def start_trace(path):
+    """Starts recording one JSON line per command and per API request in the file at path."""
+    global tracer
+    tracer = TraceWriter(path)
+
+def stop_trace():
+    global tracer
+    if tracer:
+        tracer.close()
+        tracer = None
+
+def trace(record):
+    """Adds a record to the trace log, if the run is being traced."""
+    if tracer:
+        tracer.trace(record)
+
+def trace_target(credential, dictionary):
+    """Returns the user (or group) and domain a command works on, from its arguments."""
+    target = dictionary.get('user_name') or dictionary.get('user') or dictionary.get('id') or dictionary.get('name') or ''
+    domain = credential and credential.domain or ''
+    if '@' in target:
+        (target, domain) = target.split('@', 1)
+    return (target, domain)
+
+## PROFILING ##
+
+# The phases the profile report splits the run's time into, as (phase, file name parts, function name parts):
+# a function's own time goes to the first phase with a matching file or function name. Time spent in
+# other functions is reported as 'other'.
+PROFILE_PHASES = [
+    ('template expansion', [], ['iter_cmd_template_rows', 'expand_cmd_template', 'read_template_entries',
+                               "'_csv.reader'", 'numbered_rows']),
+    ('argument parsing', ['shlex.py'], ['build_arg_dict', 'split_command', 'split_template_args', 'str_to_bool']),
+    ('socket wait', ['socket.py', 'ssl.py', 'httplib.py', '/gevent/_socket', '/gevent/_ssl'],
+     ["'_socket.", "'_ssl.", 'getaddrinfo', "'select'"]),
+    ('gdata XML building and parsing', ['/atom/', '/gdata/', '/xml/', 'ElementTree', 'pyexpat'],
+     ['cElementTree', 'pyexpat', "'_elementtree."]),
+    ('waiting (rate limits, backoff, locks)', ['threading.py', 'Queue.py', '/gevent/hub.py', '/gevent/thread.py',
+                                               '/gevent/lock.py', '/gevent/event.py', '/gevent/queue.py'],
+     ['<time.sleep>', "'acquire' of", "'wait' of"]),
+    ]
+
+# The BatchProfiler of the run, if it is being profiled (see start_profile).
+profiler = None
+
+class BatchProfiler:
+    """Profiles a run with cProfile, in every thread that runs rows (or expands them).
+    
+    cProfile only sees the thread that enables it, so each thread gets its own profile, enabled while
+    it runs a row, and the profiles are added together at the end. On the async engine, where the rows
+    are greenlets of one thread, a single profile covers the whole run instead (see share)."""
+    def __init__(self):
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.shared_profile = None
+    
+    def share(self):
+        """Profiles everything the calling thread does from now on, instead of each row separately."""
+        self.shared_profile = cProfile.Profile()
+        self.add_profile(self.shared_profile)
+        self.shared_profile.enable()
+    
+    def add_profile(self, profile):
+        self.lock.acquire()
+        try:
+            self.profiles.append(profile)
+        finally:
+            self.lock.release()
+    
+    def call(self, function, *args, **kwargs):
+        """Calls function, profiling it in the calling thread."""
+        if self.shared_profile or getattr(self.local, 'depth', 0):
+            return function(*args, **kwargs) # already being profiled
+        if not getattr(self.local, 'profile', None):
+            self.local.profile = cProfile.Profile()
+            self.add_profile(self.local.profile)
+        self.local.depth = 1
+        self.local.profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.local.profile.disable()
+            self.local.depth = 0
+    
+    def iterate(self, iterable):
+        """Yields the items of iterable, profiling the work of producing them."""
+        iterator = iter(iterable)
+        while True:
+            try:
+                item = self.call(iterator.next)
+            except StopIteration:
+                return
+            yield item
+    
+    def stats(self):
+        """Returns the pstats.Stats of every profile."""
+        if self.shared_profile:
+            self.shared_profile.disable()
+        profiles = [profile for profile in self.profiles if profile.getstats()]
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+    
+    def write(self, path):
+        """Writes the profile to path+'.pstats', and a report, split by phase, to path+'.txt'."""
+        stats = self.stats()
+        if not stats:
+            return
+        stats.dump_stats(path+'.pstats')
+        phase_times = {}
+        for ((file_name, line, function_name), (primitive_calls, calls, own_time, cumulative_time, callers)) in stats.stats.items():
+            phase = profile_phase(file_name, function_name)
+            phase_times[phase] = phase_times.get(phase, 0.0) + own_time
+        total = sum(phase_times.values()) or 1.0
+        report_file = open(path+'.txt', 'w')
+        try:
+            report_file.write('Time by phase (own time of each function, added up over all threads):\n\n')
+            for (phase, seconds) in sorted(phase_times.items(), key=lambda item: -item[1]):
+                report_file.write('  %-40s %10.3fs %6.1f%%\n' % (phase, seconds, 100.0*seconds/total))
+            report_file.write('\n')
+            stats.stream = report_file
+            stats.sort_stats('time').print_stats(40)
+            stats.sort_stats('cumulative').print_stats(40)
+        finally:
+            report_file.close()
+
+def profile_phase(file_name, function_name):
+    """Returns the PROFILE_PHASES phase a function's time belongs to."""
+    for (phase, file_name_parts, function_name_parts) in PROFILE_PHASES:
+        for part in file_name_parts:
+            if part in file_name:
+                return phase
+        for part in function_name_parts:
+            if part in function_name:
+                return phase
+    return 'other'
+
+def start_profile():
+    """Starts profiling the run."""
+    global profiler
+    profiler = BatchProfiler()
+
+def stop_profile(path):
+    """Stops profiling the run, and writes the profile to path+'.pstats' and its report to path+'.txt'."""
+    global profiler
+    if profiler:
+        profiler.write(path)
+        profiler = None
+
+def profile_call(function, *args, **kwargs):
+    """Calls function, profiling it if the run is being profiled."""
+    if profiler:
+        return profiler.call(function, *args, **kwargs)
+    return function(*args, **kwargs)
 
 ## CREDENTIALS / AUTHENTICATION RELATED STUFF ##
+
+# How long (in seconds) a token is trusted without a RetrieveUser probe after it was last validated.
+TOKEN_VALIDATION_TTL = 12*60*60
+
+# How long (in seconds) a token is kept in the credential store at all. ClientLogin tokens expire after two weeks.
+TOKEN_MAX_AGE = 14*24*60*60
+
+# Whether log in and log out activity is appended to gas_credential_log.txt. Tokens are never written to it.
+WRITE_CREDENTIAL_AUDIT_LOG = True
+
+def path_for_gas_file(file_name):
+    """Returns the absolute path of file_name in the directory GAS is run from."""
+    path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    if os.path.abspath('/') != -1:
+        divider = '/'
+    else:
+        divider = '\\'
+    return path+divider+file_name
+
+# Serializes the credential store's read-modify-write cycles within this process (see CredentialStore.acquire).
+credential_store_lock = threading.Lock()
+
+class CredentialStore:
+    """A small JSON index of the live tokens, keyed by admin email address.
+    
+    Only live tokens are kept: logging out removes the entry, and tokens older than TOKEN_MAX_AGE
+    are dropped whenever the store is written, so the file stays the same size however long GAS runs.
+    Several admins can be logged in at once; 'current' names the one used when no email is given."""
+    def __init__(self, path, log_path=None):
+        self.path = path
+        self.log_path = log_path
+        self.lock_file = None
+    
+    def acquire(self, writing=True):
+        """Locks the store against every other thread and, when writing, every other GAS process (e.g. a daemon
+        and the command line) until release.
+        
+        Other processes are kept out by an flock on a .lock file next to the store, where there is fcntl. Readers
+        don't need it, since the store is replaced atomically, so only writing creates the .lock file."""
+        credential_store_lock.acquire()
+        if fcntl and writing:
+            try:
+                self.lock_file = open(self.path + '.lock', 'a')
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            except Exception:
+                credential_store_lock.release()
+                raise
+    
+    def release(self):
+        try:
+            if self.lock_file:
+                self.lock_file.close() # which releases the flock
+                self.lock_file = None
+        finally:
+            credential_store_lock.release()
+    
+    def load(self):
+        """Returns the store's contents, importing the old gas_credential_log.txt the first time."""
+        if not os.path.isfile(self.path):
+            return self.import_log()
+        try:
+            store_file = open(self.path, 'r')
+            try:
+                data = json.load(store_file)
+            finally:
+                store_file.close()
+        except (IOError, ValueError):
+            return {'current': '', 'tokens': {}}
+        data.setdefault('current', '')
+        data.setdefault('tokens', {})
+        return data
+    
+    def save(self, data):
+        """Writes the store, dropping expired tokens. The file is replaced atomically, so readers never see half of it."""
+        now = time.time()
+        for email in data['tokens'].keys():
+            if data['tokens'][email].get('logged_in', 0) + TOKEN_MAX_AGE < now:
+                del data['tokens'][email]
+        if data['current'] not in data['tokens']:
+            data['current'] = ''
+        write_file_atomically(self.path, json.dumps(data, indent=2), 0600) # the tokens are as good as passwords
+    
+    def import_log(self):
+        """Builds the store from the tokens in an old gas_credential_log.txt, which held one line per log in."""
+        data = {'current': '', 'tokens': {}}
+        if not self.log_path or not os.path.isfile(self.log_path):
+            return data
+        log_file = open(self.log_path, 'r')
+        try:
+            for line in log_file:
+                split_line = [entry.strip() for entry in line.split(',')]
+                if len(split_line) < 5:
+                    continue
+                (line_date, line_activity, line_username, line_domain, line_token) = split_line[:5]
+                email = line_username+'@'+line_domain
+                if line_activity in ('log_in', 'validate') and line_token!='removed':
+                    try:
+                        validated_until = int(split_line[5])
+                    except (IndexError, ValueError):
+                        validated_until = 0 # written before validation times were stored; validate it again
+                    data['tokens'][email] = {'token': line_token, 'logged_in': time.time(), 'validated_until': validated_until}
+                    data['current'] = email
+                elif line_activity=='log_out':
+                    data['tokens'].pop(email, None)
+                    data['current'] = ''
+        finally:
+            log_file.close()
+        return data
+    
+    def get(self, email=''):
+        """Returns the stored entry for email (or for the current admin), or None."""
+        self.acquire(writing=False)
+        try:
+            data = self.load()
+            email = email or data['current']
+            entry = data['tokens'].get(email)
+            if entry:
+                entry = dict(entry)
+                entry['email'] = email
+                entry['is_current'] = (email == data['current'])
+            return entry
+        finally:
+            self.release()
+    
+    def put(self, email, token, validated_until, logged_in=None):
+        """Stores token for email and makes email the current admin."""
+        self.acquire()
+        try:
+            data = self.load()
+            if logged_in is None:
+                logged_in = data['tokens'].get(email, {}).get('logged_in', time.time())
+            data['tokens'][email] = {'token': token, 'logged_in': logged_in, 'validated_until': validated_until}
+            data['current'] = email
+            self.save(data)
+        finally:
+            self.release()
+    
+    def remove(self, email, token=None):
+        """Forgets the token for email (if given a token, only if that is still the one stored)."""
+        self.acquire()
+        try:
+            data = self.load()
+            if token is not None and data['tokens'].get(email, {}).get('token') != token:
+                return # logged in again meanwhile
+            data['tokens'].pop(email, None)
+            if data['current'] == email:
+                data['current'] = ''
+            self.save(data)
+        finally:
+            self.release()
+
 class Credentials:
     def __init__(self, email='', password=''):
         """Comments"""
@@ -88,13 +1039,15 @@ class Credentials:
             self.domain = ''
             self.password = ''
             # self.log_in will attempt to use last authentication token used
-          
-        path = os.path.dirname(os.path.abspath(sys.argv[0]))
-        if os.path.abspath('/') != -1:
-            divider = '/'
-        else:
-            divider = '\\'
-        self.token_path = path+divider+'gas_credential_log.txt'
+        self.token = ''
+        load_api('provisioning') # every login goes through the Provisioning API
+        self.reauthentication_lock = threading.Lock()
+        self.service_pool = {}
+        self.service_pool_lock = threading.Lock()
+        self.customer_id = ''
+        
+        self.token_path = path_for_gas_file('gas_credential_log.txt')
+        self.store = CredentialStore(path_for_gas_file('gas_credentials.json'), log_path=self.token_path)
         self.log_in()
     
     def get_email(self):
@@ -109,128 +1062,249 @@ class Credentials:
         """Returns the currently logged in domain name."""
         return self.domain
     
-    def credential_line_to_list(self, line):
-        split_line = line.split(',')
-        split_line = [new_line.strip() for new_line in split_line]
-        
-        if len(split_line)==5:
-            return split_line # in format date, activity, username, domain, token
-        else:
-            return ['','','','','']
-        
     def last_credentials(self):
-        # First checks to see whether the username/password combination has a token from Google.
+        """Returns the stored token entry for this username and domain, or for the current admin if none was given."""
         try:
-            if os.path.isfile(self.token_path):
-                token_file = open(self.token_path, 'r')
-                token_fileLines = token_file.readlines()
-                token_file.close()
-            
-                last_line = token_fileLines[-1] # the last line in the file should be the most up-to-date authorization token
-                return self.credential_line_to_list(last_line)
+            if self.username:
+                return self.store.get(self.get_email())
             else:
-                return ['','','','','']
-        except:
-            return ['','','','','']
+                return self.store.get()
+        except (IOError, OSError):
+            return None
 
-    def get_email_settings_object(self):
-        """Returns an EmailSettings object from gdata."""
+    def get_pooled_service(self, service_class, api_family, domain=None):
+        """Returns the service_class object for domain (by default the logged in domain), creating it the first time.
+        
+        Each domain gets its own service objects, all sharing this credential's token, so commands for
+        secondary domains never change the domain of a service another command may be using.
+        Requests are rate limited by api_family (see API_RATE_LIMITS)."""
+        domain = domain or self.domain
+        key = (service_class, domain)
+        self.service_pool_lock.acquire()
         try:
-            return self.EmailSettings
-        except:
-            self.EmailSettings = gdata.apps.emailsettings.service.EmailSettingsService(domain=self.domain)
-            self.EmailSettings.SetClientLoginToken(self.service.current_token.get_token_string())
-            return self.EmailSettings
+            if key not in self.service_pool:
+                self.service_pool[key] = self.authorize_service(new_service(service_class, domain=domain), api_family)
+            return self.service_pool[key]
+        finally:
+            self.service_pool_lock.release()
+    
+    def get_service(self, domain=None):
+        """Returns an AppsService (Provisioning API) object from gdata for domain."""
+        return self.get_pooled_service(load_api('provisioning').AppsService, 'provisioning', domain)
+    
+    def get_email_settings_object(self, domain=None):
+        """Returns an EmailSettings object from gdata for domain."""
+        return self.get_pooled_service(load_api('email_settings').EmailSettingsService, 'email_settings', domain)
 
     def get_organization_object(self):
         """Returns an OrganizationService object from gdata."""
-        try:
-            return self.Orgs
-        except:
-            self.Orgs = gdata.apps.orgs.service.OrganizationService(domain=self.domain)
-            self.Orgs.SetClientLoginToken(self.service.current_token.get_token_string())
-            return self.Orgs
+        return self.get_pooled_service(load_api('orgs').OrganizationService, 'orgs')
 
-    def get_groups_object(self):
-        """Returns a GroupsService object from gdata."""
+    def get_customer_id(self):
+        """Returns the customer id of the Google Apps account, which the organization feeds are addressed by."""
+        if not self.customer_id:
+            self.customer_id = self.get_organization_object().RetrieveCustomerId()['customerId']
+        return self.customer_id
+
+    def get_groups_object(self, domain=None):
+        """Returns a GroupsService object from gdata for domain."""
+        return self.get_pooled_service(load_api('groups').GroupsService, 'groups', domain)
+    
+    def get_service_objects(self):
+        """Returns every gdata service object created so far with this credential's token."""
+        self.service_pool_lock.acquire()
         try:
-            return self.Groups
-        except:
-            self.Groups = gdata.apps.groups.service.GroupsService(domain=self.domain)
-            self.Groups.SetClientLoginToken(self.service.current_token.get_token_string())
-            return self.Groups
+            return self.service_pool.values()
+        finally:
+            self.service_pool_lock.release()
+    
+    def authorize_service(self, service, api_family):
+        """Gives service the current token, rate limits its requests, and retries the ones rejected for the token or a quota.
+        
+        Tokens are trusted for TOKEN_VALIDATION_TTL without being checked, so an expired one is only noticed
+        when a real call comes back 401. The request is then repeated with a fresh token, so only that one call is retried.
+        Requests rejected because a quota was exceeded were not carried out, so they are sent again (up to QUOTA_RETRIES
+        times) once the api_family's RateLimiter has backed off; after that, QuotaExceeded is raised."""
+        service.SetClientLoginToken(self.token)
+        send_request = service.request
+        limiter = get_rate_limiter(api_family)
+        def request(operation, url, data=None, headers=None, url_params=None):
+            reauthenticated = False
+            quota_retries = 0
+            labels = {'api': api_family, 'method': operation, 'endpoint': endpoint_name(url)}
+            while True:
+                limiter.acquire()
+                used_token = self.token
+                started = time.time()
+                try:
+                    response = send_request(operation, url, data=data, headers=headers, url_params=url_params)
+                except Exception, e:
+                    metrics.count('gas_api_requests_total', dict(labels, status=e.__class__.__name__))
+                    trace(dict(labels, type='request', command=getattr(trace_context, 'command', None), url=str(url),
+                               start=started, end=time.time(), status='error', error=error_reason(e)))
+                    raise
+                finished = time.time()
+                metrics.observe('gas_api_request_seconds', labels, finished-started)
+                metrics.count('gas_api_requests_total', dict(labels, status=response.status))
+                trace(dict(labels, type='request', command=getattr(trace_context, 'command', None), url=str(url),
+                           start=started, end=finished, status=response.status))
+                if response.status < 400:
+                    limiter.increase()
+                    return response
+                if response.status == 401 and not reauthenticated:
+                    response.read() # discard the error body
+                    metrics.count('gas_reauthentications_total', {'api': api_family})
+                    self.reauthenticate(used_token)
+                    reauthenticated = True
+                    continue
+                response = BufferedResponse(response)
+                if is_quota_response(response):
+                    if quota_retries >= QUOTA_RETRIES:
+                        raise QuotaExceeded(api_family, response.status)
+                    metrics.count('gas_api_quota_backoffs_total', {'api': api_family})
+                    limiter.backoff()
+                    quota_retries += 1
+                    continue
+                return response
+        service.request = request
+        return service
+    
+    def reauthenticate(self, rejected_token):
+        """Replaces rejected_token with a new token from Google, on every service object of this credential."""
+        self.reauthentication_lock.acquire()
+        try:
+            if self.token != rejected_token:
+                return # another request already re-authenticated
+            if not self.password:
+                # otherwise later runs would trust the rejected token until its validated_until
+                self.store.remove(self.get_email(), rejected_token)
+                raise Exception("Your saved GAS login for %s has expired. Please log in again." % self.get_email())
+            self.token = self.request_token()
+            for service in self.get_service_objects():
+                service.SetClientLoginToken(self.token)
+        finally:
+            self.reauthentication_lock.release()
+    
+    def request_token(self):
+        """Logs in to Google with the username and password, and records the new token in the credential store."""
+        service = new_service(gdata.apps.service.AppsService, email=self.get_email(), domain=self.domain, password=self.password)
+        try:
+            service.ProgrammaticLogin()
+            service.RetrieveUser(self.username) # test that we're successfully authorized
+        except gdata.service.BadAuthentication, e:
+            raise Exception("Invalid username and password combination. Please try again.")
+        except gdata.apps.service.AppsForYourDomainException, e:
+            raise Exception ("Either the user you entered is not a Google "
+                             "Apps Administrator or the Provisioning API is "
+                             "not enabled for your domain. Please see: "
+                             "http://www.google.com/support/a/bin/answer.py?hl=en&answer=60757")
+        except socket.error, e:
+            raise Exception("Failed to connect to Google's servers.")
+        
+        token = service.current_token.get_token_string()
+        self.store.put(self.get_email(), token, int(time.time()) + TOKEN_VALIDATION_TTL, logged_in=time.time())
+        self.write_audit_line('log_in')
+        return token
+    
+    def write_audit_line(self, activity):
+        """Appends an activity line to the audit log, if it is enabled."""
+        if not WRITE_CREDENTIAL_AUDIT_LOG:
+            return
+        try:
+            token_file = open(self.token_path, 'a')
+            token_file.write("\n%s,%s,%s,%s" % (time.asctime(), activity, self.username, self.domain))
+            token_file.close()
+        except IOError:
+            pass # the audit log is not worth failing a command over
     
     def log_in(self):
-        """Authorizes the username, domain, and password with Google.  Stores a token in the text file tokens.txt"""
+        """Authorizes the username, domain, and password with Google.  Stores a token in the credential store gas_credentials.json"""
         is_authorized = False
         
         # First checks to see whether the username/password combination has a token from Google.
-        (line_date, line_activity, line_username, line_domain, line_token) = self.last_credentials()
-        if (line_username==self.username and line_domain==self.domain) or self.username=='':
-            # Either the token matches, or no username was given, in which case we'll try the last token.
-            try:
-                service = gdata.apps.service.AppsService(domain=line_domain)
-                service.SetClientLoginToken(line_token)
-                service.RetrieveUser(line_username) # test that we're successfully authorized
-            except gdata.apps.service.AppsForYourDomainException, e:
-                pass
-            except socket.error, e:
-                raise Exception("Failed to connect to Google's servers.")
-            else:
-                # Successful login.
+        entry = self.last_credentials()
+        if entry:
+            # Either the token matches, or no username was given, in which case we'll try the current admin's token.
+            (line_username, line_domain) = entry['email'].split('@', 1)
+            line_token = entry['token']
+            validated_until = entry['validated_until']
+            if time.time() < validated_until:
+                # The token was validated recently enough to trust it without a round-trip.
                 is_authorized = True
+            else:
+                try:
+                    service = new_service(gdata.apps.service.AppsService, domain=line_domain)
+                    service.SetClientLoginToken(line_token)
+                    service.RetrieveUser(line_username) # test that we're successfully authorized
+                except gdata.apps.service.AppsForYourDomainException, e:
+                    pass
+                except socket.error, e:
+                    raise Exception("Failed to connect to Google's servers.")
+                else:
+                    # Successful login.
+                    is_authorized = True
+            if is_authorized:
                 self.domain = line_domain
                 self.username = line_username
                 self.token = line_token
-
+                if time.time() >= validated_until:
+                    self.store.put(self.get_email(), self.token, int(time.time()) + TOKEN_VALIDATION_TTL)
+                elif not entry['is_current']:
+                    self.store.put(self.get_email(), self.token, validated_until) # makes this admin the current one
         
         if not is_authorized:
-            service = gdata.apps.service.AppsService(email=self.get_email(), domain=self.domain, password=self.password)
-            try:
-                service.ProgrammaticLogin()
-                service.RetrieveUser(self.username) # test that we're successfully authorized
-                is_authorized = True
-            except gdata.service.BadAuthentication, e:
-                raise Exception("Invalid username and password combination. Please try again.")
-            except gdata.apps.service.AppsForYourDomainException, e:
-                raise Exception ("Either the user you entered is not a Google "
-                                 "Apps Administrator or the Provisioning API is "
-                                 "not enabled for your domain. Please see: "
-                                 "http://www.google.com/support/a/bin/answer.py?hl=en&answer=60757")
-            except socket.error, e:
-                raise Exception("Failed to connect to Google's servers.")
-            
-            self.token = service.current_token.get_token_string()
-            
-            token_file = open(self.token_path, 'a')
-            token_file.write("\n%s,log_in,%s,%s,%s" %
-                             (time.asctime(), self.username, self.domain, self.token))
-            token_file.close()
-            
-        self.service = service
-        return service
+            self.token = self.request_token()
+        
+        self.service = self.get_service()
+        return self.service
     
     def log_out(self):
-        """Removes the authentication token from the token file, and adds a log out activity."""
-        
-        token_file = open(self.token_path, 'r')
-        token_lines = token_file.readlines()
-        token_file.close()
-        
-        token_file = open(self.token_path, 'w')
-        for line in token_lines:
-            (line_date, line_activity, line_username, line_domain, line_token) = self.credential_line_to_list(line)
-            if line_activity=='log_in' and line_token==self.token:
-                token_file.write(line_date + ',log_in,' + line_username + ',' + line_domain + ',' + 'removed')
-            else:
-                token_file.write(line)
-        token_file.write("\n"+time.asctime() + ',log_out,' + self.username + ',' + self.domain + ',no_token')
-        token_file.close()
+        """Removes the authentication token from the credential store, and adds a log out activity."""
+        self.store.remove(self.get_email())
+        self.write_audit_line('log_out')
         
         self.username = ''
         self.domain = ''
         self.token = ''
         self.service = False
+        self.service_pool = {}
+
+def split_user_name(credential, user_name):
+    """Splits user_name into a user name and a domain. Names without an @domain are in the logged in domain."""
+    if user_name.find('@') > 0:
+        return (user_name[:user_name.find('@')], user_name[user_name.find('@')+1:])
+    return (user_name, credential.get_domain())
+
+class Session:
+    """Holds the authenticated Credentials shared by every command run in this process."""
+    def __init__(self):
+        self.credential = None
+        self.lock = threading.Lock()
+    
+    def get_credential(self):
+        """Returns the shared Credentials, logging in with the last stored token the first time it is needed."""
+        self.lock.acquire()
+        try:
+            if not self.credential:
+                self.credential = Credentials('', '')
+            return self.credential
+        finally:
+            self.lock.release()
+    
+    def set_credential(self, credential):
+        """Replaces the shared Credentials, e.g. after an explicit log in."""
+        self.lock.acquire()
+        try:
+            self.credential = credential
+        finally:
+            self.lock.release()
+    
+    def reset(self):
+        """Forgets the shared Credentials, so the next command logs in again."""
+        self.set_credential(None)
+
+# The one Session used by execute(), and through it by GASI's RunCommands.
+session = Session()
 
 def log_in(email='', password=''):
     """Logs in with the credentials provided by the email and password arguments."""
@@ -245,11 +1319,591 @@ def print_authentication(credential=None):
     """Prints output explaining the current authentication status."""
     try:
         if not credential:
-            credential = Credentials()
+            credential = session.get_credential()
         log('Currently authenticated as %s to %s' % (credential.get_email(), credential.get_domain()))
     except:
         log('GAS is not currently signed in to Google.')
 
+## PAGED LISTINGS ##
+
+# How many pages a listing fetches ahead of the page being used.
+PREFETCH_PAGES = 2
+# How many listings (e.g. the users of different organization units) are fetched at once.
+PREFETCH_LISTINGS = 4
+
+def iter_property_pages(service, uri):
+    """Yields each page of a paged property feed as a list of property dicts.
+    
+    The next page is only fetched once the previous one has been taken, so the feed is never held in memory
+    at once. Each page is fetched with the retries of retry_policies['read_feed_page']."""
+    while uri:
+        feed = call_with_retries('read_feed_page', service._GetPropertyFeed, uri)
+        yield [service._PropertyEntry2Dict(entry) for entry in feed.entry]
+        next_link = feed.GetNextLink()
+        uri = next_link and next_link.href
+
+def property_listing(service, uri):
+    """Returns a function that starts listing the paged property feed at uri, for PagePrefetcher."""
+    return lambda: iter_property_pages(service, uri)
+
+class PagePrefetcher:
+    """Iterates over the pages of one or more listings, fetching them on background threads ahead of their use.
+    
+    listings are functions that each return an iterator of pages (see property_listing). Up to workers
+    listings are fetched at once, but the pages always come in listing order, so a run sees them in the same
+    order every time. Each listing holds at most depth fetched pages, and no more than twice workers listings
+    are fetched ahead of the one in use, so memory stays bounded however long and many the listings are."""
+    def __init__(self, listings, depth=PREFETCH_PAGES, workers=1):
+        self.listings = Queue.Queue()
+        self.pages = [] # a queue of fetched pages for every listing, in listing order
+        for listing in listings:
+            pages = Queue.Queue(depth)
+            self.pages.append(pages)
+            self.listings.put((listing, pages))
+        self.workers = max(1, min(workers, len(listings)))
+        # a listing is only started with a token, which is given back once its pages have been used
+        self.tokens = Queue.Queue()
+        for i in range(2*self.workers):
+            self.tokens.put(None)
+        self.stopped = False
+        # requests made for the listing belong to the command and row that iterates over it
+        self.context = (getattr(trace_context, 'command', None), getattr(trace_context, 'row', None))
+    
+    def __iter__(self):
+        threads = [threading.Thread(target=self.fetch) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for pages in self.pages:
+                while True:
+                    (kind, value) = pages.get()
+                    if kind == 'page':
+                        yield value
+                    elif kind == 'done':
+                        break
+                    else:
+                        raise value[0], value[1], value[2]
+                self.tokens.put(None)
+            for thread in threads:
+                thread.join() # every listing is done, so they are only finding that out
+        finally:
+            self.stopped = True # stops the fetching threads if iteration ended early
+    
+    def fetch(self):
+        """Fetches the pages of listings, in order, until there are none left, on a background thread."""
+        (trace_context.command, trace_context.row) = self.context
+        while not self.stopped:
+            try:
+                (listing, pages) = self.listings.get_nowait()
+            except Queue.Empty:
+                return
+            if not self.wait(self.tokens):
+                return
+            try:
+                listing_pages = listing()
+                if profiler:
+                    listing_pages = profiler.iterate(listing_pages)
+                for page in listing_pages:
+                    if not self.put(pages, ('page', page)):
+                        return
+            except Exception:
+                self.put(pages, ('error', sys.exc_info()))
+                return
+            self.put(pages, ('done', None))
+    
+    def wait(self, tokens):
+        """Waits for a token, unless iteration stops first. Returns whether a token was taken."""
+        while not self.stopped:
+            try:
+                tokens.get(timeout=0.1)
+                return True
+            except Queue.Empty:
+                pass
+        return False
+    
+    def put(self, pages, item):
+        """Waits for room for item in a listing's pages, unless iteration stops first. Returns whether item was put."""
+        while not self.stopped:
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+def iter_user_pages(credential):
+    """Yields the users of the organization a page at a time, as lists of dicts with orgUserEmail and orgUnitPath.
+    
+    When the domain has organization units, the users of each unit are listed separately, PREFETCH_LISTINGS
+    units at a time, so the pages come in unit by unit (always in the same order) rather than in address order."""
+    org_service = credential.get_organization_object()
+    customer_id = credential.get_customer_id()
+    org_paths = []
+    for page in iter_property_pages(org_service, '/a/feeds/orgunit/2.0/'+customer_id+'?get=all'):
+        org_paths.extend([org['orgUnitPath'] for org in page])
+    if not org_paths:
+        return PagePrefetcher([property_listing(org_service, '/a/feeds/orguser/2.0/'+customer_id+'?get=all')])
+    listings = [org_unit_users_listing(credential, path) for path in ['/'] + org_paths]
+    return PagePrefetcher(listings, workers=PREFETCH_LISTINGS)
+
+def org_unit_users_listing(credential, path):
+    """Returns the listing of the users directly in the organization unit at path, for PagePrefetcher."""
+    uri = '/a/feeds/orguser/2.0/%s?get=children&orgUnitPath=%s' % (credential.get_customer_id(), urllib.quote(path))
+    return property_listing(credential.get_organization_object(), uri)
+
+## DIRECTORY CACHE ##
+
+# The kinds of entries the directory cache keeps. members and owners hold the lists of each group's
+# members and owners, and org_users the organization unit of every user.
+DIRECTORY_KINDS = ['users', 'nicknames', 'groups', 'members', 'owners', 'orgs', 'org_users']
+
+class DirectoryCache:
+    """A snapshot of the domain's users, nicknames, groups, group members and organization units, kept in a JSON file.
+    
+    Every entry keeps the time it was fetched, and every kind the time it was last fetched in full, so readers
+    can tell whether what they find is fresh enough (see --max-age). Changes are kept in memory until save()."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = False
+        self.data = {'synced': {}}
+        if os.path.exists(path):
+            cache_file = open(path, 'rb')
+            try:
+                self.data = json.load(cache_file, object_hook=utf8_dict)
+            finally:
+                cache_file.close()
+        for kind in DIRECTORY_KINDS:
+            self.data.setdefault(kind, {})
+    
+    def get(self, kind, key, max_age):
+        """Returns the entry of kind for key if it was fetched at most max_age seconds ago, otherwise None."""
+        self.lock.acquire()
+        try:
+            entry = self.data[kind].get(key)
+        finally:
+            self.lock.release()
+        if entry and time.time() - entry['fetched'] <= max_age:
+            return entry
+        return None
+    
+    def entries(self, kind, max_age):
+        """Returns a dict of every entry of kind by key, if they were all fetched at most max_age seconds ago, otherwise None."""
+        self.lock.acquire()
+        try:
+            if time.time() - self.data['synced'].get(kind, 0) > max_age:
+                return None
+            return dict(self.data[kind])
+        finally:
+            self.lock.release()
+    
+    def put(self, kind, key, entry):
+        """Stores entry (a dict) as the entry of kind for key, fetched now."""
+        self.lock.acquire()
+        try:
+            self.data[kind][key] = dict(entry, fetched=time.time())
+            self.changed = True
+        finally:
+            self.lock.release()
+    
+    def drop(self, kind, key=None):
+        """Forgets the entry of kind for key, or, without a key, that the entries of kind are complete."""
+        self.lock.acquire()
+        try:
+            if key is None:
+                self.data['synced'].pop(kind, None)
+            else:
+                self.data[kind].pop(key, None)
+            self.changed = True
+        finally:
+            self.lock.release()
+    
+    def replace(self, kind, entries, fetched):
+        """Replaces the entries of kind with entries, a dict of all of them by key, fetched in full at time fetched."""
+        for entry in entries.values():
+            entry['fetched'] = fetched
+        self.lock.acquire()
+        try:
+            self.data[kind] = entries
+            self.data['synced'][kind] = fetched
+            self.changed = True
+        finally:
+            self.lock.release()
+    
+    def synced(self, kind):
+        """Returns the time the entries of kind were last fetched in full, or 0."""
+        return self.data['synced'].get(kind, 0)
+    
+    def save(self):
+        """Writes the cache to its file, if it changed."""
+        self.lock.acquire()
+        try:
+            if not self.changed:
+                return
+            write_file_atomically(self.path, json.dumps(self.data, separators=(',', ':'))) # so an interrupted save never leaves half a cache
+            self.changed = False
+        finally:
+            self.lock.release()
+
+def utf8_dict(dictionary):
+    """Encodes the unicode keys and values of a dict loaded from JSON as UTF-8 strings, like gdata's."""
+    encoded = {}
+    for (key, value) in dictionary.items():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        encoded[key.encode('utf-8')] = value
+    return encoded
+
+# The DirectoryCache of the run once it is opened (see open_directory_cache), and how old its entries may be
+# for commands to read them instead of asking the API (--max-age). Without a max age, commands keep the
+# cache up to date with what they read and change, but always ask the API.
+directory_cache = None
+cache_max_age = None
+
+def open_directory_cache(max_age=None):
+    """Opens the directory cache of the run, gas_directory.json, and sets how old the entries commands read may be."""
+    global directory_cache, cache_max_age
+    if directory_cache is None:
+        directory_cache = DirectoryCache(path_for_gas_file('gas_directory.json'))
+    if max_age is not None:
+        cache_max_age = max_age
+
+def close_directory_cache():
+    """Saves the directory cache of the run, if it was opened."""
+    if directory_cache is not None:
+        directory_cache.save()
+
+def cached_entry(kind, key):
+    """Returns the cached entry of kind for key, if the run reads from the cache and it is fresh enough, otherwise None."""
+    if directory_cache is None or cache_max_age is None:
+        return None
+    return directory_cache.get(kind, key, cache_max_age)
+
+def cached_entries(kind):
+    """Returns a dict of every cached entry of kind, if the run reads from the cache and they are fresh enough, otherwise None."""
+    if directory_cache is None or cache_max_age is None:
+        return None
+    return directory_cache.entries(kind, cache_max_age)
+
+def cache_entry(kind, key, entry):
+    """Stores an entry read from the API in the directory cache, if it is open."""
+    if directory_cache is not None:
+        directory_cache.put(kind, key, entry)
+
+def user_key(credential, user_name):
+    """Returns the directory cache key of a user (or nickname): its full, lower case email address."""
+    return ('%s@%s' % split_user_name(credential, user_name)).lower()
+
+def group_key(credential, id):
+    """Returns the directory cache key of a group: its full, lower case email address."""
+    if '@' not in id:
+        id = id + '@' + credential.get_domain()
+    return id.lower()
+
+def org_key(credential, name):
+    """Returns the directory cache key of an organization unit: its path, without the leading /."""
+    return name.strip('/')
+
+# The cache keys of each kind of entry, from the argument that names them.
+directory_keys = {'users': user_key, 'org_users': user_key, 'nicknames': user_key,
+                  'groups': group_key, 'members': group_key, 'owners': group_key, 'orgs': org_key}
+
+# The directory cache entries each command changes, as (kind, argument naming the entry). They are dropped after
+# the command runs, so later reads of them go to the API. An argument of None means the command may add or
+# remove entries of that kind, so the cache no longer has all of them.
+cache_changes = {
+    'create_user': [('users', 'user_name'), ('users', None), ('org_users', None)],
+    'update_user': [('users', 'user_name'), ('users', 'new_user_name'), ('users', None), ('org_users', None),
+                    ('nicknames', None)],
+    'rename_user': [('users', 'user_name'), ('users', 'new_user_name'), ('users', None), ('org_users', None),
+                    ('nicknames', None)],
+    'suspend_user': [('users', 'user_name')],
+    'restore_user': [('users', 'user_name')],
+    'delete_user': [('users', 'user_name'), ('org_users', 'user_name'), ('nicknames', None)],
+    'create_nickname': [('nicknames', 'nickname'), ('nicknames', None)],
+    'delete_nickname': [('nicknames', 'nickname')],
+    'create_group': [('groups', 'id'), ('groups', None)],
+    'update_group': [('groups', 'id')],
+    'delete_group': [('groups', 'id'), ('members', 'id'), ('owners', 'id')],
+    'add_member_to_group': [('members', 'id')],
+    'remove_member_from_group': [('members', 'id')],
+    'add_owner_to_group': [('owners', 'id')],
+    'remove_owner_from_group': [('owners', 'id')],
+    'sync_group_members': [('members', 'id'), ('owners', 'id')],
+    'create_org': [('orgs', 'name'), ('orgs', None)],
+    'update_org': [('orgs', 'name'), ('orgs', 'new_name'), ('orgs', None), ('org_users', None)],
+    'add_users_to_org': [('org_users', None)],
+    'delete_org': [('orgs', 'name')],
+    }
+
+def forget_changed_entries(credential, call_function, dictionary):
+    """Drops the directory cache entries the command may have changed, if the cache is open, and the membership index if it changed."""
+    global membership_index, membership_index_build
+    changes = cache_changes.get(call_function, [])
+    if [kind for (kind, argument) in changes if kind in ('members', 'owners')]:
+        lock = membership_index_lock()
+        lock.acquire()
+        try:
+            membership_index = membership_index_build = None
+        finally:
+            lock.release()
+    if directory_cache is None:
+        return
+    for (kind, argument) in changes:
+        if argument is None:
+            directory_cache.drop(kind)
+        elif dictionary.get(argument):
+            directory_cache.drop(kind, directory_keys[kind](credential, dictionary[argument]))
+
+def user_properties(user):
+    """Returns the properties of a gdata UserEntry that read_user prints, as a dict."""
+    return {'user_name': user.login.user_name, 'first_name': user.name.given_name, 'last_name': user.name.family_name,
+            'admin': user.login.admin, 'suspended': user.login.suspended, 'ip_whitelisted': user.login.ip_whitelisted,
+            'change_password': user.login.change_password, 'agreed_to_terms': user.login.agreed_to_terms}
+
+def iter_feed_pages(service, uri, converter):
+    """Yields the entries of each page of a paged gdata feed, with converter turning the feed's XML into a feed."""
+    while uri:
+        feed = call_with_retries('read_feed_page', service.Get, uri, converter=converter)
+        yield feed.entry
+        next_link = feed.GetNextLink()
+        uri = next_link and next_link.href
+
+def update_directory_cache(credential, kinds=','.join(DIRECTORY_KINDS), max_age='0'):
+    """Fetches the kinds of entries (all of them by default) that weren't fetched in full in the last max_age seconds into the directory cache."""
+    open_directory_cache()
+    max_age = float(max_age)
+    domain = credential.get_domain()
+    for kind in kinds.split(','):
+        kind = kind.strip()
+        if kind not in DIRECTORY_KINDS:
+            raise Exception('Unknown kind of directory entry %s. Use some of: %s' % (kind, ', '.join(DIRECTORY_KINDS)))
+        if time.time() - directory_cache.synced(kind) <= max_age:
+            log('The cached %s are up to date' % kind)
+            continue
+        log('Updating the cached %s' % kind)
+        started = time.time()
+        entries = {}
+        if kind == 'users':
+            service = credential.get_service()
+            for page in PagePrefetcher([lambda: iter_feed_pages(service, '/a/feeds/%s/user/2.0' % domain,
+                                                                gdata.apps.UserFeedFromString)]):
+                for user in page:
+                    entries[user_key(credential, user.login.user_name)] = user_properties(user)
+        elif kind == 'nicknames':
+            service = credential.get_service()
+            for page in PagePrefetcher([lambda: iter_feed_pages(service, '/a/feeds/%s/nickname/2.0' % domain,
+                                                                gdata.apps.NicknameFeedFromString)]):
+                for nickname in page:
+                    entries[user_key(credential, nickname.nickname.name)] = {'user_name': nickname.login.user_name}
+        elif kind == 'groups':
+            group_service = credential.get_groups_object()
+            for page in PagePrefetcher([property_listing(group_service, '/a/feeds/group/2.0/'+domain)]):
+                for group in page:
+                    entries[group_key(credential, group['groupId'])] = group
+        elif kind in ('members', 'owners'):
+            entries = fetch_group_members(credential, [kind])[kind]
+        elif kind == 'orgs':
+            org_service = credential.get_organization_object()
+            uri = '/a/feeds/orgunit/2.0/'+credential.get_customer_id()+'?get=all'
+            for page in PagePrefetcher([property_listing(org_service, uri)]):
+                for org in page:
+                    entries[org_key(credential, org['orgUnitPath'])] = org
+        elif kind == 'org_users':
+            for page in iter_user_pages(credential):
+                for user in page:
+                    entries[user['orgUserEmail'].lower()] = {'orgUnitPath': org_key(credential, user.get('orgUnitPath') or '/')}
+        directory_cache.replace(kind, entries, started)
+        log('Cached %d %s' % (len(entries), kind))
+    directory_cache.save()
+
+def fetch_group_members(credential, kinds):
+    """Fetches the members and/or owners (kinds) of every group in one sweep, PREFETCH_LISTINGS listings at a time.
+    
+    Returns {kind: {group key: {kind: [member properties]}}}, the form of the directory cache's entries."""
+    group_service = credential.get_groups_object()
+    group_ids = []
+    for page in PagePrefetcher([property_listing(group_service, '/a/feeds/group/2.0/'+credential.get_domain())]):
+        group_ids.extend([group['groupId'] for group in page])
+    fetched = {}
+    for kind in kinds:
+        fetched[kind] = dict([(group_key(credential, group_id), {kind: []}) for group_id in group_ids])
+    listings = [group_members_listing(group_service, group_id, kind) for group_id in group_ids for kind in kinds]
+    for (group_id, kind, page) in PagePrefetcher(listings, workers=PREFETCH_LISTINGS):
+        fetched[kind][group_key(credential, group_id)][kind].extend(page)
+    return fetched
+
+def group_members_listing(group_service, group_id, kind):
+    """Returns the listing of the members (or owners, for kind 'owners') of a group, for PagePrefetcher.
+    
+    Its pages are (group_id, kind, page), so the pages of many listings can be told apart."""
+    uri = '/a/feeds/group/2.0/%s/%s/%s' % (group_service.domain, urllib.quote(group_id), kind[:-1])
+    return lambda: ((group_id, kind, page) for page in iter_property_pages(group_service, uri))
+
+## GROUP MEMBERSHIP INDEX ##
+
+class MembershipIndex:
+    """The members and owners of every group, and the groups every address is a member or owner of.
+    
+    Addresses are numbered, and every list is a sorted array of numbers, so even the index of a large
+    domain is small. Lookups are dictionary and array operations, with no API calls."""
+    def __init__(self, members, owners):
+        """Builds the index from the members and owners of every group, as dicts of lists of addresses by group key."""
+        self.addresses = []
+        self.numbers = {}
+        # group number -> sorted array of the numbers of its members (or owners)
+        self.members = {}
+        self.owners = {}
+        for (group, group_members) in members.items():
+            self.members[self.number(group)] = self.numbers_of(group_members)
+        for (group, group_owners) in owners.items():
+            self.owners[self.number(group)] = self.numbers_of(group_owners)
+        # address number -> sorted array of the numbers of the groups it is a member (or owner) of
+        self.member_of = self.reverse(self.members)
+        self.owner_of = self.reverse(self.owners)
+    
+    def number(self, address):
+        """Returns the number of address, numbering it if it is new."""
+        address = address.lower()
+        if address not in self.numbers:
+            self.numbers[address] = len(self.addresses)
+            self.addresses.append(address)
+        return self.numbers[address]
+    
+    def numbers_of(self, addresses):
+        return array.array('i', sorted(set([self.number(address) for address in addresses])))
+    
+    def reverse(self, lists):
+        """Turns {group number: array of address numbers} into {address number: array of group numbers}."""
+        reversed_lists = {}
+        for (group, numbers) in lists.items():
+            for number in numbers:
+                reversed_lists.setdefault(number, []).append(group)
+        for (number, groups) in reversed_lists.items():
+            reversed_lists[number] = array.array('i', sorted(groups))
+        return reversed_lists
+    
+    def groups_of(self, address, indirect=False):
+        """Returns a sorted list of (group, role) for the groups address is a member ('member') or owner ('owner') of.
+        
+        With indirect, also the groups it belongs to through groups it is a member of."""
+        number = self.numbers.get(address.lower())
+        if number is None:
+            return []
+        roles = {}
+        for group in self.owner_of.get(number, []):
+            roles[group] = 'owner'
+        for group in self.member_of.get(number, []):
+            roles.setdefault(group, 'member')
+        if indirect:
+            pending = roles.keys()
+            while pending:
+                for group in self.member_of.get(pending.pop(), []):
+                    if group not in roles:
+                        roles[group] = 'indirect member'
+                        pending.append(group)
+        return sorted([(self.addresses[group], role) for (group, role) in roles.items()])
+    
+    def people_of(self, group):
+        """Returns the set of the numbers of a group's members and owners, or None if there is no such group."""
+        number = self.numbers.get(group.lower())
+        if number is None or (number not in self.members and number not in self.owners):
+            return None
+        return set(self.members.get(number, [])) | set(self.owners.get(number, []))
+
+class PendingIndex:
+    """A membership index being built: callers that need the index meanwhile wait() for it instead of sweeping too."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.index = None
+        self.built = None
+        self.failure = None
+    
+    def wait(self):
+        """Returns the index once it is built, or raises the error that stopped the build."""
+        self.done.wait()
+        if self.failure:
+            (error_type, error, error_traceback) = self.failure
+            raise error_type, error, error_traceback
+        return self.index
+
+# How long the membership index is used, in seconds, if the run has no --max-age.
+MEMBERSHIP_INDEX_MAX_AGE = 300
+
+# The MembershipIndex of this process and the time its data was fetched, built the first time a command needs it
+# (see get_membership_index), and dropped when a command changes a group's members or owners or it gets too old.
+# membership_index_build is the PendingIndex of the build in progress, if any. The lock guarding them is created
+# on first use, so under the async engine (which patches threading) it is one of gevent's; it is never held while
+# the index is being built.
+membership_index = None
+membership_index_built = None
+membership_index_build = None
+membership_index_locks = {}
+
+def membership_index_lock():
+    if 'lock' not in membership_index_locks:
+        membership_index_locks.setdefault('lock', threading.Lock()) # setdefault: every caller gets the same lock
+    return membership_index_locks['lock']
+
+def get_membership_index(credential):
+    """Returns the membership index, building it from the directory cache, if it is fresh enough, or else with one sweep of every group.
+    
+    The index is rebuilt once it is older than --max-age (or MEMBERSHIP_INDEX_MAX_AGE). Only one caller builds
+    it; the others wait for that build."""
+    global membership_index, membership_index_built, membership_index_build
+    max_age = cache_max_age
+    if max_age is None:
+        max_age = MEMBERSHIP_INDEX_MAX_AGE
+    lock = membership_index_lock()
+    lock.acquire()
+    try:
+        if membership_index is not None and time.time() - membership_index_built <= max_age:
+            return membership_index
+        build = membership_index_build
+        if build is None:
+            build = membership_index_build = PendingIndex()
+            building = True
+        else:
+            building = False
+    finally:
+        lock.release()
+    if not building:
+        return build.wait()
+    try:
+        (build.index, build.built) = build_membership_index(credential)
+    except:
+        build.failure = sys.exc_info()
+    lock.acquire()
+    try:
+        if membership_index_build is build: # otherwise a command changed the groups during the build
+            membership_index_build = None
+            if not build.failure:
+                (membership_index, membership_index_built) = (build.index, build.built)
+    finally:
+        lock.release()
+    build.done.set()
+    return build.wait()
+
+def build_membership_index(credential):
+    """Returns a new MembershipIndex and the time its data was fetched."""
+    members = cached_entries('members')
+    owners = cached_entries('owners')
+    if members is not None and owners is not None:
+        built = min(directory_cache.synced('members'), directory_cache.synced('owners'))
+    else:
+        log('Indexing the members and owners of every group')
+        built = time.time()
+        fetched = fetch_group_members(credential, ['members', 'owners'])
+        (members, owners) = (fetched['members'], fetched['owners'])
+        if directory_cache is not None:
+            directory_cache.replace('members', members, built)
+            directory_cache.replace('owners', owners, built)
+    index = MembershipIndex(
+        dict([(group, [member['memberId'] for member in entry['members']]) for (group, entry) in members.items()]),
+        dict([(group, [owner['email'] for owner in entry['owners']]) for (group, entry) in owners.items()]))
+    return (index, built)
+
 ## USER FUNCTIONS ##
 def create_user(credential, user_name, first_name, last_name, password, password_hash_function=None, suspended='false', quota_limit=None, change_password=None):
     """Creates a user."""
@@ -260,48 +1914,44 @@ def create_user(credential, user_name, first_name, last_name, password, password
         password = new_hash.hexdigest()
         password_hash_function = 'SHA-1'
     
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
         
     log("Creating account for %s" % user_name)
     try:
-        credential.service.CreateUser(user_name=user_name, family_name=last_name, given_name=first_name, password=password, suspended=suspended, quota_limit=quota_limit, password_hash_function=password_hash_function, change_password=change_password)
+        credential.get_service(domain).CreateUser(user_name=user_name, family_name=last_name, given_name=first_name, password=password, suspended=suspended, quota_limit=quota_limit, password_hash_function=password_hash_function, change_password=change_password)
     except gdata.apps.service.AppsForYourDomainException, e:
+        if is_transient_error(e):
+            raise # left for execute() to retry
         if e.reason == 'EntityExists':
             raise Exception('EntityExists error. '+user_name+" is an existing user, group or nickname. Please delete the existing entity with this name before creating "+user_name)
         elif e.reason == 'UserDeletedRecently':
             raise Exception('UserDeletedRecently error. '+user_name+" was recently deleted within five days. You'll need to wait five days before a user can be created or renamed to this name.")
         else:
             raise StandardError('An error occurred: '+e.reason)
-    
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def update_user(credential, user_name, new_user_name=None, first_name=None, last_name=None, password=None, password_hash_function=None, admin=None, suspended=None, ip_whitelisted=None, change_password=None):
     """Updates the user."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
+    service = credential.get_service(domain)
     
-    user = credential.service.RetrieveUser(user_name)
+    user = service.RetrieveUser(user_name)
+    # Only fields that differ from the retrieved entry count as changes; without any, the update is skipped.
+    changed = False
     
-    if new_user_name!=None:
+    if new_user_name!=None and new_user_name!=user.login.user_name:
         user.login.user_name = new_user_name
+        changed = True
 
-    if first_name!=None:
+    if first_name!=None and first_name!=user.name.given_name:
         user.name.given_name = first_name
+        changed = True
     
-    if last_name!=None:
+    if last_name!=None and last_name!=user.name.family_name:
         user.name.family_name = last_name
+        changed = True
     
-    if password!=None:
+    if password!=None: # the current password can't be read, so it always counts as a change
+        changed = True
         if not password_hash_function:
             new_hash = sha1()
             new_hash.update(password)
@@ -310,105 +1960,91 @@ def update_user(credential, user_name, new_user_name=None, first_name=None, last
         user.login.password = password
         user.login.hash_function_name = password_hash_function
     
-    if admin!=None:
-        user.login.admin = 'true' if admin else 'false'
-    
-    if suspended!=None:
-        user.login.suspended = 'true' if suspended else 'false'
-    
-    if ip_whitelisted!=None:
-        user.login.ip_whitelisted = 'true' if ip_whitelisted else 'false'
+    for (flag, value) in (('admin', admin), ('suspended', suspended), ('ip_whitelisted', ip_whitelisted),
+                          ('change_password', change_password)):
+        if value!=None and flag_text(value)!=flag_text(getattr(user.login, flag)):
+            setattr(user.login, flag, flag_text(value))
+            changed = True
     
-    if change_password!=None:
-        user.login.change_password = 'true' if change_password else 'false'
+    if not changed and skip_unchanged_writes:
+        log('%s is already up to date' % user_name)
+        skip_stats.record('update_user')
+        return
     
     log('Updating %s' % user_name)
     try:
-        credential.service.UpdateUser(user_name, user)
+        service.UpdateUser(user_name, user)
     except gdata.apps.service.AppsForYourDomainException, e:
+        if is_transient_error(e):
+            raise # left for execute() to retry
         if e.reason == 'EntityExists':
             raise Exception('EntityExists error. '+user.login.user_name+" is an existing user, group or nickname. Please delete the existing entity with this name before renaming "+user_name)
         elif e.reason == 'UserDeletedRecently':
             raise Exception('UserDeletedRecently error. '+user.login.user_name+" was recently deleted within five days. You'll need to wait five days before a user can be created or renamed to this name.")
         else:
             raise StandardError('An error occurred: '+e.reason)        
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+
+def flag_text(value):
+    """Returns 'true' or 'false' for a flag: text like true, false, on or off, True for a bare argument, or None
+    for a flag the API left unset (which is false)."""
+    if isinstance(value, basestring):
+        value = str_to_bool(value)
+    return 'true' if value else 'false'
 
 def read_user(credential, user_name, first_name=True, last_name=True, admin=True, suspended=True, ip_whitelisted=True, change_password=True, agreed_to_terms=True):
     """Reads the user with username user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
+    key = user_key(credential, user_name+'@'+domain)
     
-    try:
-        user = credential.service.RetrieveUser(user_name)
-    except gdata.apps.service.AppsForYourDomainException, e:
-        if e.reason == 'EntityDoesNotExist':
-            raise Exception('EntityDoesNotExist error. '+user_name+" does not exist.")
-        else:
-            raise StandardError('An error occurred: '+e.reason)        
+    user = cached_entry('users', key)
+    if user is None:
+        try:
+            user = user_properties(credential.get_service(domain).RetrieveUser(user_name))
+        except gdata.apps.service.AppsForYourDomainException, e:
+            if is_transient_error(e):
+                raise # left for execute() to retry
+            if e.reason == 'EntityDoesNotExist':
+                raise Exception('EntityDoesNotExist error. '+user_name+" does not exist.")
+            else:
+                raise StandardError('An error occurred: '+e.reason)        
+        cache_entry('users', key, user)
     
-    print 'User: %s' % user.login.user_name
+    print 'User: %s' % user['user_name']
     
     if first_name:
-        print 'First Name: %s' % user.name.given_name
+        print 'First Name: %s' % user['first_name']
     
     if last_name:
-        print 'Last Name: %s' % user.name.family_name
+        print 'Last Name: %s' % user['last_name']
     
     if admin:
-        print 'Is Admin: %s' % user.login.admin
+        print 'Is Admin: %s' % user['admin']
     
     if suspended:
-        print 'Is Suspended: %s' % user.login.suspended
+        print 'Is Suspended: %s' % user['suspended']
     
     if ip_whitelisted:
-        print 'IP Whitelisted: %s' % user.login.ip_whitelisted
+        print 'IP Whitelisted: %s' % user['ip_whitelisted']
     
     if change_password:
-        print 'Must Change Password: %s' % user.login.change_password
+        print 'Must Change Password: %s' % user['change_password']
     
     if agreed_to_terms:
-        print 'Has Agreed to Terms: %s' % user.login.agreed_to_terms    
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+        print 'Has Agreed to Terms: %s' % user['agreed_to_terms']
 
 def suspend_user(credential, user_name):
     """Suspends the user with username user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     log('Suspending %s' % user_name)
-    credential.service.SuspendUser(user_name)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+    credential.get_service(domain).SuspendUser(user_name)
 
 def restore_user(credential, user_name):
     """Suspends the user with username user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     log('Restoring %s' % user_name)
-    credential.service.RestoreUser(user_name)
-
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+    credential.get_service(domain).RestoreUser(user_name)
 
 def rename_user(credential, user_name, new_user_name):
     """Renames the user with username user_name with new_user_name. This function is explicitly included since renaming user is such a popular feature."""
@@ -416,195 +2052,186 @@ def rename_user(credential, user_name, new_user_name):
 
 def delete_user(credential, user_name, no_rename='false'):
     """Deletes the user with username user_name. The username is first renamed to include the current timestamp; this is so that a new user with the same username can be recreated immediately. If no_rename is set, this part is skipped."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
+    service = credential.get_service(domain)
     
     no_rename=str_to_bool(no_rename)
     if no_rename:
         log('Deleting %s' % user_name)
-        credential.service.DeleteUser(user_name)
+        service.DeleteUser(user_name)
     else:
         time_stamp = time.strftime("%Y%m%d%H%M%S")
         renamed_user_name = user_name+'-'+time_stamp
-        user = credential.service.RetrieveUser(user_name)
+        user = service.RetrieveUser(user_name)
         user.login.user_name = renamed_user_name
         log('Renaming %s to %s' % (user_name, renamed_user_name))
-        credential.service.UpdateUser(user_name, user)
+        service.UpdateUser(user_name, user)
         log('Deleting %s' % renamed_user_name)
-        credential.service.DeleteUser(renamed_user_name)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+        # The rename can't be undone by running delete_user again, so retry the delete on its own.
+        try:
+            call_with_retries('delete_renamed_user', gdata.apps.service.AppsService.DeleteUser, service, renamed_user_name)
+        except Exception, e:
+            raise Exception('%s was renamed to %s, but could not be deleted: %s' % (user_name, renamed_user_name, e))
+
+def user_entries(credential):
+    """Yields [email address, organization unit path] for every user, for use as the entries of a command template."""
+    for page in iter_user_pages(credential):
+        for user in page:
+            yield [user['orgUserEmail'], user.get('orgUnitPath') or '/']
 
 def print_users(credential):
-    """Prints a list of all users in the organization."""
-    org_service = credential.get_organization_object()
-    all_users = org_service.RetrieveAllOrganizationUsers()
-    for user in all_users:
-        print user['orgUserEmail']
+    """Prints a list of all users in the organization, a page at a time as the pages arrive."""
+    for page in iter_user_pages(credential):
+        for user in page:
+            print user['orgUserEmail']
+        sys.stdout.flush()
 
 ## USER EMAIL SETTING FUNCTIONS ##
 
 def create_label(credential, user_name, label):
     """Creates a label for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
         
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
     log('Creating label %s for %s' % (label, user_name))
     email_settings.CreateLabel(user_name, label)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def create_filter(credential, user_name, mail_from=None, mail_to=None, subject=None,
                    has_the_word=None, does_not_have_the_word=None,
                    has_attachment='false', label=None, should_mark_as_read='false',
                    should_archive='false'):
     """Just a pass-through for the GData CreateFilter method."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     has_attachment = str_to_bool(has_attachment)
     should_mark_as_read = str_to_bool(should_mark_as_read)
     should_archive = str_to_bool(should_archive)
     
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
     log('Creating filter for %s' % user_name)
     email_settings.CreateFilter(username=user_name, from_=mail_from, to=mail_to, subject=subject,
                        has_the_word=has_the_word, does_not_have_the_word=does_not_have_the_word,
                        has_attachment=has_attachment, label=label, should_mark_as_read=should_mark_as_read,
                        should_archive=should_archive)
+
+def setting_already_set(call_function, email_settings, user_name, setting, wanted):
+    """Returns whether user_name's email setting (e.g. 'signature') already has the wanted properties, so that
+    call_function can skip writing them. The skip is logged and counted.
     
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
+    Flags (bools in wanted) are compared as flags, everything else as unicode text, since gdata may return
+    either bytes or unicode. A setting that can't be read is never already set, so it is written as before."""
+    if not skip_unchanged_writes:
+        return False
+    uri = '/a/feeds/emailsettings/2.0/'+email_settings.domain+'/'+user_name+'/'+setting
+    try:
+        current = email_settings._GetProperties(uri)
+    except gdata.apps.service.AppsForYourDomainException:
+        return False
+    for (name, value) in wanted.items():
+        current_value = current.get(name)
+        if current_value is None:
+            return False
+        if isinstance(value, bool):
+            if current_value.lower() != flag_text(value):
+                return False
+        elif setting_text(current_value) != setting_text(value):
+            return False
+    log('The %s setting of %s is already up to date' % (setting, user_name))
+    skip_stats.record(call_function)
+    return True
+
+def setting_text(value):
+    """Returns a setting's value as unicode, decoding UTF-8 bytes."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
 
 def update_web_clips(credential, user_name, enable):
     """Enables or disables web clips for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     enable = str_to_bool(enable)
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
     if enable:
         log('Enabling web clips for %s' % user_name)
     else:
         log('Disabling web clips for %s' % user_name)
     email_settings.UpdateWebClipSettings(user_name, enable)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def create_send_as(credential, user_name, name, address, reply_to=None, make_default='false'):
     """Creates a send_as alias for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     make_default = str_to_bool(make_default)
     
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
     log('Creating send as alias for %s to send as %s' % (user_name, address))
     email_settings.CreateSendAsAlias(user_name, name, address, reply_to, make_default)
     
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
-    
 def update_forwarding(credential, user_name, enable, forward_to, action):
     """Enables or disables email forwarding for user_name. Action should be one of keep, archive, or delete."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     enable = str_to_bool(enable)
     action = action.upper()
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
+    wanted = {'enable': enable}
+    if enable:
+        wanted.update({'forwardTo': forward_to, 'action': action})
+    if setting_already_set('update_forwarding', email_settings, user_name, 'forwarding', wanted):
+        return
     if enable:
         log('Enabling forwarding for %s to forward to %s' % (user_name, forward_to))
     else:
         log('Disabling forwarding for %s' % user_name)
     email_settings.UpdateForwarding(user_name, enable, forward_to, action)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 
 def update_pop(credential, user_name, enable, enable_for, action):
     """Enables or disables POP access for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     enable = str_to_bool(enable)
     enable_for = enable_for.upper()
     action = action.upper()
     
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
+    wanted = {'enable': enable}
+    if enable:
+        wanted.update({'enableFor': enable_for, 'action': action})
+    if setting_already_set('update_pop', email_settings, user_name, 'pop', wanted):
+        return
     if enable:
         log('Enabling POP for %s' % user_name)
     else:
         log('Disabling POP for %s' % user_name)
     email_settings.UpdatePop(user_name, enable, enable_for, action)
 
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
-
 def update_imap(credential, user_name, enable):
     """Enables or disables IMAP access for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     enable = str_to_bool(enable)
     
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
+    if setting_already_set('update_imap', email_settings, user_name, 'imap', {'enable': enable}):
+        return
     if enable:
         log('Enabling IMAP for %s' % user_name)
     else:
         log('Disabling IMAP for %s' % user_name)
     email_settings.UpdateImap(user_name, enable)
 
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
-
 def update_vacation(credential, user_name, enable, subject='', message='', contacts_only='false'):
     """Enables or disables a vacation responder for user_name."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
     enable = str_to_bool(enable)
-    contacts_only = str_to_bool(enable)
+    contacts_only = str_to_bool(contacts_only)
+    
+    wanted = {'enable': enable}
+    if enable:
+        wanted.update({'subject': subject, 'message': message.replace('\\n', '\n'), 'contactsOnly': contacts_only})
     
     # The following code is needed to properly deal with new lines. This was found in the Google Apps Manager, used here under the Apache 2.0 license.
     message = cgi.escape(message).replace('\\n', '&#xA;')
@@ -616,27 +2243,22 @@ def update_vacation(credential, user_name, enable, subject='', message='', conta
         <apps:property name="contactsOnly" value="'''+str(contacts_only)+'''" />
     </atom:entry>'''
     
-    email_settings = credential.get_email_settings_object()
-    uri = 'https://apps-apis.google.com/a/feeds/emailsettings/2.0/'+email_settings.domain+'/'+user_name+'/vacation'
+    email_settings = credential.get_email_settings_object(domain)
+    uri = '/a/feeds/emailsettings/2.0/'+email_settings.domain+'/'+user_name+'/vacation'
     
+    if setting_already_set('update_vacation', email_settings, user_name, 'vacation', wanted):
+        return
     if enable:
         log('Enabling vacation responder for %s' % user_name)
     else:
         log('Disabling vacation responder for %s' % user_name)
     
     email_settings.Put(vacation_xml, uri) # JRP, 12/22/10 - we have to Put this since the GData library doesn't currently support new lines
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def update_signature(credential, user_name, signature):
     """Replaces the user's signature with signature. Note that new lines are currently not supported."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
+    wanted = {'signature': signature.replace('\\n', '\n')}
     
     # The following code is needed to properly deal with new lines. This was found in the Google Apps Manager, used here under the Apache 2.0 license.
     signature = cgi.escape(signature).replace('\\n', '&#xA;')
@@ -645,31 +2267,20 @@ def update_signature(credential, user_name, signature):
         <apps:property name="signature" value="'''+signature+'''" />
     </atom:entry>'''
     
+    email_settings = credential.get_email_settings_object(domain)
+    if setting_already_set('update_signature', email_settings, user_name, 'signature', wanted):
+        return
     log('Updating signature for %s to %s' % (user_name, signature))
-    
-    email_settings = credential.get_email_settings_object()
-    uri = 'https://apps-apis.google.com/a/feeds/emailsettings/2.0/'+email_settings.domain+'/'+user_name+'/signature'
+    uri = '/a/feeds/emailsettings/2.0/'+email_settings.domain+'/'+user_name+'/signature'
     email_settings.Put(xml_signature, uri)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def update_language(credential, user_name, language):
     """Replaces the user's language."""
-    old_domain=''
-    if user_name.find('@') > 0:
-        old_domain = credential.service.domain
-        credential.service.domain = user_name[user_name.find('@')+1:]
-        user_name = user_name[:user_name.find('@')]
+    (user_name, domain) = split_user_name(credential, user_name)
     
-    email_settings = credential.get_email_settings_object()
+    email_settings = credential.get_email_settings_object(domain)
     log('Updating language for %s to %s' % (user_name, language))
     email_settings.UpdateLanguage(user_name, language)
-    
-    if old_domain:
-        # reset domain to the old domain
-        credential.service.domain = old_domain
 
 def update_general():
     pass
@@ -682,8 +2293,12 @@ def create_nickname(credential, nickname, user_name):
 
 def read_nickname(credential, nickname):
     log('Reading info for nickname %s' % (nickname))
-    result = credential.service.RetrieveNickname(nickname)
-    print 'Nickname %s is under user %s' % (nickname, result.login.user_name)
+    key = user_key(credential, nickname)
+    result = cached_entry('nicknames', key)
+    if result is None:
+        result = {'user_name': credential.service.RetrieveNickname(nickname).login.user_name}
+        cache_entry('nicknames', key, result)
+    print 'Nickname %s is under user %s' % (nickname, result['user_name'])
 
 def retrieve_nicknames(credential, user_name):
     log('Reading all nicknames for %s' % (user_name))
@@ -715,14 +2330,22 @@ def create_group(credential, id, name, description, permission=''):
 def read_group(credential, id):
     log('Creating group %s' % id)
     group_service = credential.get_groups_object()
-    group = group_service.RetrieveGroup(id)
+    key = group_key(credential, id)
+    group = cached_entry('groups', key)
+    if group is None:
+        group = group_service.RetrieveGroup(id)
+        cache_entry('groups', key, group)
+    # fetch everything before printing, so a retry doesn't print the group twice
+    group_members = cached_entry('members', key)
+    if group_members is None:
+        group_members = {'members': group_service.RetrieveAllMembers(group['groupId'])}
+        cache_entry('members', key, group_members)
     print 'Group id: %s' % group['groupId']
     print 'Group name: %s' % group['groupName']
     print 'Description: %s' % group['description']
     print 'Email permission: %s' % group['emailPermission']
     print 'Members:'
-    group_members = group_service.RetrieveAllMembers(group['groupId'])
-    for member in group_members:
+    for member in group_members['members']:
         print member['memberId']+','+member['memberType']
 
 def update_group(credential, id, name, description, permission=''):
@@ -742,20 +2365,28 @@ def delete_group(credential, id):
 def list_groups(credential):
     log('Listing all groups')
     group_service = credential.get_groups_object()
-    groups = group_service.RetrieveAllGroups()
-    for group in groups:
-        print '' # new line
-        print 'Group id: %s' % group['groupId']
-        print 'Group name: %s' % group['groupName']
-        print 'Description: %s' % group['description']
-        print 'Email permission: %s' % group['emailPermission']
+    # the next pages are fetched while each one is printed
+    groups_listing = property_listing(group_service, '/a/feeds/group/2.0/'+group_service.domain)
+    for page in PagePrefetcher([groups_listing]):
+        for group in page:
+            print '' # new line
+            print 'Group id: %s' % group['groupId']
+            print 'Group name: %s' % group['groupName']
+            print 'Description: %s' % group['description']
+            print 'Email permission: %s' % group['emailPermission']
+        sys.stdout.flush()
 
 def list_group_members(credential, id, suspended_users='false'):
     log('Retrieving members in group %s' % id)
     suspended_users = str_to_bool(suspended_users)
     group_service = credential.get_groups_object()
-    members = group_service.RetrieveAllMembers(id, suspended_users)
-    owners = group_service.RetrieveAllOwners(id, suspended_users)
+    if suspended_users:
+        # the cache only holds the members who aren't suspended
+        members = group_service.RetrieveAllMembers(id, suspended_users)
+        owners = group_service.RetrieveAllOwners(id, suspended_users)
+    else:
+        members = cached_group_members(credential, group_service, id, 'members')
+        owners = cached_group_members(credential, group_service, id, 'owners')
     for member in members:
         print member['memberId']+',member'
     for owner in owners:
@@ -763,6 +2394,18 @@ def list_group_members(credential, id, suspended_users='false'):
     if len(owners) + len(members) == 0:
         print '(none)'
 
+def cached_group_members(credential, group_service, id, kind):
+    """Returns the members (or, for kind 'owners', the owners) of a group, from the directory cache if it is fresh enough."""
+    key = group_key(credential, id)
+    entry = cached_entry(kind, key)
+    if entry is None:
+        if kind == 'owners':
+            entry = {kind: group_service.RetrieveAllOwners(id)}
+        else:
+            entry = {kind: group_service.RetrieveAllMembers(id)}
+        cache_entry(kind, key, entry)
+    return entry[kind]
+
 def list_group_owners(credential, id):
     log('Retrieving owners of group %s' % id)
     group_service = credential.get_groups_object()
@@ -772,6 +2415,29 @@ def list_group_owners(credential, id):
     if not len(owners):
         print '(none)'
 
+def list_user_groups(credential, user_name, indirect='false'):
+    """Lists the groups user_name is a member or owner of (with indirect, also through other groups), from the membership index."""
+    log('Listing the groups of %s' % user_name)
+    groups = get_membership_index(credential).groups_of(user_key(credential, user_name), str_to_bool(indirect))
+    for (group, role) in groups:
+        print group+','+role
+    if not groups:
+        print '(none)'
+
+def group_overlap(credential, id, other_id):
+    """Lists the addresses that are members or owners of both groups, from the membership index."""
+    log('Comparing the members of groups %s and %s' % (id, other_id))
+    index = get_membership_index(credential)
+    people = index.people_of(group_key(credential, id))
+    other_people = index.people_of(group_key(credential, other_id))
+    for (group, group_people) in ((id, people), (other_id, other_people)):
+        if group_people is None:
+            raise Exception('EntityDoesNotExist error. Group %s does not exist.' % group)
+    both = sorted([index.addresses[number] for number in people & other_people])
+    for address in both:
+        print address
+    log('%d of the %d members of %s are also among the %d members of %s' % (len(both), len(people), id, len(other_people), other_id))
+
 def add_member_to_group(credential, user, id):
     log('Adding member %s to group %s' % (user, id))
     group_service = credential.get_groups_object()
@@ -792,6 +2458,112 @@ def remove_owner_from_group(credential, user, id):
     group_service = credential.get_groups_object()
     group_service.RemoveOwnerFromGroup(user, id)
 
+# How many adds and removes sync_group_members sends at once.
+GROUP_SYNC_WORKERS = 8
+
+def read_group_members_file(credential, members_file):
+    """Returns the addresses a sync_group_members file lists, as {'members': set, 'owners': set} of cache keys.
+    
+    Every line is checked first; the problems of all of them are reported together, by line."""
+    wanted = {'members': set(), 'owners': set()}
+    problems = []
+    try:
+        with open(members_file, 'rb') as input_file:
+            reader = csv.reader(input_file)
+            try:
+                for row in reader:
+                    address = row and row[0].strip()
+                    if not address or address.startswith('#') or address.lower() in ('member', 'email', 'address'):
+                        continue # blank lines, comments and a header row
+                    role = (len(row) > 1 and row[1].strip().lower()) or 'member'
+                    if role not in ('member', 'owner'):
+                        problems.append('line %d: unknown role %s for %s; use member or owner' % (reader.line_num, role, address))
+                    elif len(row) > 2 or ' ' in address or address.count('@') > 1:
+                        problems.append('line %d: %s is not an address, optionally followed by ,owner or ,member' % (
+                            reader.line_num, ','.join(row)))
+                    else:
+                        wanted[role+'s'].add(user_key(credential, address))
+            except csv.Error, e:
+                problems.append('line %d: %s' % (reader.line_num, e))
+    except IOError, e:
+        raise Exception('Could not read %s: %s' % (members_file, e.strerror or e))
+    if problems:
+        raise Exception('%s has problems, so group members were not changed:\n  %s' % (members_file, '\n  '.join(problems)))
+    return wanted
+
+def sync_group_members(credential, id, members_file, remove_extra='false', workers=str(GROUP_SYNC_WORKERS)):
+    """Makes a group's members and owners those listed in members_file, sending only the adds (and, with
+    remove_extra, the removes) that are needed.
+    
+    Each line of members_file is an address, optionally followed by ,owner (or ,member). The group's current
+    members and owners are fetched once, and the changes are sent workers at a time. With remove_extra,
+    members not in the file are removed, and so are owners whose address isn't in the file at all."""
+    log('Syncing the members of group %s with %s' % (id, members_file))
+    remove_extra = str_to_bool(remove_extra)
+    group_service = credential.get_groups_object()
+    wanted = read_group_members_file(credential, members_file)
+    
+    # the current members and owners, read from the API rather than the cache, since this command changes them
+    current = {'members': set(), 'owners': set()}
+    listings = [group_members_listing(group_service, id, kind) for kind in ('members', 'owners')]
+    for (group_id, kind, page) in PagePrefetcher(listings, workers=2):
+        current[kind].update([(member.get('memberId') or member.get('email') or '').lower() for member in page])
+    
+    changes = []
+    for address in sorted(wanted['members'] - current['members']):
+        changes.append(('add_member_to_group', 'Added member', group_service.AddMemberToGroup, address))
+    for address in sorted(wanted['owners'] - current['owners']):
+        changes.append(('add_owner_to_group', 'Added owner', group_service.AddOwnerToGroup, address))
+    if remove_extra:
+        listed = wanted['members'] | wanted['owners']
+        for address in sorted(current['members'] - listed):
+            changes.append(('remove_member_from_group', 'Removed member', group_service.RemoveMemberFromGroup, address))
+        for address in sorted(current['owners'] - listed):
+            changes.append(('remove_owner_from_group', 'Removed owner', group_service.RemoveOwnerFromGroup, address))
+    unchanged = len(wanted['members'] & current['members']) + len(wanted['owners'] & current['owners'])
+    
+    failures = send_group_changes(credential, id, changes, int(workers))
+    for change in changes:
+        (call_function, done, method, address) = change
+        if change in failures:
+            print >> sys.stderr, '%s failed for %s: %s' % (call_function, address, failures[change])
+        else:
+            log('%s %s' % (done, address))
+    log('%d change(s) sent to group %s, %d failed, %d address(es) already up to date' % (len(changes)-len(failures), id, len(failures), unchanged))
+    if failures:
+        raise Exception('%d of the %d changes to group %s failed.' % (len(failures), len(changes), id))
+
+def send_group_changes(credential, id, changes, workers):
+    """Sends sync_group_members' changes, (command, description, group service method, address), on workers threads.
+    
+    Each change is retried as its command (e.g. add_member_to_group) would be. Returns {change: error} for the
+    changes that failed. The threads don't print, so the output of a batch row stays together."""
+    pending = Queue.Queue()
+    for change in changes:
+        pending.put(change)
+    failures = {}
+    # requests made for the changes belong to the command and row that sends them
+    context = (getattr(trace_context, 'command', None), getattr(trace_context, 'row', None))
+    def send():
+        (trace_context.command, trace_context.row) = context
+        while True:
+            try:
+                change = pending.get_nowait()
+            except Queue.Empty:
+                return
+            (call_function, done, method, address) = change
+            try:
+                call_with_retries(call_function, lambda credential, user, id: method(user, id), credential, user=address, id=id)
+            except Exception, e:
+                failures[change] = e
+    threads = [threading.Thread(target=send) for i in range(max(1, min(workers, len(changes))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
 ## SHARED CONTACT FUNCTIONS ##
 
 
@@ -836,15 +2608,27 @@ def read_org(credential, name):
     """Reads info about an organization unit."""
     log('Reading organization %s' % name)
     org_service = credential.get_organization_object()
-    org = org_service.RetrieveOrganizationUnit(name)    
+    key = org_key(credential, name)
+    org = cached_entry('orgs', key)
+    if org is None:
+        org = org_service.RetrieveOrganizationUnit(name)
+        cache_entry('orgs', key, org)
     print 'Organization unit name: %s' % name
     print 'Description: %s' % str(org['description'])
     print 'Parent organization unit: %s' % str(org['parentOrgUnitPath'])
     print 'Block inheritance: %s' % str(org['blockInheritance'])
     print 'Users:'
-    users = org_service.RetrieveAllOrganizationUnitUsers(name)
-    for user in users:
-        print '  '+user['orgUserEmail']
+    org_users = cached_entries('org_users')
+    if org_users is not None:
+        for (user_email, org_user) in sorted(org_users.items()):
+            if org_user['orgUnitPath'] == key:
+                print '  '+user_email
+        return
+    # the next pages are fetched while each one is printed
+    for page in PagePrefetcher([org_unit_users_listing(credential, name)]):
+        for user in page:
+            print '  '+user['orgUserEmail']
+        sys.stdout.flush()
 
 def delete_org(credential, name):
     """Reads info about an organization unit. To access a suborganization, use Name1/Name2."""
@@ -916,14 +2700,265 @@ whitelist_functions = {
     'list_groups': list_groups,
     'list_group_members': list_group_members,
     'list_group_owners': list_group_owners,
+    'list_user_groups': list_user_groups,
+    'group_overlap': group_overlap,
+    'sync_group_members': sync_group_members,
     'add_member_to_group': add_member_to_group,
     'remove_member_from_group': remove_member_from_group,
     'add_owner_to_group': add_owner_to_group,
-    'remove_owner_from_group': remove_owner_from_group
+    'remove_owner_from_group': remove_owner_from_group,
+    ## Directory cache ##
+    'update_directory_cache': update_directory_cache
     }
 
+## RETRIES ##
+
+# How many times a command that failed with a transient error is run again.
+RETRY_ATTEMPTS = 5
+
+# The backoff before the n-th retry is a random time (jitter) between 0 and RETRY_BASE_DELAY*2**n seconds,
+# capped at RETRY_MAX_DELAY.
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+
+def is_transient_error(e):
+    """Returns whether the exception e is a failure that may go away if the same request is sent again."""
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return True
+    if isinstance(e, (gdata.apps.service.AppsForYourDomainException, gdata.service.RequestError)):
+        try:
+            if e.args[0]['status'] >= 500:
+                return True
+        except (IndexError, KeyError, TypeError):
+            pass
+        return getattr(e, 'error_code', None) == gdata.apps.service.UNKOWN_ERROR
+    return False
+
+def entity_exists(retrieve, *args):
+    """Calls retrieve(*args), returning False if Google says the entity does not exist."""
+    try:
+        retrieve(*args)
+    except gdata.apps.service.AppsForYourDomainException, e:
+        if getattr(e, 'reason', '') == 'EntityDoesNotExist' or getattr(e, 'error_code', None) == gdata.apps.service.ENTITY_DOES_NOT_EXIST:
+            return False
+        raise
+    return True
+
+# Check functions take the arguments of the command that failed, and tell whether it can be run again:
+# 'retry' if the failed attempt did not change anything, 'done' if it actually went through, or 'fail'
+# if the account is now in a state that running the command again would not fix.
+
+def check_user_created(credential, user_name, **args):
+    (user_name, domain) = split_user_name(credential, user_name)
+    if entity_exists(credential.get_service(domain).RetrieveUser, user_name):
+        return 'done'
+    return 'retry'
+
+def check_user_updated(credential, user_name, new_user_name=None, **args):
+    (user_name, domain) = split_user_name(credential, user_name)
+    service = credential.get_service(domain)
+    if new_user_name and not entity_exists(service.RetrieveUser, user_name):
+        if entity_exists(service.RetrieveUser, new_user_name):
+            return 'done' # the rename went through
+        return 'fail'
+    return 'retry' # setting the same fields again is harmless
+
+def check_user_deleted(credential, user_name, **args):
+    (user_name, domain) = split_user_name(credential, user_name)
+    if entity_exists(credential.get_service(domain).RetrieveUser, user_name):
+        return 'retry' # not renamed or deleted yet, so the whole command can run again
+    # The user was renamed. delete_user already retried deleting the renamed account, and gave up.
+    return 'fail'
+
+def check_nickname_created(credential, nickname, user_name, **args):
+    if entity_exists(credential.service.RetrieveNickname, nickname):
+        return 'done'
+    return 'retry'
+
+def check_nickname_deleted(credential, nickname, **args):
+    if entity_exists(credential.service.RetrieveNickname, nickname):
+        return 'retry'
+    return 'done'
+
+def check_group_created(credential, id, **args):
+    if entity_exists(credential.get_groups_object().RetrieveGroup, id):
+        return 'done'
+    return 'retry'
+
+def check_group_deleted(credential, id, **args):
+    if entity_exists(credential.get_groups_object().RetrieveGroup, id):
+        return 'retry'
+    return 'done'
+
+def check_member_added(credential, user, id, **args):
+    if credential.get_groups_object().IsMember(user, id):
+        return 'done'
+    return 'retry'
+
+def check_member_removed(credential, user, id, **args):
+    if credential.get_groups_object().IsMember(user, id):
+        return 'retry'
+    return 'done'
+
+def check_owner_added(credential, user, id, **args):
+    if credential.get_groups_object().IsOwner(user, id):
+        return 'done'
+    return 'retry'
+
+def check_owner_removed(credential, user, id, **args):
+    if credential.get_groups_object().IsOwner(user, id):
+        return 'retry'
+    return 'done'
+
+def check_renamed_user_deleted(service, renamed_user_name):
+    if entity_exists(service.RetrieveUser, renamed_user_name):
+        return 'retry'
+    return 'done'
+
+# How each command may be retried after a transient error. 'safe' commands only read, or set a value
+# (running them twice has the same effect as once), so they are simply run again. The others are only
+# run again if their check function says the failed attempt did not go through. Commands missing from
+# this table (e.g. create_label or create_filter, which would create duplicates) are never retried.
+retry_policies = {
+    ## Users ##
+    'create_user': check_user_created,
+    'read_user': 'safe',
+    'update_user': check_user_updated,
+    'rename_user': check_user_updated,
+    'delete_user': check_user_deleted,
+    'suspend_user': 'safe',
+    'restore_user': 'safe',
+    'print_users': None, # its pages are retried on their own (read_feed_page), so the output isn't repeated
+    ## Email settings ##
+    'update_web_clips': 'safe',
+    'update_forwarding': 'safe',
+    'update_pop': 'safe',
+    'update_imap': 'safe',
+    'update_vacation': 'safe',
+    'update_signature': 'safe',
+    'update_language': 'safe',
+    ## Nicknames ##
+    'create_nickname': check_nickname_created,
+    'read_nickname': 'safe',
+    'retrieve_nicknames': 'safe',
+    'delete_nickname': check_nickname_deleted,
+    ## Organization units ##
+    'update_org': 'safe',
+    'add_users_to_org': 'safe',
+    'read_org': None, # streams its pages, see print_users
+    ## Groups ##
+    'create_group': check_group_created,
+    'read_group': 'safe',
+    'update_group': 'safe',
+    'delete_group': check_group_deleted,
+    'list_groups': None, # streams its pages, see print_users
+    'list_group_members': 'safe',
+    'list_group_owners': 'safe',
+    'list_user_groups': 'safe',
+    'group_overlap': 'safe',
+    'sync_group_members': 'safe', # reads the members again, so only what is still missing is sent
+    'add_member_to_group': check_member_added,
+    'remove_member_from_group': check_member_removed,
+    'add_owner_to_group': check_owner_added,
+    'remove_owner_from_group': check_owner_removed,
+    ## Steps of commands ##
+    'delete_renamed_user': check_renamed_user_deleted,
+    'read_feed_page': 'safe',
+    }
+
+class RetryStats:
+    """Counts the retries made during a run, and the time spent backing off before them."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.retries = {}
+        self.backoff_time = 0.0
+    
+    def record(self, name, delay):
+        self.lock.acquire()
+        try:
+            self.retries[name] = self.retries.get(name, 0) + 1
+            self.backoff_time += delay
+        finally:
+            self.lock.release()
+    
+    def report(self):
+        """Writes a summary of the retries to stderr, if there were any."""
+        if not self.retries:
+            return
+        counts = ', '.join(['%s: %d' % (name, self.retries[name]) for name in sorted(self.retries.keys())])
+        sys.stderr.write('Retried %d command(s) after transient errors (%s), backing off for %.1f seconds in total.\n' %
+                         (sum(self.retries.values()), counts, self.backoff_time))
+
+retry_stats = RetryStats()
+
+# Whether update_user and the email setting commands skip writes that would not change anything (--always-write turns this off).
+skip_unchanged_writes = True
+
+class SkipStats:
+    """Counts the writes skipped during a run because they would not have changed anything."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.skips = {}
+    
+    def record(self, name):
+        self.lock.acquire()
+        try:
+            self.skips[name] = self.skips.get(name, 0) + 1
+        finally:
+            self.lock.release()
+        metrics.count('gas_skipped_writes_total', {'command': name})
+    
+    def report(self):
+        """Writes a summary of the skipped writes to stderr, if there were any."""
+        if not self.skips:
+            return
+        counts = ', '.join(['%s: %d' % (name, self.skips[name]) for name in sorted(self.skips.keys())])
+        sys.stderr.write('Skipped %d write(s) that would not have changed anything (%s).\n' %
+                         (sum(self.skips.values()), counts))
+
+skip_stats = SkipStats()
+
+def retry_delay(attempt):
+    """Returns the backoff before retry number attempt (counting from 0): exponential, with full jitter."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+def call_with_retries(call_function, function, *args, **kwargs):
+    """Calls function, running it again after a backoff when it fails with a transient error, as retry_policies[call_function] allows."""
+    policy = retry_policies.get(call_function)
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception, e:
+            failure = sys.exc_info()
+            if not policy or not is_transient_error(e) or attempt >= RETRY_ATTEMPTS:
+                raise failure[0], failure[1], failure[2]
+        
+        if policy != 'safe':
+            try:
+                outcome = policy(*args, **kwargs)
+            except Exception:
+                outcome = 'fail' # could not tell whether it is safe, so don't risk running it twice
+            if outcome == 'done':
+                return None
+            elif outcome != 'retry':
+                raise failure[0], failure[1], failure[2]
+        
+        delay = retry_delay(attempt)
+        retry_stats.record(call_function, delay)
+        metrics.count('gas_retries_total', {'command': call_function, 'reason': error_reason(failure[1])})
+        sys.stderr.write('%s failed (%s), retrying in %.1f seconds.\n' % (call_function, failure[1], delay))
+        time.sleep(delay)
+        attempt += 1
+
 def get_logged_in_user():
-    credential = Credentials('', '')
+    credential = session.get_credential()
     return credential.get_email()
     
 def execute(args, credential=None):
@@ -933,28 +2968,948 @@ def execute(args, credential=None):
     # log_in and log_out are treated specially since they use the credential
     if call_function=='log_in':
         credential = Credentials(**dictionary)
+        session.set_credential(credential)
     elif call_function=='log_out':
         try:
-            credential = Credentials(**dictionary)
+            credential = session.get_credential()
         except:
             raise Exception('Cannot log out because you are not logged in.')
-        log_out(credential, **dictionary)
+        log_out(credential)
+        session.reset()
     elif call_function=='print_authentication':
         print_authentication()
     else:
         if not credential:
-            credential = Credentials('', '')
+            # Reuse the session's credential, so a batch only authenticates once.
+            credential = session.get_credential()
         if call_function in whitelist_functions:
-            whitelist_functions[call_function](credential, **dictionary)
+            load_command_apis(call_function)
+            trace_context.command = call_function
+            started = time.time()
+            try:
+                call_with_retries(call_function, whitelist_functions[call_function], credential, **dictionary)
+            except Exception, e:
+                metrics.count('gas_commands_total', {'command': call_function, 'status': 'error'})
+                metrics.count('gas_command_errors_total', {'command': call_function, 'reason': error_reason(e)})
+                if tracer:
+                    (target, domain) = trace_target(credential, dictionary)
+                    trace({'type': 'command', 'command': call_function, 'target': target, 'domain': domain,
+                           'start': started, 'end': time.time(), 'status': 'error', 'error': error_reason(e)})
+                raise
+            finally:
+                metrics.observe('gas_command_seconds', {'command': call_function}, time.time()-started)
+                trace_context.command = None
+                forget_changed_entries(credential, call_function, dictionary)
+            metrics.count('gas_commands_total', {'command': call_function, 'status': 'ok'})
+            if tracer:
+                (target, domain) = trace_target(credential, dictionary)
+                trace({'type': 'command', 'command': call_function, 'target': target, 'domain': domain,
+                       'start': started, 'end': time.time(), 'status': 'ok'})
         else:
             raise Exception('Unknown function '+call_function)
 
+## BATCH EXECUTION ##
+
+def split_command(command):
+    """Splits a command line into the argument list execute() expects, dropping a leading 'gas' if there is one."""
+    args = shlex.split(command)
+    if args and args[0].lower()=='gas':
+        args = args[1:]
+    return args
+
+class ThreadOutput:
+    """The base of sys.stdout replacements that keep each thread's output apart, in self.local.
+    
+    The print statement keeps a softspace flag on the file it prints to, saying whether the next item needs
+    a space before it. Threads printing at once would see each other's flag (and print stray spaces), so
+    here every thread has its own."""
+    def __getattr__(self, name):
+        if name == 'softspace':
+            return getattr(self.local, 'softspace', 0)
+        raise AttributeError(name)
+    
+    def __setattr__(self, name, value):
+        if name == 'softspace':
+            setattr(self.local, 'softspace', value)
+        else:
+            self.__dict__[name] = value
+
+class RowOutput(ThreadOutput):
+    """A sys.stdout (or sys.stderr) replacement that collects what each worker thread writes in its own buffer.
+    
+    Writes from any other thread go straight to the wrapped stream."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def start_row(self):
+        """Starts collecting the current thread's output."""
+        self.local.buffer = []
+    
+    def finish_row(self):
+        """Stops collecting the current thread's output, and returns what was collected."""
+        text = ''.join(self.local.buffer)
+        self.local.buffer = None
+        return text
+    
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.stream.write(text)
+        else:
+            buffer.append(str(text))
+    
+    def flush(self):
+        pass
+
+def command_text(command):
+    """Returns a command (a command line, or an argument list for execute()) as a command line."""
+    if isinstance(command, basestring):
+        return command
+    return ' '.join([pipes.quote(arg) for arg in command])
+
+# Arguments whose values are never written to a run journal or shown in a sync plan.
+SECRET_ARGUMENTS = ['password']
+# What a secret value is replaced with.
+REDACTED = '<redacted>'
+
+def secret_value(arg):
+    """Returns the value of arg (name=value) if its name is one of SECRET_ARGUMENTS, or None."""
+    (name, equals, value) = arg.partition('=')
+    if equals and name.strip().lower() in SECRET_ARGUMENTS:
+        return value
+    return None
+
+def redact_command(command):
+    """Returns the command line with the values of its SECRET_ARGUMENTS replaced by REDACTED.
+    
+    Values that are only template placeholders, like password={3}, are kept, so a redacted template still expands."""
+    try:
+        args = shlex.split(command_text(command))
+    except ValueError:
+        # can't be split into arguments (an unclosed quote), so hide everything after the secret's name
+        return re.sub(r'(?i)(%s)=.*' % '|'.join(SECRET_ARGUMENTS), r'\1=' + REDACTED, command_text(command))
+    redacted = False
+    for (index, arg) in enumerate(args):
+        value = secret_value(arg)
+        if value is not None and not re.match(r'^(\{\d+\})+$', value):
+            args[index] = arg.partition('=')[0] + '=' + REDACTED
+            redacted = True
+    if not redacted:
+        return command_text(command) # keep the quoting as it was, which a template's values may rely on
+    return command_text(args)
+
+class RunJournal:
+    """A durable record of a batch run, so that a run that died can be resumed where it stopped.
+    
+    The journal is a file of JSON lines. The first line describes the run (the command templates, and
+    the input file, the desired-state file of a sync, or the template entries themselves); after that,
+    one line is appended, and flushed to disk, for every command that finishes, giving its row, its
+    position in the row and its status. Opening an existing journal loads which commands already
+    succeeded, and new lines are appended.
+    
+    Passwords are never written (see redact_command): the journal keeps the redacted command lines, and the
+    template entry columns that fill in a password. Only its owner can read the file, and it is deleted
+    once the run has succeeded."""
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self.succeeded = {} # (row number, command number) -> redacted command line
+        self.recorded = False # whether a command was recorded since opening
+        self.lock = threading.Lock()
+        self.is_new = not os.path.isfile(path)
+        if not self.is_new:
+            self.load()
+        self.journal_file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600), 'a')
+        if header and self.is_new:
+            self.write(dict(self.redact_header(header), type='run', started=time.asctime()))
+    
+    def redact_header(self, header):
+        """Returns the run description with the passwords in its templates, and the entry columns that fill them in, redacted."""
+        header = dict(header)
+        secret_columns = set()
+        for template in header['templates']:
+            try:
+                args = shlex.split(template)
+            except ValueError:
+                continue
+            for arg in args:
+                value = secret_value(arg)
+                if value is not None:
+                    secret_columns.update([int(column)-1 for column in re.findall(r'\{(\d+)\}', value)])
+        header['templates'] = [redact_command(template) for template in header['templates']]
+        if header.get('entries') and secret_columns:
+            header['entries'] = [[(index in secret_columns and column and REDACTED) or column for (index, column) in enumerate(entry)]
+                                 for entry in header['entries']]
+        return header
+    
+    def load(self):
+        """Reads what an earlier run recorded."""
+        journal_file = open(self.path, 'r')
+        try:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # the last line may be cut short if the run died while writing it
+                if record.get('type') == 'run':
+                    # json gives unicode strings, but shlex needs byte strings
+                    record['templates'] = [template.encode('utf-8') for template in record['templates']]
+                    if record.get('entries'):
+                        record['entries'] = [[column.encode('utf-8') for column in entry] for entry in record['entries']]
+                    for name in ('input', 'sync'):
+                        if record.get(name):
+                            record[name] = record[name].encode('utf-8')
+                    self.header = record
+                elif record.get('type') == 'command':
+                    key = (record['row'], record['command'])
+                    if record['status'] == 'ok':
+                        self.succeeded[key] = record['text'].encode('utf-8')
+                    else:
+                        self.succeeded.pop(key, None)
+        finally:
+            journal_file.close()
+    
+    def write(self, record):
+        """Appends a record, and makes sure it reaches the disk."""
+        self.lock.acquire()
+        try:
+            self.journal_file.write(json.dumps(record) + '\n')
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+        finally:
+            self.lock.release()
+    
+    def is_done(self, row_number, command_number, command):
+        """Returns whether the command already succeeded in an earlier run."""
+        return self.succeeded.get((row_number, command_number)) == redact_command(command)
+    
+    def is_row_done(self, row_number, row):
+        """Returns whether every command of the row already succeeded in an earlier run."""
+        for (command_number, command) in enumerate(row):
+            if not self.is_done(row_number, command_number, command):
+                return False
+        return True
+    
+    def record(self, row_number, command_number, command, status, error=None):
+        """Records that a command finished with status 'ok' or 'failed'."""
+        record = {'type': 'command', 'row': row_number, 'command': command_number,
+                  'text': redact_command(command), 'status': status}
+        if error:
+            record['error'] = str(error)
+        self.write(record)
+        self.recorded = True
+    
+    def close(self, finished=False):
+        """Closes the journal, deleting it if the whole run succeeded, or if it was new and the run stopped before
+        any command (e.g. when the login failed), since there is nothing left to resume."""
+        self.journal_file.close()
+        if finished or (self.is_new and not self.recorded):
+            os.remove(self.path)
+    
+    def entries(self):
+        """Returns the template entries of the journaled run: a stream of its input file or of every user, the plan of
+        its sync (made again, so only what is still needed is run), or the entries themselves."""
+        if self.header.get('input'):
+            return read_template_entries(self.header['input'])
+        if self.header.get('all_users'):
+            return user_entries(session.get_credential())
+        if self.header.get('sync'):
+            return plan_sync(session.get_credential(), self.header['sync'], 0, self.header.get('delete')).entries()
+        return self.header.get('entries')
+
+def new_journal_path(prefix='gas'):
+    """Returns the path for a new run journal, named after the current time."""
+    name = '%s_journal_%s' % (prefix, time.strftime('%Y%m%d%H%M%S'))
+    path = path_for_gas_file(name + '.jsonl')
+    number = 1
+    while os.path.exists(path):
+        # another run started in the same second
+        number += 1
+        path = path_for_gas_file('%s_%d.jsonl' % (name, number))
+    return path
+
+class BatchExecutor:
+    """Runs rows of commands, several rows at a time.
+    
+    A row is the list of commands expanded from one line of a template (the ;-separated commands),
+    each given as a command line or as the argument list for execute(). Commands in a row always run
+    in order, one after another, but up to workers rows run at the same time. The output of each row
+    is written in one piece, from the calling thread, when the row finishes. If a row fails, its
+    remaining commands are skipped, no new rows are started, and the error is raised once the running
+    rows have finished. With a RunJournal, every finished command is recorded, and commands that
+    already succeeded in an earlier run of the same journal are skipped."""
+    def __init__(self, workers=1, credential=None, journal=None):
+        self.workers = max(1, int(workers))
+        self.credential = credential
+        self.journal = journal
+    
+    def run_command(self, command):
+        """Runs one command."""
+        if isinstance(command, basestring):
+            command = split_command(command)
+        execute(command, self.credential)
+    
+    def run_row(self, row_number, row):
+        """Runs the commands of one row in order."""
+        trace_context.row = row_number
+        for (command_number, command) in enumerate(row):
+            if self.journal and self.journal.is_done(row_number, command_number, command):
+                continue
+            try:
+                if self.journal and REDACTED in command_text(command):
+                    raise Exception('The journal of this run does not keep passwords, so this command cannot be resumed. '
+                                    'Run it again from its input instead.')
+                self.run_command(command)
+            except Exception, e:
+                if self.journal:
+                    self.journal.record(row_number, command_number, command, 'failed', e)
+                raise
+            if self.journal:
+                self.journal.record(row_number, command_number, command, 'ok')
+    
+    def numbered_rows(self, rows):
+        """Numbers the rows, leaving out those the journal says are already done."""
+        for (row_number, row) in enumerate(rows):
+            if self.journal and self.journal.is_row_done(row_number, row):
+                continue
+            yield (row_number, row)
+    
+    def run(self, rows):
+        """Runs every row, and returns the number of rows run. A summary of any retries is written to stderr at the end."""
+        retry_stats.reset()
+        skip_stats.reset()
+        connection_pool.reset()
+        if profiler:
+            rows = profiler.iterate(rows)
+        finished = False
+        try:
+            if not self.credential:
+                # log in before the workers start, so they all share one login
+                self.credential = session.get_credential()
+            if self.workers == 1:
+                count = 0
+                for (row_number, row) in self.numbered_rows(rows):
+                    profile_call(self.run_row, row_number, row)
+                    count += 1
+            else:
+                count = self.run_threaded(self.numbered_rows(rows))
+            finished = True
+            return count
+        finally:
+            if self.journal:
+                self.journal.close(finished)
+            retry_stats.report()
+            skip_stats.report()
+            connection_pool.report()
+    
+    def run_threaded(self, rows):
+        """Runs the rows on a pool of worker threads, writing each row's output as it finishes."""
+        rows_to_run = Queue.Queue(self.workers*2)
+        finished_rows = Queue.Queue()
+        state = {'submitted': 0, 'feeding': True, 'failure': None}
+        stop = threading.Event()
+        
+        def feed():
+            try:
+                for row in rows:
+                    if stop.isSet():
+                        break
+                    while not stop.isSet():
+                        try:
+                            rows_to_run.put(row, timeout=0.1)
+                            state['submitted'] += 1
+                            break
+                        except Queue.Full:
+                            pass
+            except:
+                state['failure'] = sys.exc_info()
+                stop.set()
+            state['feeding'] = False
+        
+        def work():
+            while True:
+                numbered_row = rows_to_run.get()
+                if numbered_row is None:
+                    return
+                if stop.isSet():
+                    finished_rows.put(('', '', None))
+                    continue
+                out.start_row()
+                err.start_row()
+                failure = None
+                try:
+                    profile_call(self.run_row, *numbered_row)
+                except:
+                    failure = sys.exc_info()
+                    stop.set()
+                finished_rows.put((out.finish_row(), err.finish_row(), failure))
+        
+        out = RowOutput(sys.stdout)
+        err = RowOutput(sys.stderr)
+        sys.stdout = out
+        sys.stderr = err
+        try:
+            feeder = threading.Thread(target=feed)
+            feeder.setDaemon(True)
+            feeder.start()
+            workers = []
+            for index in range(self.workers):
+                worker = threading.Thread(target=work)
+                worker.setDaemon(True)
+                worker.start()
+                workers.append(worker)
+            
+            finished = 0
+            while state['feeding'] or finished < state['submitted']:
+                try:
+                    (row_output, row_errors, failure) = finished_rows.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                finished += 1
+                out.stream.write(row_output)
+                err.stream.write(row_errors)
+                if failure and not state['failure']:
+                    state['failure'] = failure
+            for worker in workers:
+                rows_to_run.put(None)
+        finally:
+            sys.stdout = out.stream
+            sys.stderr = err.stream
+        
+        if state['failure']:
+            (error_type, error, error_traceback) = state['failure']
+            raise error_type, error, error_traceback
+        return finished
+
+class AsyncExecutor(BatchExecutor):
+    """Runs rows of commands on gevent greenlets instead of threads, so hundreds of rows can be in flight at once.
+    
+    gevent's monkey patching makes the sockets (and so gdata's HTTP requests) non-blocking and the
+    threads of BatchExecutor cheap greenlets on one event loop. Commands go through the same execute()
+    and whitelist_functions as the other engines, so any command line runs the same way on either.
+    Patching is process-wide and cannot be undone, so this engine is meant for gas command line runs."""
+    def run(self, rows):
+        """Runs every row, and returns the number of rows run."""
+        try:
+            import gevent.monkey
+        except ImportError:
+            if self.journal:
+                self.journal.close()
+            raise Exception('The async engine needs gevent (http://www.gevent.org/). Please install it, or use --engine=threads.')
+        gevent.monkey.patch_all()
+        if profiler:
+            profiler.share() # the greenlets all run on this thread
+        return BatchExecutor.run(self, rows)
+
+# The engines selectable with --engine on the command line.
+executors = {
+    'threads': BatchExecutor,
+    'async': AsyncExecutor,
+    }
+
+## DAEMON ##
+
+class ConnectionOutput(ThreadOutput):
+    """A sys.stdout (or sys.stderr) replacement that sends what each daemon thread writes to its client.
+    
+    Writes from any other thread go straight to the wrapped stream."""
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name # 'stdout' or 'stderr', the key the client looks for
+        self.local = threading.local()
+    
+    def start_connection(self, connection):
+        """Sends the current thread's output to the connection's client."""
+        self.local.connection = connection
+    
+    def finish_connection(self):
+        """Stops sending the current thread's output to a client."""
+        self.local.connection = None
+    
+    def write(self, text):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            self.stream.write(text)
+        else:
+            connection.send_message({self.name: str(text).decode('utf-8', 'replace')})
+    
+    def flush(self):
+        pass
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """Runs one command sent by gas_client, streaming its output back as JSON lines."""
+    def send_message(self, message):
+        self.wfile.write(json.dumps(message) + '\n')
+        self.wfile.flush()
+    
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        args = [arg.encode('utf-8') for arg in json.loads(line)['args']]
+        sys.stdout.start_connection(self)
+        sys.stderr.start_connection(self)
+        status = 0
+        try:
+            try:
+                execute(args)
+            except Exception:
+                # the same traceback the command would have printed if it had been run by itself
+                traceback.print_exc(file=sys.stderr)
+                status = 1
+        finally:
+            sys.stdout.finish_connection()
+            sys.stderr.finish_connection()
+        try:
+            self.send_message({'exit': status})
+        except socket.error:
+            pass # the client went away
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """A long-lived GAS process that runs the commands gas_client sends it over a Unix domain socket.
+    
+    Every command shares gas.session and the service pool, so clients neither import gdata
+    nor log in; the daemon logs in once, with the saved login, when it starts."""
+    daemon_threads = True
+    
+    def __init__(self, path):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise Exception('The GAS daemon needs Unix domain sockets, which this system does not have.')
+        if gas_client.daemon_running(path):
+            raise Exception('A GAS daemon is already listening on %s.' % path)
+        if os.path.exists(path):
+            os.remove(path) # left behind by a daemon that did not stop cleanly
+        SocketServer.UnixStreamServer.__init__(self, path, DaemonRequestHandler)
+        os.chmod(path, 0600) # only this user may run commands with this user's login
+        self.path = path
+    
+    def serve(self):
+        """Serves clients until interrupted."""
+        try:
+            credential = session.get_credential()
+            for get_service_object in (credential.get_email_settings_object, credential.get_organization_object,
+                                       credential.get_groups_object):
+                get_service_object()
+        except Exception, e:
+            sys.stderr.write('Not logged in yet (%s). Run gas log_in to log the daemon in.\n' % e)
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = ConnectionOutput(old_stdout, 'stdout')
+        sys.stderr = ConnectionOutput(old_stderr, 'stderr')
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: exit(0)) # so kill cleans up too
+        try:
+            try:
+                self.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            self.server_close()
+            os.remove(self.path)
+            close_directory_cache()
+            connection_pool.close()
+
+def serve(args):
+    """Runs the GAS daemon, e.g. gas serve [--socket PATH] [--max-age SECONDS] [--pool-size CONNECTIONS] [--max-rate REQUESTS]."""
+    (options, args) = getopt.getopt(args, '', ['socket=', 'max-age=', 'pool-size=', 'max-rate='])
+    options = dict(options)
+    path = options.get('--socket') or gas_client.socket_path()
+    if '--pool-size' in options:
+        connection_pool.size = int(options['--pool-size'])
+    if '--max-rate' in options:
+        set_max_rate(float(options['--max-rate']))
+    if '--max-age' in options:
+        open_directory_cache(float(options['--max-age'])) # kept in memory, and saved when the daemon stops
+    daemon = Daemon(path)
+    sys.stderr.write('GAS daemon listening on %s. Press Ctrl-C to stop.\n' % path)
+    daemon.serve()
+
+## DESIRED STATE SYNC ##
+
+# The desired-state files gas sync understands, by the columns their header row must have (tried in order):
+#   users          user_name[,first_name,last_name,password,admin,suspended,ip_whitelisted,change_password]
+#   memberships    group,member[,role]  (role is member, the default, or owner)
+#   org_placement  user_name,org
+#   nicknames      nickname,user_name
+SYNC_KINDS = [('memberships', ['group', 'member']), ('nicknames', ['nickname', 'user_name']),
+              ('org_placement', ['user_name', 'org']), ('users', ['user_name'])]
+
+# The directory cache kinds each desired-state kind is compared with.
+SYNC_SNAPSHOTS = {'users': ['users'], 'memberships': ['members', 'owners'], 'org_placement': ['org_users'],
+                  'nicknames': ['nicknames']}
+
+# The user properties a users file may set, and which of them are true/false.
+USER_SYNC_COLUMNS = ['first_name', 'last_name', 'admin', 'suspended', 'ip_whitelisted', 'change_password']
+USER_SYNC_FLAGS = ['admin', 'suspended', 'ip_whitelisted', 'change_password']
+
+# How many users one add_users_to_org call moves.
+ORG_MOVE_BATCH = 25
+
+class SyncPlan:
+    """The commands that make the domain match a desired-state file, as rows of one or two commands (argument lists)."""
+    def __init__(self, kind):
+        self.kind = kind
+        self.rows = []
+        self.counts = {'create': 0, 'update': 0, 'delete': 0, 'unchanged': 0}
+        self.warnings = []
+    
+    def add(self, action, *commands):
+        """Adds a row of commands that carry out action (create, update or delete) for one entry."""
+        self.rows.append(list(commands))
+        self.counts[action] += 1
+    
+    def unchanged(self):
+        self.counts['unchanged'] += 1
+    
+    def warn(self, message):
+        self.warnings.append(message)
+    
+    def write(self, stream):
+        """Writes the plan to stream: a summary, then every command."""
+        stream.write('Plan (%s): %d to create, %d to update, %d to delete, %d unchanged\n' % (
+            self.kind, self.counts['create'], self.counts['update'], self.counts['delete'], self.counts['unchanged']))
+        for warning in self.warnings:
+            stream.write('Warning: %s\n' % warning)
+        for row in self.rows:
+            for command in row:
+                stream.write('  %s\n' % redact_command(command))
+    
+    def entries(self):
+        """Returns the rows as template entries for the templates ['{1}', '{2}']."""
+        return [[command_text(command) for command in row] + [''] * (2 - len(row)) for row in self.rows]
+
+def read_desired_state(path):
+    """Reads a desired-state CSV file. Returns its kind (see SYNC_KINDS) and its rows, as dicts by column name.
+    
+    Every row is checked before anything is planned; the problems of all of them are reported together, by line."""
+    desired_file = open(path, 'rb')
+    try:
+        reader = csv.reader(desired_file)
+        header = None
+        rows = []
+        problems = []
+        for entry in reader:
+            if not entry:
+                continue
+            if header is None:
+                header = [column.strip().lower() for column in entry]
+                for (kind, columns) in SYNC_KINDS:
+                    if not [column for column in columns if column not in header]:
+                        break
+                else:
+                    raise Exception('The header row of %s must name the columns of a users, memberships, org_placement or '
+                                    'nicknames file (e.g. user_name,first_name,last_name or group,member,role).' % path)
+                continue
+            row = dict(zip(header, [column.strip() for column in entry]))
+            problems.extend(['line %d: %s' % (reader.line_num, problem) for problem in desired_row_problems(kind, row)])
+            rows.append(row)
+    except csv.Error, e:
+        raise Exception('%s, line %d: %s' % (path, reader.line_num, e))
+    finally:
+        desired_file.close()
+    if header is None:
+        raise Exception('%s is empty.' % path)
+    if problems:
+        raise Exception('%s has problems, so nothing was planned:\n  %s' % (path, '\n  '.join(problems)))
+    return (kind, rows)
+
+def desired_row_problems(kind, row):
+    """Returns a list of what is wrong with a row of a desired-state file of kind (empty if nothing is)."""
+    problems = []
+    for column in dict(SYNC_KINDS)[kind]:
+        if not row.get(column):
+            problems.append('%s is missing' % column)
+    if kind == 'users':
+        for column in USER_SYNC_FLAGS:
+            if row.get(column) and row[column].lower() not in ('true', 'on', 'false', 'off'):
+                problems.append('%s must be true or false, not %s' % (column, row[column]))
+    return problems
+
+def plan_users(credential, rows, snapshot, delete):
+    """Plans the create_user and update_user (and, with delete, delete_user) commands for a users file."""
+    plan = SyncPlan('users')
+    current_users = snapshot['users']
+    wanted = set()
+    for row in rows:
+        key = user_key(credential, row['user_name'])
+        wanted.add(key)
+        current = current_users.get(key)
+        if current is None:
+            missing = [column for column in ('first_name', 'last_name', 'password') if not row.get(column)]
+            if missing:
+                plan.warn('%s does not exist, and cannot be created without %s.' % (row['user_name'], ', '.join(missing)))
+                continue
+            create = ['create_user', 'user_name='+row['user_name'], 'first_name='+row['first_name'],
+                      'last_name='+row['last_name'], 'password='+row['password']]
+            update = ['update_user', 'user_name='+row['user_name']]
+            for column in ('suspended', 'change_password'):
+                if row.get(column):
+                    create.append('%s=%s' % (column, row[column]))
+            for column in ('admin', 'ip_whitelisted'):
+                if row.get(column):
+                    update.append('%s=%s' % (column, row[column]))
+            if len(update) > 2:
+                plan.add('create', create, update) # create_user can't set these
+            else:
+                plan.add('create', create)
+            continue
+        update = ['update_user', 'user_name='+row['user_name']]
+        for column in USER_SYNC_COLUMNS:
+            value = row.get(column)
+            if not value:
+                continue
+            if column in USER_SYNC_FLAGS:
+                changed = flag_text(value) != flag_text(current[column]) # an unset flag (None) is false
+            else:
+                changed = value != current[column]
+            if changed:
+                update.append('%s=%s' % (column, value))
+        if len(update) > 2:
+            plan.add('update', update)
+        else:
+            plan.unchanged()
+    if delete:
+        logged_in_user = credential.get_email().lower()
+        for key in sorted(current_users):
+            if key not in wanted and key != logged_in_user:
+                plan.add('delete', ['delete_user', 'user_name='+key])
+    return plan
+
+def plan_memberships(credential, rows, snapshot, delete):
+    """Plans the add_member_to_group and add_owner_to_group (and, with delete, remove_..._from_group) commands for a memberships file.
+    
+    With delete, the groups the file names are left with exactly the members and owners it lists."""
+    plan = SyncPlan('memberships')
+    wanted = {}
+    for row in rows:
+        role = (row.get('role') or 'member').lower()
+        if role not in ('member', 'owner'):
+            plan.warn('Unknown role %s for %s in %s; use member or owner.' % (role, row['member'], row['group']))
+            continue
+        group = group_key(credential, row['group'])
+        wanted.setdefault((group, role+'s'), set()).add(user_key(credential, row['member']))
+    for ((group, kind), addresses) in sorted(wanted.items()):
+        if group not in snapshot[kind]:
+            plan.warn('Group %s does not exist.' % group)
+            continue
+        role = kind[:-1]
+        current = set([(member.get('memberId') or member.get('email') or '').lower() for member in snapshot[kind][group][kind]])
+        for address in sorted(addresses):
+            if address in current:
+                plan.unchanged()
+            else:
+                plan.add('create', ['add_%s_to_group' % role, 'user='+address, 'id='+group])
+        if delete:
+            for address in sorted(current - addresses):
+                plan.add('delete', ['remove_%s_from_group' % role, 'user='+address, 'id='+group])
+    return plan
+
+def plan_org_placement(credential, rows, snapshot, delete):
+    """Plans the add_users_to_org commands for an org_placement file, moving up to ORG_MOVE_BATCH users per command."""
+    plan = SyncPlan('org_placement')
+    moves = {}
+    for row in rows:
+        key = user_key(credential, row['user_name'])
+        org = org_key(credential, row['org'])
+        current = snapshot['org_users'].get(key)
+        if current is None:
+            plan.warn('%s does not exist.' % row['user_name'])
+        elif current['orgUnitPath'] == org:
+            plan.unchanged()
+        else:
+            moves.setdefault(org, []).append(key)
+    for (org, users) in sorted(moves.items()):
+        for start in range(0, len(users), ORG_MOVE_BATCH):
+            plan.add('update', ['add_users_to_org', 'name='+(org or '/'), 'users_to_move='+' '.join(users[start:start+ORG_MOVE_BATCH])])
+    return plan
+
+def plan_nicknames(credential, rows, snapshot, delete):
+    """Plans the create_nickname and delete_nickname commands for a nicknames file.
+    
+    A nickname that belongs to another user than the file says is not moved, since that takes deleting it
+    first, and a failed create would then lose it; the conflict is reported instead. With delete, the users
+    the file names are left with exactly the nicknames it lists."""
+    plan = SyncPlan('nicknames')
+    current_nicknames = snapshot['nicknames']
+    wanted = set()
+    users = set()
+    for row in rows:
+        key = user_key(credential, row['nickname'])
+        user = user_key(credential, row['user_name'])
+        wanted.add(key)
+        users.add(user)
+        current = current_nicknames.get(key)
+        create = ['create_nickname', 'nickname='+row['nickname'], 'user_name='+row['user_name']]
+        if current is None:
+            plan.add('create', create)
+        elif user_key(credential, current['user_name']) == user:
+            plan.unchanged()
+        else:
+            plan.warn('Nickname %s belongs to %s, not %s. Delete it with delete_nickname before syncing to move it.' % (
+                row['nickname'], current['user_name'], row['user_name']))
+    if delete:
+        for (key, current) in sorted(current_nicknames.items()):
+            if key not in wanted and user_key(credential, current['user_name']) in users:
+                plan.add('delete', ['delete_nickname', 'nickname='+key.split('@')[0]])
+    return plan
+
+sync_planners = {'users': plan_users, 'memberships': plan_memberships, 'org_placement': plan_org_placement,
+                 'nicknames': plan_nicknames}
+
+def plan_sync(credential, path, max_age=0, delete=False):
+    """Compares the desired-state file at path with a snapshot of the domain, at most max_age seconds old, and returns the SyncPlan."""
+    (kind, rows) = read_desired_state(path)
+    load_command_apis('update_directory_cache')
+    update_directory_cache(credential, ','.join(SYNC_SNAPSHOTS[kind]), str(max_age))
+    snapshot = {}
+    for snapshot_kind in SYNC_SNAPSHOTS[kind]:
+        snapshot[snapshot_kind] = directory_cache.entries(snapshot_kind, float('inf'))
+    return sync_planners[kind](credential, rows, snapshot, delete)
+
+def run_sync(options, args):
+    """Runs gas sync: shows the plan for a desired-state file, and with --apply carries it out as a batch."""
+    if len(args) != 1:
+        raise Exception('gas sync takes one desired-state CSV file, e.g. gas sync --apply users.csv')
+    credential = session.get_credential()
+    plan = plan_sync(credential, args[0], float(options.get('--max-age', 0)), '--delete' in options)
+    plan.write(sys.stdout)
+    if '--apply' not in options:
+        sys.stderr.write('Nothing was changed. Run gas sync --apply to carry out this plan.\n')
+        return
+    if not plan.rows:
+        return
+    # The plan runs like any batch, so it can use --workers and --engine, and be resumed with --resume.
+    templates = ['{1}', '{2}']
+    entries = plan.entries()
+    journal_path = options.get('--journal') or new_journal_path()
+    # a resumed sync plans again from the file, so the journal needn't keep the commands and their passwords
+    journal = RunJournal(journal_path, {'templates': templates, 'sync': os.path.abspath(args[0]), 'delete': '--delete' in options})
+    sys.stderr.write('Recording this run in %s\n' % journal_path)
+    run_batch(options, templates, entries, journal)
+
 ## MAIN ##
+def split_template_args(args):
+    """Turns the command line arguments after the options into a list of command templates, split at ';'."""
+    if len(args)==1:
+        return args[0].split(';') # the whole template was given as one quoted argument
+    templates = [[]]
+    for arg in args:
+        if arg==';':
+            templates.append([])
+        else:
+            templates[-1].append(pipes.quote(arg))
+    return [' '.join(template) for template in templates]
+
+def run_batch(options, templates, entries, journal):
+    """Runs the command templates for every entry, with the engine and workers given in the command line options."""
+    # The entries are read, expanded and run one at a time, so the size of the input doesn't matter.
+    rows = iter_cmd_template_rows(templates, entries)
+    engine = options.get('--engine', 'threads')
+    if engine not in executors:
+        journal.close()
+        raise Exception('Unknown engine %s. Use one of: %s' % (engine, ', '.join(sorted(executors.keys()))))
+    executors[engine](workers=options.get('--workers', 1), journal=journal).run(rows)
+
 def __main__():
+    global skip_unchanged_writes
     args = sys.argv
     if len(args)<=1:
         raise Exception('Must provide at least one argument.')
-    execute(args[1:])
+    if args[1]=='serve':
+        serve(args[2:])
+        return
+    if args[1]=='sync':
+        # gas sync [--apply] [--delete] [options] FILE makes the domain match a desired-state file
+        args = [args[0], '--sync'] + args[2:]
+    if not args[1].startswith('--'):
+        # A single command is run by the daemon, if one is running.
+        status = gas_client.forward(args[1:])
+        if status is not None:
+            exit(status)
+    (options, args) = getopt.getopt(args[1:], '', ['workers=', 'input=', 'engine=', 'journal=', 'resume=',
+                                                    'metrics=', 'metrics-interval=', 'trace=', 'profile', 'all-users',
+                                                    'max-age=', 'sync', 'apply', 'delete', 'always-write', 'pool-size=',
+                                                    'max-rate='])
+    options = dict(options)
+    metrics_writer = None
+    if '--metrics' in options:
+        # Write the run's metrics when it ends (and every --metrics-interval seconds during it), e.g.
+        #   gas --metrics gas_metrics.prom --metrics-interval 10 --input users.csv ...
+        # A file name ending in .json gets a JSON snapshot instead of Prometheus text.
+        metrics_writer = MetricsWriter(options['--metrics'], float(options.get('--metrics-interval', 0)) or None)
+    if '--trace' in options:
+        # Append one JSON line per command and per API request to a trace log, e.g. --trace gas_trace.jsonl
+        start_trace(options['--trace'])
+    if '--pool-size' in options:
+        # Keep up to this many idle connections open to each API host, e.g. as many as --workers
+        connection_pool.size = int(options['--pool-size'])
+    if '--max-rate' in options:
+        # Allow this many requests per second to each API, instead of API_RATE_LIMITS, e.g. to let many
+        # --workers run at once when the domain's quota allows it
+        set_max_rate(float(options['--max-rate']))
+    if '--always-write' in options:
+        # Write every update, without first checking whether it would change anything
+        skip_unchanged_writes = False
+    if '--max-age' in options:
+        # Let read_user, read_group, list_group_members and read_org read entries of the directory cache
+        # (see update_directory_cache) fetched at most this many seconds ago, instead of asking the API.
+        open_directory_cache(float(options['--max-age']))
+    if '--profile' in options:
+        # Profile the run, and write gas_profile_<time>.pstats and a report split by phase, gas_profile_<time>.txt
+        profile_path = path_for_gas_file('gas_profile_%s' % time.strftime('%Y%m%d%H%M%S'))
+        start_profile()
+    try:
+        run_options(options, args)
+    finally:
+        if '--profile' in options:
+            stop_profile(profile_path)
+            sys.stderr.write('Profile written to %s.pstats, report in %s.txt\n' % (profile_path, profile_path))
+        stop_trace()
+        close_directory_cache()
+        if metrics_writer:
+            metrics_writer.stop()
+
+def run_options(options, args):
+    """Runs what the command line options and arguments ask for."""
+    if '--sync' in options:
+        run_sync(options, args)
+        return
+    if '--resume' in options:
+        # Run the template of a journaled run again, skipping the commands that already succeeded, e.g.
+        #   gas --resume gas_journal_20111024093000.jsonl --workers 8
+        journal = RunJournal(options['--resume'])
+        if not journal.header:
+            journal.close()
+            raise Exception('%s is not a GAS run journal.' % options['--resume'])
+        sys.stderr.write('Resuming the run in %s\n' % options['--resume'])
+        run_batch(options, journal.header['templates'], journal.entries(), journal)
+        return
+    if '--input' not in options and '--all-users' not in options:
+        try:
+            profile_call(execute, args)
+        finally:
+            retry_stats.report()
+            skip_stats.report()
+        return
+    
+    # Run the command template once for every line of the input CSV file, e.g.
+    #   gas --input users.csv --workers 8 update_signature user_name={1} "signature={2}"
+    # --engine=async runs the rows on greenlets, for far more workers than threads allow.
+    # Every finished command is recorded in a journal, so that the run can be resumed with --resume.
+    # --all-users runs it for every user of the domain instead, with {1} the user's email address and
+    # {2} their organization unit, listing the users a page at a time as the run needs them.
+    templates = split_template_args(args)
+    if '--all-users' in options:
+        header = {'templates': templates, 'all_users': True}
+        entries = user_entries(session.get_credential())
+    else:
+        input_path = os.path.abspath(options['--input'])
+        header = {'templates': templates, 'input': input_path}
+        entries = read_template_entries(input_path)
+    journal_path = options.get('--journal') or new_journal_path()
+    journal = RunJournal(journal_path, header)
+    sys.stderr.write('Recording this run in %s\n' % journal_path)
+    run_batch(options, templates, entries, journal)
 
 if __name__ == '__main__':
     __main__()
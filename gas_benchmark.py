@@ -0,0 +1,283 @@
+#!/usr/bin/python
+#
+# gas_benchmark.py
+#
+# Benchmarks for GAS, so that changes to its speed can be measured and tracked.
+# Results are printed, and appended as JSON lines to a results file, so that runs
+# from different versions can be compared.
+#
+# usage:
+#   python gas_benchmark.py startup [--repeat N] [--output FILE] [command ...]
+#     Measures the cold start of each command (by default every command): starting
+#     Python, importing gas and importing the gdata modules the command uses.
+#     Nothing is sent to Google.
+#
+#   python gas_benchmark.py workloads [--size 1000] [--listing-users 100000] [--latency 0.05]
+#                                     [--workers 20] [--async-workers 200] [--modes sequential,threaded,async]
+#                                     [--rate-limit N] [--output FILE] [workload ...]
+#     Runs typical admin workloads (by default all of them) against gas_fake_server.py, once for each
+#     execution mode, and reports throughput, p50/p95/p99 command latency, API calls per command and
+#     peak memory. Each run gets a fresh fake server and its own process. Nothing is sent to Google.
+#     GAS's own rate limits (gas.API_RATE_LIMITS) apply, unless --rate-limit sets another
+#     (requests per second for every API), e.g. to measure what the engines could do without them.
+#
+
+__version__ = '1.1.7'
+
+import sys, os, time, json, getopt, subprocess, shutil, tempfile, urllib2
+
+import gas
+
+GAS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def median(values):
+    values = sorted(values)
+    middle = len(values)//2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1]+values[middle])/2.0
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(percent/100.0*len(values)))-1)]
+
+def write_results(path, benchmark, options, results):
+    """Appends the results of a benchmark to the results file."""
+    record = {'benchmark': benchmark, 'version': gas.__version__, 'time': time.asctime(),
+              'python': sys.version.split()[0], 'options': options, 'results': results}
+    results_file = open(path, 'a')
+    try:
+        results_file.write(json.dumps(record)+'\n')
+    finally:
+        results_file.close()
+
+## STARTUP ##
+
+# Run in a fresh interpreter for each measurement, so that nothing is imported yet.
+STARTUP_SCRIPT = """
+import time, json, sys
+started = time.time()
+import gas
+imported = time.time()
+gas.load_command_apis(sys.argv[1])
+loaded = time.time()
+print json.dumps({'import_gas': imported-started, 'load_apis': loaded-imported})
+"""
+
+def measure_startup(command):
+    """Returns the times, in seconds, of one cold start of command."""
+    started = time.time()
+    output = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, command], cwd=GAS_DIRECTORY,
+                              stdout=subprocess.PIPE).communicate()[0]
+    times = json.loads(output.strip().splitlines()[-1])
+    times['process'] = time.time()-started
+    return times
+
+def startup(options, commands):
+    """Returns the median cold start times of each command, as a dictionary of command to times."""
+    commands = commands or sorted(gas.whitelist_functions.keys())+['print_authentication']
+    for command in commands:
+        if command not in gas.whitelist_functions and command != 'print_authentication':
+            raise Exception('Unknown function '+command)
+    repeat = int(options.get('--repeat', 5))
+    results = {}
+    for command in commands:
+        samples = [measure_startup(command) for i in range(repeat)]
+        results[command] = dict((name, median([sample[name] for sample in samples])) for name in samples[0])
+    return results
+
+def print_startup(results):
+    print '%-28s %10s %10s %10s' % ('command', 'process', 'import gas', 'load apis')
+    for command in sorted(results):
+        times = results[command]
+        print '%-28s %8.1fms %8.1fms %8.1fms' % (command, times['process']*1000, times['import_gas']*1000, times['load_apis']*1000)
+
+## WORKLOADS ##
+
+# Each workload is the commands of one batch run: the template, the rows it is run for
+# (given the --size and --listing-users options), and what the fake domain holds beforehand.
+workloads = {
+    'create_user': {
+        'templates': ['create_user user_name=bench{1} first_name=Bench last_name={1} password=Benchmark1'],
+        'rows': lambda size, listing_users: [['%06d' % i] for i in range(size)],
+        'users': lambda size, listing_users: 0,
+        'groups': 0},
+    'update_signature': {
+        'templates': ['update_signature user_name={1} "signature=Sent from {1} at Example Inc."'],
+        'rows': lambda size, listing_users: [['user%05d' % (i+1)] for i in range(size)],
+        'users': lambda size, listing_users: size,
+        'groups': 0},
+    'delete_user': { # delete_user renames the user first, then deletes the renamed user
+        'templates': ['delete_user user_name={1}'],
+        'rows': lambda size, listing_users: [['user%05d' % (i+1)] for i in range(size)],
+        'users': lambda size, listing_users: size,
+        'groups': 0},
+    'print_users': {
+        'templates': ['print_users'],
+        'rows': lambda size, listing_users: [[]],
+        'users': lambda size, listing_users: listing_users,
+        'groups': 0},
+    'add_member_to_group': { # every user is added to each of 10 groups
+        'templates': ['add_member_to_group id=group%04d@example.com user={1}@example.com' % (group+1) for group in range(10)],
+        'rows': lambda size, listing_users: [['user%05d' % (i+1)] for i in range(max(1, size//10))],
+        'users': lambda size, listing_users: max(1, size//10),
+        'groups': 10}
+    }
+
+# How each mode runs the batch: (engine, the option giving its number of workers).
+modes = {
+    'sequential': ('threads', None),
+    'threaded': ('threads', '--workers'),
+    'async': ('async', '--async-workers')
+    }
+
+# Run in its own process for each workload and mode, so that peak memory (and gevent's
+# patching) belongs to that run alone. It logs in to the fake server, runs the rows, and
+# prints the per-command latencies and peak memory as JSON.
+WORKLOAD_SCRIPT = """
+import sys, os, time, json, resource
+import gas
+(templates, rows, engine, workers, rate_limit) = json.loads(sys.argv[1])
+if rate_limit:
+    gas.set_max_rate(rate_limit)
+gas.execute(['log_in', 'email=admin@example.com', 'password=password'])
+latencies = []
+executor_class = gas.executors[engine]
+class TimedExecutor(executor_class):
+    def run_command(self, command):
+        started = time.time()
+        try:
+            executor_class.run_command(self, command)
+        finally:
+            latencies.append(time.time()-started)
+sys.stdout = open(os.devnull, 'w')
+error = None
+started = time.time()
+try:
+    TimedExecutor(workers=workers).run(gas.iter_cmd_template_rows(templates, rows))
+except Exception, e:
+    error = str(e)
+seconds = time.time()-started
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform != 'darwin':
+    peak_rss *= 1024 # ru_maxrss is in kilobytes, except on Mac
+sys.stdout = sys.__stdout__
+print json.dumps({'latencies': latencies, 'seconds': seconds, 'peak_rss': peak_rss, 'error': error})
+"""
+
+FAKE_SERVER_PORT = 8089
+
+def start_fake_server(port, users, groups, latency):
+    """Starts gas_fake_server.py in its own process, and returns the process once it answers."""
+    server = subprocess.Popen([sys.executable, os.path.join(GAS_DIRECTORY, 'gas_fake_server.py'), '--port', str(port),
+                               '--users', str(users), '--groups', str(groups), '--latency', str(latency)],
+                              stdout=open(os.devnull, 'w'))
+    for i in range(600):
+        try:
+            urllib2.urlopen('http://localhost:%d/fake/stats' % port).read()
+            return server
+        except urllib2.URLError:
+            if server.poll() is not None:
+                raise Exception('The fake server could not start on port %d.' % port)
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('The fake server did not start on port %d.' % port)
+
+def fake_server_calls(port):
+    """Returns the number of API calls the fake server has answered, not counting logins."""
+    stats = json.loads(urllib2.urlopen('http://localhost:%d/fake/stats' % port).read())
+    return sum([count for (name, count) in stats.items() if name not in ('client_login', 'error', 'quota_error')])
+
+def run_workload(workload_name, mode, options):
+    """Runs a workload in one mode, and returns its measurements."""
+    workload = workloads[workload_name]
+    size = int(options.get('--size', 1000))
+    listing_users = int(options.get('--listing-users', 100000))
+    (engine, workers_option) = modes[mode]
+    workers = workers_option and int(options.get(workers_option, {'--workers': 20, '--async-workers': 200}[workers_option])) or 1
+    port = int(options.get('--port', FAKE_SERVER_PORT))
+    rows = workload['rows'](size, listing_users)
+    server = start_fake_server(port, workload['users'](size, listing_users), workload['groups'],
+                               float(options.get('--latency', 0.05)))
+    # Each run logs in from an empty directory, so the fake login never reaches the real credential store.
+    run_directory = tempfile.mkdtemp(prefix='gas_benchmark_')
+    try:
+        environment = dict(os.environ, GAS_API_SERVER='http://localhost:%d' % port,
+                           PYTHONPATH=os.pathsep.join([GAS_DIRECTORY, os.environ.get('PYTHONPATH', '')]))
+        process = subprocess.Popen([sys.executable, '-c', WORKLOAD_SCRIPT, json.dumps([workload['templates'], rows, engine, workers,
+                                                                         float(options.get('--rate-limit', 0))])],
+                                   cwd=run_directory, env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (output, errors) = process.communicate()
+        if process.returncode:
+            return {'error': errors.strip().splitlines()[-1] if errors.strip() else 'exit status %d' % process.returncode}
+        measurements = json.loads(output.strip().splitlines()[-1])
+        api_calls = fake_server_calls(port)
+    finally:
+        server.kill()
+        server.wait()
+        shutil.rmtree(run_directory, True)
+    latencies = measurements['latencies']
+    commands = len(latencies)
+    return {'commands': commands, 'workers': workers, 'seconds': measurements['seconds'],
+            'throughput': commands/measurements['seconds'] if measurements['seconds'] else None,
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+            'api_calls_per_command': float(api_calls)/commands if commands else None,
+            'peak_rss': measurements['peak_rss'], 'error': measurements['error']}
+
+def workloads_benchmark(options, names):
+    """Returns the measurements of each workload in each mode, as a dictionary of 'workload mode' to measurements."""
+    names = names or sorted(workloads.keys())
+    for name in names:
+        if name not in workloads:
+            raise Exception('Unknown workload %s. Use some of: %s' % (name, ', '.join(sorted(workloads.keys()))))
+    mode_names = options.get('--modes', 'sequential,threaded,async').split(',')
+    for mode in mode_names:
+        if mode not in modes:
+            raise Exception('Unknown mode %s. Use some of: %s' % (mode, ', '.join(sorted(modes.keys()))))
+    results = {}
+    for name in names:
+        for mode in mode_names:
+            sys.stderr.write('Running %s (%s)\n' % (name, mode))
+            results['%s %s' % (name, mode)] = run_workload(name, mode, options)
+    return results
+
+def print_workloads(results):
+    print '%-32s %8s %9s %8s %8s %8s %10s %9s' % ('workload', 'commands', 'per sec', 'p50', 'p95', 'p99', 'calls/cmd', 'peak MB')
+    for name in sorted(results):
+        result = results[name]
+        if result.get('commands') is None:
+            print '%-32s failed: %s' % (name, result['error'])
+            continue
+        print '%-32s %8d %9.1f %6.0fms %6.0fms %6.0fms %10.2f %9.1f' % (
+            name, result['commands'], result['throughput'] or 0, (result['p50'] or 0)*1000, (result['p95'] or 0)*1000,
+            (result['p99'] or 0)*1000, result['api_calls_per_command'] or 0, result['peak_rss']/1048576.0)
+        if result['error']:
+            print '%-32s stopped early: %s' % ('', result['error'])
+
+# benchmark name -> (its options, the function running it, the function printing its results)
+benchmarks = {
+    'startup': (['repeat='], startup, print_startup),
+    'workloads': (['size=', 'listing-users=', 'latency=', 'workers=', 'async-workers=', 'modes=', 'port=',
+                   'rate-limit='],
+                  workloads_benchmark, print_workloads)
+    }
+
+def __main__():
+    args = sys.argv[1:]
+    if not args or args[0] not in benchmarks:
+        raise Exception('Usage: python gas_benchmark.py %s [options]' % '|'.join(sorted(benchmarks.keys())))
+    benchmark = args[0]
+    (option_names, run, report) = benchmarks[benchmark]
+    (options, args) = getopt.gnu_getopt(args[1:], '', option_names + ['output='])
+    options = dict(options)
+    output_path = options.pop('--output', os.path.join(GAS_DIRECTORY, 'gas_benchmark_results.jsonl'))
+    results = run(options, args)
+    report(results)
+    write_results(output_path, benchmark, options, results)
+    print 'Results appended to %s' % output_path
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# gas_client.py
+#
+# A thin client for a running GAS daemon (started with "python gas.py serve").
+# It takes the same arguments as gas.py, but sends them to the daemon, which is
+# already logged in and has its services ready, and prints what the daemon sends back.
+# If no daemon is running, the command is run by gas.py in this process instead.
+#
+# This file deliberately imports nothing from gas or gdata, so that it starts quickly.
+#
+
+__version__ = '1.1.7'
+
+import sys, os, socket, json
+
+DAEMON_SOCKET_NAME = 'gas_daemon.sock'
+
+def socket_path():
+    """Returns the path of the daemon's socket, in the directory GAS is run from."""
+    return os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), DAEMON_SOCKET_NAME)
+
+def connect(path=None):
+    """Returns a socket connected to the daemon, or None if no daemon is listening."""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None # no Unix domain sockets on Windows
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+def daemon_running(path=None):
+    """Returns whether a daemon is listening on the socket."""
+    connection = connect(path)
+    if connection:
+        connection.close()
+        return True
+    return False
+
+def forward(args, path=None, connection=None):
+    """Runs the argument list for execute() on the daemon, writing its output to stdout and stderr.
+
+    Returns the exit status for the command, or None if no daemon is running."""
+    connection = connection or connect(path)
+    if not connection:
+        return None
+    try:
+        connection.sendall(json.dumps({'args': args}) + '\n')
+        responses = connection.makefile('r')
+        for line in responses:
+            # each line is one message: {"stdout": text}, {"stderr": text}, or finally {"exit": status}
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'].encode('utf-8'))
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'].encode('utf-8'))
+            elif 'exit' in message:
+                return message['exit']
+        sys.stderr.write('The GAS daemon closed the connection before the command finished.\n')
+        return 1
+    finally:
+        connection.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    status = None
+    if args and args[0] != 'serve' and not args[0].startswith('--'):
+        status = forward(args)
+    if status is None:
+        import gas # no daemon, or not a single command: run it here
+        gas.__main__()
+        status = 0
+    sys.exit(status)
@@ -116,6 +116,10 @@ Restores a user (from a suspended user state).
     'usage': 'gas print_users',
     'description': """
 Prints the full email address of all users in the Google Apps account.
+Users are printed a page at a time as the pages arrive, so large domains start
+printing at once. The users of each organization unit are listed separately,
+several units at a time, so they are printed unit by unit rather than in
+alphabetical order. To run a command for every user, use gas --all-users.
 """,
     'examples': [
       ('gas print_users',
@@ -123,6 +127,23 @@ Prints the full email address of all users in the Google Apps account.
       ]
   },
   
+  'update_directory_cache': {
+    'title': 'Update the Directory Cache',
+    'category': 'Directory Cache',
+    'usage': 'gas update_directory_cache [kinds=users,nicknames,groups,members,owners,orgs,org_users] [max_age=<seconds>]',
+    'description': """
+Fetches the domain's users, nicknames, groups, group members and owners, organization units and the organization unit of every user into gas_directory.json.
+Optional parameter kinds fetches only some of them. Optional parameter max_age skips the kinds that were fetched less than max_age seconds ago, so running it regularly only fetches what has gone stale.
+Commands given the --max-age option (e.g. gas --max-age 3600 read_user user_name=monkey) then read users, groups, group members and organization units from the cache instead of the API, as long as the cached entry is no older than --max-age seconds. Commands that change an entry drop it from the cache, so the next read fetches it again.
+""",
+    'examples': [
+      ('gas update_directory_cache',
+      'This example fetches the whole directory into the cache.'),
+      ('gas update_directory_cache kinds=groups,members max_age=3600',
+      'This example fetches the groups and their members again, unless they were fetched in the last hour.')
+      ]
+  },
+
   'print_authentication': {
     'title': 'Print Authentication',
     'category': 'Authentication',
@@ -475,6 +496,46 @@ Lists all Google Group members of the group. If suspended_users is true, this wi
         ]
   },
 
+  'list_user_groups': {
+      'title': 'List the Groups of a User',
+      'category': 'Groups',
+      'usage': 'gas list_user_groups user_name=<name> [indirect=true]',
+      'description': """
+Lists the groups user_name is a member or owner of, one group,role per line. If indirect is true, this also lists the groups the user belongs to because one of their groups is a member.
+The answer comes from an index of every group's members and owners, built the first time it is needed in one sweep of all groups (or from the directory cache, with --max-age). Later lookups in the same run, or in a GAS daemon, take microseconds.
+""",
+      'examples': [
+        ('gas list_user_groups user_name=picard indirect=true',
+        'This example lists every group picard is in, directly or through other groups.')
+        ]
+  },
+
+  'group_overlap': {
+      'title': 'Compare the Members of Two Groups',
+      'category': 'Groups',
+      'usage': 'gas group_overlap id=<groupid> other_id=<groupid>',
+      'description': """
+Lists the addresses that are members or owners of both groups, and how many members each group has. Like list_user_groups, it answers from the group membership index.
+""",
+      'examples': [
+        ('gas group_overlap id=starship_enterprise other_id=starfleet_command',
+        'This example lists who is in both the starship_enterprise and starfleet_command groups.')
+        ]
+  },
+
+  'sync_group_members': {
+      'title': 'Sync Group Members with a File',
+      'category': 'Groups',
+      'usage': 'gas sync_group_members id=<groupid> members_file=<path> [remove_extra=<true|false>] [workers=<number>]',
+      'description': """
+Makes a group's members and owners those listed in a file, with one address per line, optionally followed by ,owner. The current members and owners are read once, and only the addresses that are missing are added, several at a time (workers, 8 by default), so running it again only sends what changed. With remove_extra=true, members who are not in the file are removed, and so are owners whose address is not in the file at all. The changes that fail are listed at the end, without stopping the others.
+""",
+      'examples': [
+        ('gas sync_group_members id=starship_enterprise members_file=crew.csv remove_extra=true',
+        'This example makes the members of starship_enterprise exactly the addresses listed in crew.csv.')
+        ]
+  },
+
   'list_group_owners': {
       'title': 'List Group Owners',
       'category': 'Groups',
@@ -0,0 +1,664 @@
+#!/usr/bin/python
+#
+# gas_fake_server.py
+#
+# A local stand-in for the Google Apps APIs GAS uses: ClientLogin, and the Provisioning,
+# Email Settings, Groups and Organization feeds. Everything is kept in memory, so GAS can be
+# tested and load tested without a network, and without touching a real domain.
+#
+# usage:
+#   python gas_fake_server.py [--port 8089] [--domain example.com] [--users 0] [--groups 0]
+#                             [--latency 0] [--quota-rate 0] [--max-rate 0] [--page-size 100]
+# and point GAS at it with its one setting:
+#   export GAS_API_SERVER=http://localhost:8089
+#   python gas.py log_in email=admin@example.com password=password
+#
+# --latency adds that many seconds to every response, --quota-rate makes that fraction of requests
+# fail with a 503 quota error, and --max-rate fails every request beyond that many per second.
+# --users and --groups fill the domain with that many users (user00001@...) and groups (group0001@...),
+# every user being a member of one group. GET /fake/stats returns how many requests each endpoint got.
+#
+
+__version__ = '1.1.7'
+
+import sys, re, time, json, random, getopt, threading, bisect, urllib, urlparse, BaseHTTPServer, SocketServer
+import atom
+import gdata
+import gdata.apps
+import gdata.apps.service
+
+DEFAULT_PORT = 8089
+DEFAULT_PAGE_SIZE = 100
+CUSTOMER_ID = 'C00fake00'
+
+class FakeError(Exception):
+    """An error response of the Apps APIs, e.g. EntityDoesNotExist."""
+    def __init__(self, error_code, reason, invalid_input='', status=400):
+        Exception.__init__(self, reason)
+        self.error_code = error_code
+        self.reason = reason
+        self.invalid_input = invalid_input
+        self.status = status
+
+    def body(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<AppsForYourDomainErrors>\n'
+                '  <error errorCode="%d" invalidInput="%s" reason="%s" />\n</AppsForYourDomainErrors>\n'
+                % (self.error_code, self.invalid_input, self.reason))
+
+def does_not_exist(name):
+    return FakeError(gdata.apps.service.ENTITY_DOES_NOT_EXIST, 'EntityDoesNotExist', name)
+
+def already_exists(name):
+    return FakeError(gdata.apps.service.ENTITY_EXISTS, 'EntityExists', name)
+
+def property_entry(properties):
+    """Returns the XML of a PropertyEntry with the properties of a dictionary."""
+    entry = gdata.apps.PropertyEntry()
+    entry.property = [gdata.apps.Property(name=name, value=value) for (name, value) in sorted(properties.items())
+                      if value is not None]
+    return entry
+
+def read_properties(body):
+    """Returns the properties of a PropertyEntry as a dictionary."""
+    entry = gdata.apps.PropertyEntryFromString(body)
+    return dict((p.name, p.value) for p in entry.property)
+
+class FakeDomain:
+    """The in-memory state of the fake domain. Every method is called with the lock held."""
+    def __init__(self, domain, page_size=DEFAULT_PAGE_SIZE):
+        self.domain = domain
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.users = {} # user name -> dictionary of user fields
+        self.passwords = {} # user name -> password
+        self.nicknames = {} # nickname -> user name
+        self.settings = {} # (user name, setting) -> list of property dictionaries
+        self.groups = {} # group id -> dictionary of group properties
+        self.members = {} # group id -> set of member ids
+        self.owners = {} # group id -> set of owner emails
+        self.orgs = {'/': {'name': '/', 'description': '', 'parentOrgUnitPath': '', 'blockInheritance': 'false'}}
+        self.org_users = {} # user email -> org unit path ('/' for the top)
+        self.tokens = set()
+        self.version = 0 # changed by every write, so that sorted listings can be reused until then
+        self.sorted_cache = {}
+
+    def add_user(self, user_name, given_name, family_name, password, admin='false'):
+        self.users[user_name] = {'user_name': user_name, 'given_name': given_name, 'family_name': family_name,
+                                 'suspended': 'false', 'admin': admin, 'change_password': 'false',
+                                 'agreed_to_terms': 'true', 'quota': gdata.apps.service.DEFAULT_QUOTA_LIMIT}
+        self.passwords[user_name] = password
+        self.org_users['%s@%s' % (user_name, self.domain)] = '/'
+
+    def populate(self, users=0, groups=0):
+        """Fills the domain with users and groups, every user being a member of one group."""
+        for i in range(groups):
+            group_id = 'group%04d@%s' % (i+1, self.domain)
+            self.groups[group_id] = {'groupId': group_id, 'groupName': 'Group %d' % (i+1), 'description': '',
+                                     'emailPermission': 'Member'}
+            self.members[group_id] = set()
+            self.owners[group_id] = set()
+        group_ids = sorted(self.groups)
+        for i in range(users):
+            user_name = 'user%05d' % (i+1)
+            self.add_user(user_name, 'User', str(i+1), 'password')
+            if group_ids:
+                self.members[group_ids[i % len(group_ids)]].add('%s@%s' % (user_name, self.domain))
+
+    def user(self, user_name):
+        if user_name not in self.users:
+            raise does_not_exist(user_name)
+        return self.users[user_name]
+
+    def group(self, group_id):
+        if group_id not in self.groups:
+            raise does_not_exist(group_id)
+        return self.groups[group_id]
+
+    def org(self, path):
+        path = '/' + path.strip('/')
+        if path not in self.orgs:
+            raise does_not_exist(path)
+        return path
+
+    def page(self, items, start, cache_key=None):
+        """Returns the items from start (or the first if start is None), and the item that starts the next page.
+        
+        Listings with a cache_key are only sorted once between writes, so paging through many users stays fast."""
+        if cache_key and self.sorted_cache.get(cache_key, (None,))[0] == self.version:
+            items = self.sorted_cache[cache_key][1]
+        else:
+            items = sorted(items)
+            if cache_key:
+                self.sorted_cache[cache_key] = (self.version, items)
+        first = start and bisect.bisect_left(items, start) or 0
+        if len(items) - first > self.page_size:
+            return (items[first:first+self.page_size], items[first+self.page_size])
+        return (items[first:], None)
+
+## XML ##
+
+def user_entry(user):
+    entry = gdata.apps.UserEntry()
+    entry.login = gdata.apps.Login(user_name=user['user_name'], suspended=user['suspended'], admin=user['admin'],
+                                   change_password=user['change_password'], agreed_to_terms=user['agreed_to_terms'])
+    entry.name = gdata.apps.Name(family_name=user['family_name'], given_name=user['given_name'])
+    entry.quota = gdata.apps.Quota(limit=user['quota'])
+    return entry
+
+def nickname_entry(nickname, user_name):
+    entry = gdata.apps.NicknameEntry()
+    entry.login = gdata.apps.Login(user_name=user_name)
+    entry.nickname = gdata.apps.Nickname(name=nickname)
+    return entry
+
+def feed(feed_class, entries, next_url=None):
+    result = feed_class()
+    result.entry = entries
+    if next_url:
+        result.link = [atom.Link(rel='next', href=next_url)]
+    return result
+
+## HANDLERS ##
+# Each handler is called as handler(server, match, query, body) with the domain locked,
+# and returns the response entry or feed (or None for an empty response).
+
+def client_login(server, match, query, body):
+    fields = urlparse.parse_qs(body)
+    email = fields.get('Email', [''])[0]
+    password = fields.get('Passwd', [''])[0]
+    (user_name, domain) = (email.split('@') + [''])[:2]
+    fake_domain = server.fake_domain
+    if domain != fake_domain.domain or fake_domain.passwords.get(user_name) != password:
+        raise FakeError(0, 'BadAuthentication', status=403)
+    token = 'fake-%s-%d' % (user_name, random.randint(0, 2**31))
+    fake_domain.tokens.add(token)
+    return 'SID=%s\nLSID=%s\nAuth=%s\n' % (token, token, token)
+
+def create_user(server, match, query, body):
+    entry = gdata.apps.UserEntryFromString(body)
+    user_name = entry.login.user_name
+    fake_domain = server.fake_domain
+    if user_name in fake_domain.users:
+        raise already_exists(user_name)
+    fake_domain.add_user(user_name, entry.name.given_name, entry.name.family_name, entry.login.password)
+    update_user_fields(fake_domain.users[user_name], entry)
+    return user_entry(fake_domain.users[user_name])
+
+def update_user_fields(user, entry):
+    for field in ('suspended', 'admin', 'change_password', 'agreed_to_terms'):
+        if getattr(entry.login, field, None):
+            user[field] = getattr(entry.login, field)
+    if entry.name:
+        user['given_name'] = entry.name.given_name or user['given_name']
+        user['family_name'] = entry.name.family_name or user['family_name']
+    if entry.quota and entry.quota.limit:
+        user['quota'] = entry.quota.limit
+
+def retrieve_user(server, match, query, body):
+    return user_entry(server.fake_domain.user(match.group('user')))
+
+def update_user(server, match, query, body):
+    fake_domain = server.fake_domain
+    user_name = match.group('user')
+    user = fake_domain.user(user_name)
+    entry = gdata.apps.UserEntryFromString(body)
+    new_user_name = entry.login and entry.login.user_name or user_name
+    if new_user_name != user_name:
+        if new_user_name in fake_domain.users:
+            raise already_exists(new_user_name)
+        fake_domain.users[new_user_name] = fake_domain.users.pop(user_name)
+        fake_domain.passwords[new_user_name] = fake_domain.passwords.pop(user_name)
+        fake_domain.org_users['%s@%s' % (new_user_name, fake_domain.domain)] = fake_domain.org_users.pop(
+            '%s@%s' % (user_name, fake_domain.domain), '/')
+        user['user_name'] = new_user_name
+    if entry.login and entry.login.password:
+        fake_domain.passwords[new_user_name] = entry.login.password
+    update_user_fields(user, entry)
+    return user_entry(user)
+
+def delete_user(server, match, query, body):
+    fake_domain = server.fake_domain
+    user_name = match.group('user')
+    fake_domain.user(user_name)
+    del fake_domain.users[user_name]
+    del fake_domain.passwords[user_name]
+    fake_domain.org_users.pop('%s@%s' % (user_name, fake_domain.domain), None)
+    for (nickname, owner) in fake_domain.nicknames.items():
+        if owner == user_name:
+            del fake_domain.nicknames[nickname]
+
+def retrieve_users(server, match, query, body):
+    fake_domain = server.fake_domain
+    (names, next_name) = fake_domain.page(fake_domain.users.keys(), query.get('startUsername'), 'users')
+    next_url = next_name and server.url(match.group(0) + '?startUsername=' + urllib.quote(next_name))
+    return feed(gdata.apps.UserFeed, [user_entry(fake_domain.users[name]) for name in names], next_url)
+
+def create_nickname(server, match, query, body):
+    entry = gdata.apps.NicknameEntryFromString(body)
+    fake_domain = server.fake_domain
+    fake_domain.user(entry.login.user_name)
+    if entry.nickname.name in fake_domain.nicknames or entry.nickname.name in fake_domain.users:
+        raise already_exists(entry.nickname.name)
+    fake_domain.nicknames[entry.nickname.name] = entry.login.user_name
+    return nickname_entry(entry.nickname.name, entry.login.user_name)
+
+def retrieve_nickname(server, match, query, body):
+    nickname = match.group('nickname')
+    if nickname not in server.fake_domain.nicknames:
+        raise does_not_exist(nickname)
+    return nickname_entry(nickname, server.fake_domain.nicknames[nickname])
+
+def retrieve_nicknames(server, match, query, body):
+    nicknames = server.fake_domain.nicknames
+    user_name = query.get('username')
+    return feed(gdata.apps.NicknameFeed, [nickname_entry(nickname, nicknames[nickname]) for nickname in sorted(nicknames)
+                                          if not user_name or nicknames[nickname] == user_name])
+
+def delete_nickname(server, match, query, body):
+    nickname = match.group('nickname')
+    if nickname not in server.fake_domain.nicknames:
+        raise does_not_exist(nickname)
+    del server.fake_domain.nicknames[nickname]
+
+def update_email_setting(server, match, query, body):
+    fake_domain = server.fake_domain
+    fake_domain.user(match.group('user'))
+    properties = read_properties(body)
+    key = (match.group('user'), match.group('setting'))
+    if match.group('setting') in ('label', 'filter', 'sendas'):
+        fake_domain.settings.setdefault(key, []).append(properties) # created, so there may be several
+    else:
+        fake_domain.settings[key] = [properties] # replaced
+    return property_entry(properties)
+
+# What the single-valued email settings read as before they are first set.
+SETTING_DEFAULTS = {
+    'signature': {'signature': ''},
+    'language': {'language': 'en-US'},
+    'general': {'pageSize': '50', 'shortcuts': 'false', 'arrows': 'true', 'snippets': 'true', 'unicode': 'true'},
+}
+
+def retrieve_email_setting(server, match, query, body):
+    fake_domain = server.fake_domain
+    fake_domain.user(match.group('user'))
+    if match.group('setting') not in ('label', 'filter', 'sendas'):
+        # a setting with a single value is an entry, not a feed, and has its default value until it is set
+        default = [SETTING_DEFAULTS.get(match.group('setting'), {'enable': 'false'})]
+        return property_entry(fake_domain.settings.get((match.group('user'), match.group('setting')), default)[0])
+    settings = fake_domain.settings.get((match.group('user'), match.group('setting')), [{}])
+    return feed(gdata.apps.PropertyFeed, [property_entry(properties) for properties in settings])
+
+def create_group(server, match, query, body):
+    properties = read_properties(body)
+    fake_domain = server.fake_domain
+    group_id = properties['groupId']
+    if group_id in fake_domain.groups:
+        raise already_exists(group_id)
+    fake_domain.groups[group_id] = properties
+    fake_domain.members[group_id] = set()
+    fake_domain.owners[group_id] = set()
+    return property_entry(properties)
+
+def retrieve_group(server, match, query, body):
+    return property_entry(server.fake_domain.group(match.group('group')))
+
+def update_group(server, match, query, body):
+    group = server.fake_domain.group(match.group('group'))
+    group.update(read_properties(body))
+    return property_entry(group)
+
+def delete_group(server, match, query, body):
+    group_id = match.group('group')
+    server.fake_domain.group(group_id)
+    for groups in (server.fake_domain.groups, server.fake_domain.members, server.fake_domain.owners):
+        del groups[group_id]
+
+def retrieve_groups(server, match, query, body):
+    fake_domain = server.fake_domain
+    group_ids = fake_domain.groups.keys()
+    if query.get('member'):
+        group_ids = [group_id for group_id in group_ids if query['member'] in fake_domain.members[group_id]]
+    (group_ids, next_id) = fake_domain.page(group_ids, query.get('start'))
+    next_url = next_id and server.url(match.group(0) + '?' + urllib.urlencode(dict(query, start=next_id)))
+    return feed(gdata.apps.PropertyFeed, [property_entry(fake_domain.groups[group_id]) for group_id in group_ids], next_url)
+
+def member_list(server, match):
+    fake_domain = server.fake_domain
+    fake_domain.group(match.group('group'))
+    if match.group('kind') == 'owner':
+        return fake_domain.owners[match.group('group')]
+    return fake_domain.members[match.group('group')]
+
+def member_properties(kind, member_id):
+    if kind == 'owner':
+        return {'email': member_id}
+    return {'memberId': member_id, 'memberType': 'User', 'directMember': 'true'}
+
+def add_member(server, match, query, body):
+    properties = read_properties(body)
+    member_id = properties.get('memberId') or properties.get('email')
+    member_list(server, match).add(member_id)
+    return property_entry(member_properties(match.group('kind'), member_id))
+
+def retrieve_member(server, match, query, body):
+    if match.group('member') not in member_list(server, match):
+        raise does_not_exist(match.group('member'))
+    return property_entry(member_properties(match.group('kind'), match.group('member')))
+
+def retrieve_members(server, match, query, body):
+    fake_domain = server.fake_domain
+    (member_ids, next_id) = fake_domain.page(member_list(server, match), query.get('start'))
+    next_url = next_id and server.url(match.group(0) + '?start=' + urllib.quote(next_id))
+    return feed(gdata.apps.PropertyFeed, [property_entry(member_properties(match.group('kind'), member_id))
+                                          for member_id in member_ids], next_url)
+
+def remove_member(server, match, query, body):
+    members = member_list(server, match)
+    if match.group('member') not in members:
+        raise does_not_exist(match.group('member'))
+    members.remove(match.group('member'))
+
+def retrieve_customer_id(server, match, query, body):
+    return property_entry({'customerId': CUSTOMER_ID, 'customerOrgUnitName': server.fake_domain.domain})
+
+def org_properties(fake_domain, path):
+    properties = dict(fake_domain.orgs[path])
+    properties['orgUnitPath'] = path.lstrip('/')
+    return properties
+
+def create_org(server, match, query, body):
+    properties = read_properties(body)
+    fake_domain = server.fake_domain
+    parent = fake_domain.org(properties.get('parentOrgUnitPath', '/'))
+    path = parent.rstrip('/') + '/' + properties['name']
+    if path in fake_domain.orgs:
+        raise already_exists(path)
+    fake_domain.orgs[path] = {'name': properties['name'], 'description': properties.get('description', ''),
+                              'parentOrgUnitPath': parent.lstrip('/'),
+                              'blockInheritance': properties.get('blockInheritance', 'false')}
+    return property_entry(org_properties(fake_domain, path))
+
+def retrieve_org(server, match, query, body):
+    fake_domain = server.fake_domain
+    return property_entry(org_properties(fake_domain, fake_domain.org(match.group('org'))))
+
+def update_org(server, match, query, body):
+    fake_domain = server.fake_domain
+    path = fake_domain.org(match.group('org'))
+    properties = read_properties(body)
+    for user_email in (properties.pop('usersToMove', '') or '').split(','):
+        user_email = user_email.strip()
+        if user_email:
+            if user_email not in fake_domain.org_users:
+                raise does_not_exist(user_email)
+            fake_domain.org_users[user_email] = path
+    org = fake_domain.orgs[path]
+    for name in ('description', 'blockInheritance'):
+        if properties.get(name) is not None:
+            org[name] = properties[name]
+    new_path = path
+    if properties.get('parentOrgUnitPath') is not None or properties.get('name'):
+        parent = fake_domain.org(properties.get('parentOrgUnitPath') or org['parentOrgUnitPath'])
+        org['name'] = properties.get('name') or org['name']
+        org['parentOrgUnitPath'] = parent.lstrip('/')
+        new_path = parent.rstrip('/') + '/' + org['name']
+    if new_path != path:
+        fake_domain.orgs[new_path] = fake_domain.orgs.pop(path)
+        for (user_email, user_path) in fake_domain.org_users.items():
+            if user_path == path:
+                fake_domain.org_users[user_email] = new_path
+    return property_entry(org_properties(fake_domain, new_path))
+
+def delete_org(server, match, query, body):
+    fake_domain = server.fake_domain
+    path = fake_domain.org(match.group('org'))
+    if path in fake_domain.org_users.values():
+        raise FakeError(1303, 'EntityNotValid', path)
+    del fake_domain.orgs[path]
+
+def retrieve_orgs(server, match, query, body):
+    fake_domain = server.fake_domain
+    return feed(gdata.apps.PropertyFeed, [property_entry(org_properties(fake_domain, path))
+                                          for path in sorted(fake_domain.orgs) if path != '/'])
+
+def org_user_properties(fake_domain, user_email):
+    return {'orgUserEmail': user_email, 'orgUnitPath': fake_domain.org_users[user_email].lstrip('/')}
+
+def retrieve_org_users(server, match, query, body):
+    fake_domain = server.fake_domain
+    user_emails = fake_domain.org_users.keys()
+    cache_key = 'org_users'
+    if query.get('get') == 'children':
+        path = fake_domain.org(query.get('orgUnitPath', '/'))
+        user_emails = [user_email for user_email in user_emails if fake_domain.org_users[user_email] == path]
+        cache_key = None
+    (user_emails, next_email) = fake_domain.page(user_emails, query.get('startKey'), cache_key)
+    next_url = next_email and server.url(match.group(0) + '?' + urllib.urlencode(dict(query, startKey=next_email)))
+    return feed(gdata.apps.PropertyFeed, [property_entry(org_user_properties(fake_domain, user_email))
+                                          for user_email in user_emails], next_url)
+
+def retrieve_org_user(server, match, query, body):
+    fake_domain = server.fake_domain
+    if match.group('user') not in fake_domain.org_users:
+        raise does_not_exist(match.group('user'))
+    return property_entry(org_user_properties(fake_domain, match.group('user')))
+
+def update_org_user(server, match, query, body):
+    fake_domain = server.fake_domain
+    if match.group('user') not in fake_domain.org_users:
+        raise does_not_exist(match.group('user'))
+    fake_domain.org_users[match.group('user')] = fake_domain.org(read_properties(body).get('orgUnitPath', '/'))
+    return property_entry(org_user_properties(fake_domain, match.group('user')))
+
+# (method, path pattern, handler), tried in order. Paths are matched before being unquoted.
+DOMAIN = r'/a/feeds/(?P<domain>[^/?]+)'
+GROUPS = r'/a/feeds/group/2\.0/(?P<domain>[^/?]+)'
+ORGUNITS = r'/a/feeds/orgunit/2\.0/(?P<customer>[^/?]+)'
+ORGUSERS = r'/a/feeds/orguser/2\.0/(?P<customer>[^/?]+)'
+routes = [
+    ('POST', r'/accounts/ClientLogin', client_login),
+    ('POST', r'/a/feeds/emailsettings/2\.0/(?P<domain>[^/]+)/(?P<user>[^/]+)/(?P<setting>\w+)', update_email_setting),
+    ('PUT', r'/a/feeds/emailsettings/2\.0/(?P<domain>[^/]+)/(?P<user>[^/]+)/(?P<setting>\w+)', update_email_setting),
+    ('GET', r'/a/feeds/emailsettings/2\.0/(?P<domain>[^/]+)/(?P<user>[^/]+)/(?P<setting>\w+)', retrieve_email_setting),
+    ('GET', r'/a/feeds/customer/2\.0/customerId', retrieve_customer_id),
+    ('POST', GROUPS, create_group),
+    ('GET', GROUPS, retrieve_groups),
+    ('POST', GROUPS + r'/(?P<group>[^/?]+)/(?P<kind>member|owner)', add_member),
+    ('GET', GROUPS + r'/(?P<group>[^/?]+)/(?P<kind>member|owner)', retrieve_members),
+    ('GET', GROUPS + r'/(?P<group>[^/?]+)/(?P<kind>member|owner)/(?P<member>[^/?]+)', retrieve_member),
+    ('DELETE', GROUPS + r'/(?P<group>[^/?]+)/(?P<kind>member|owner)/(?P<member>[^/?]+)', remove_member),
+    ('GET', GROUPS + r'/(?P<group>[^/?]+)', retrieve_group),
+    ('PUT', GROUPS + r'/(?P<group>[^/?]+)', update_group),
+    ('DELETE', GROUPS + r'/(?P<group>[^/?]+)', delete_group),
+    ('POST', ORGUNITS, create_org),
+    ('GET', ORGUNITS, retrieve_orgs),
+    ('GET', ORGUNITS + r'/(?P<org>[^?]+)', retrieve_org),
+    ('PUT', ORGUNITS + r'/(?P<org>[^?]+)', update_org),
+    ('DELETE', ORGUNITS + r'/(?P<org>[^?]+)', delete_org),
+    ('GET', ORGUSERS, retrieve_org_users),
+    ('GET', ORGUSERS + r'/(?P<user>[^/?]+)', retrieve_org_user),
+    ('PUT', ORGUSERS + r'/(?P<user>[^/?]+)', update_org_user),
+    ('POST', DOMAIN + r'/user/2\.0', create_user),
+    ('GET', DOMAIN + r'/user/2\.0', retrieve_users),
+    ('GET', DOMAIN + r'/user/2\.0/(?P<user>[^/?]+)', retrieve_user),
+    ('PUT', DOMAIN + r'/user/2\.0/(?P<user>[^/?]+)', update_user),
+    ('DELETE', DOMAIN + r'/user/2\.0/(?P<user>[^/?]+)', delete_user),
+    ('POST', DOMAIN + r'/nickname/2\.0', create_nickname),
+    ('GET', DOMAIN + r'/nickname/2\.0', retrieve_nicknames),
+    ('GET', DOMAIN + r'/nickname/2\.0/(?P<nickname>[^/?]+)', retrieve_nickname),
+    ('DELETE', DOMAIN + r'/nickname/2\.0/(?P<nickname>[^/?]+)', delete_nickname),
+    ]
+routes = [(method, re.compile(pattern + '$'), handler) for (method, pattern, handler) in routes]
+
+## SERVER ##
+
+class FakeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers one request to the fake APIs."""
+    protocol_version = 'HTTP/1.1' # keep connections open, like Google's servers do
+    wbufsize = -1 # send each response in one piece, rather than a write per header line
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send(self, status, body, content_type='application/atom+xml; charset=UTF-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        request_path = self.path
+        if request_path.startswith('http'):
+            request_path = '/' + request_path.split('/', 3)[-1] # gdata sends absolute URIs over plain HTTP
+        (path, query_string) = (request_path.split('?', 1) + [''])[:2]
+        query = dict((name, values[0]) for (name, values) in urlparse.parse_qs(query_string).items())
+        server = self.server
+        if path == '/fake/stats':
+            return self.send(200, json.dumps(server.stats_snapshot()), 'application/json')
+        for (route_method, pattern, handler) in routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send(404, 'No fake endpoint for %s %s\n' % (method, path), 'text/plain')
+        server.count(handler.__name__)
+        if server.latency:
+            time.sleep(server.latency)
+        if handler is not client_login and not server.allow_request(): # ClientLogin isn't part of the Apps quota
+            server.count('quota_error')
+            return self.send(503, 'Request rate higher than granted (quota exceeded).\n', 'text/plain')
+        if handler is not client_login and not server.is_authorized(self.headers.get('Authorization', '')):
+            return self.send(401, 'Token invalid\n', 'text/plain')
+        server.fake_domain.lock.acquire()
+        try:
+            if method != 'GET':
+                server.fake_domain.version += 1
+            try:
+                match = FakeMatch(match)
+                result = handler(server, match, query, body)
+            except FakeError, e:
+                server.count('error')
+                if e.status == 403:
+                    return self.send(403, 'Error=%s\n' % e.reason, 'text/plain')
+                return self.send(e.status, e.body(), 'application/xml; charset=UTF-8')
+        finally:
+            server.fake_domain.lock.release()
+        if result is None:
+            return self.send(200, '')
+        if isinstance(result, str):
+            return self.send(200, result, 'text/plain')
+        return self.send(200, str(result)) # gdata's entries and feeds write their own XML declaration
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+class FakeMatch:
+    """A path match whose groups are unquoted, as the clients quote member ids and org unit paths."""
+    def __init__(self, match):
+        self.match = match
+
+    def group(self, name=0):
+        if name == 0:
+            return self.match.group(0)
+        return urllib.unquote_plus(self.match.group(name))
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The fake API server: the domain, the simulated latency and quota, and the request counts."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256 # many clients connect at once during load tests
+
+    def __init__(self, port, fake_domain, latency=0, quota_rate=0, max_rate=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), FakeRequestHandler)
+        self.fake_domain = fake_domain
+        self.latency = latency
+        self.quota_rate = quota_rate
+        self.max_rate = max_rate
+        self.verbose = verbose
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.window_start = time.time() # requests are counted per second for max_rate
+        self.window_requests = 0
+
+    def url(self, path):
+        return 'http://localhost:%d%s' % (self.server_address[1], path)
+
+    def count(self, name):
+        self.stats_lock.acquire()
+        try:
+            self.stats[name] = self.stats.get(name, 0) + 1
+        finally:
+            self.stats_lock.release()
+
+    def stats_snapshot(self):
+        self.stats_lock.acquire()
+        try:
+            return dict(self.stats)
+        finally:
+            self.stats_lock.release()
+
+    def allow_request(self):
+        """Returns whether a request is within the quota."""
+        if self.quota_rate and random.random() < self.quota_rate:
+            return False
+        if not self.max_rate:
+            return True
+        self.stats_lock.acquire()
+        try:
+            now = time.time()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            return self.window_requests <= self.max_rate
+        finally:
+            self.stats_lock.release()
+
+    def is_authorized(self, authorization):
+        token = authorization.split('auth=', 1)[-1].strip()
+        return token in self.fake_domain.tokens
+
+def start_server(port=DEFAULT_PORT, domain='example.com', admin='admin', password='password', users=0, groups=0,
+                 latency=0, quota_rate=0, max_rate=0, page_size=DEFAULT_PAGE_SIZE, verbose=False):
+    """Starts a fake server in a background thread and returns it; server.shutdown() stops it."""
+    fake_domain = FakeDomain(domain, page_size)
+    fake_domain.add_user(admin, 'Fake', 'Admin', password, admin='true')
+    fake_domain.populate(users, groups)
+    server = FakeServer(port, fake_domain, latency, quota_rate, max_rate, verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def __main__():
+    (options, args) = getopt.getopt(sys.argv[1:], '', ['port=', 'domain=', 'users=', 'groups=', 'latency=',
+                                                        'quota-rate=', 'max-rate=', 'page-size=', 'verbose'])
+    options = dict(options)
+    server = start_server(port=int(options.get('--port', DEFAULT_PORT)), domain=options.get('--domain', 'example.com'),
+                          users=int(options.get('--users', 0)), groups=int(options.get('--groups', 0)),
+                          latency=float(options.get('--latency', 0)), quota_rate=float(options.get('--quota-rate', 0)),
+                          max_rate=float(options.get('--max-rate', 0)),
+                          page_size=int(options.get('--page-size', DEFAULT_PAGE_SIZE)), verbose='--verbose' in options)
+    print 'Fake Google Apps APIs for %s listening on %s' % (server.fake_domain.domain, server.url(''))
+    print 'Log in as admin@%s with password "password", after: export GAS_API_SERVER=%s' % (
+        server.fake_domain.domain, server.url(''))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    __main__()
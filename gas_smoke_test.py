@@ -0,0 +1,231 @@
+#!/usr/bin/python
+#
+# gas_smoke_test.py
+#
+# Smoke tests for GAS: runs gas.py the way an administrator would (batches on both engines,
+# --resume, repeated writes, sync and sync_group_members) against gas_fake_server.py, and
+# checks what it printed and which requests reached the fake server. Nothing is sent to Google.
+#
+# usage:
+#   python gas_smoke_test.py [--port 8089] [--timeout 120] [check ...]
+#     Runs the checks (by default all of them), each with a fresh fake server and in an empty
+#     directory, so the fake login never reaches the real credential store. Prints one line per
+#     check, and exits with status 1 if any of them failed.
+#
+
+__version__ = '1.1.7'
+
+import sys, os, re, time, json, getopt, subprocess, shutil, tempfile, urllib2
+
+from gas_benchmark import GAS_DIRECTORY, FAKE_SERVER_PORT, start_fake_server
+
+# Run in a fresh process for every gas command, like "python gas.py ...", but from the check's directory,
+# which is where gas keeps its credentials, journals and cache (it puts them next to sys.argv[0]).
+GAS_SCRIPT = 'import gas; gas.__main__()'
+
+# How long one gas command may take, in seconds (--timeout changes it). A command that takes longer has hung.
+COMMAND_TIMEOUT = 120
+
+class SmokeRun:
+    """A fresh fake server and an empty directory to run gas commands in, for one check."""
+    def __init__(self, port, users=0, groups=0, latency=0, timeout=COMMAND_TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self.directory = tempfile.mkdtemp(prefix='gas_smoke_')
+        self.server = start_fake_server(port, users, groups, latency)
+        self.environment = dict(os.environ, GAS_API_SERVER='http://localhost:%d' % port,
+                                PYTHONPATH=os.pathsep.join([GAS_DIRECTORY, os.environ.get('PYTHONPATH', '')]))
+        try:
+            self.gas('log_in', 'email=admin@example.com', 'password=password')
+        except:
+            self.close()
+            raise
+
+    def gas(self, *args, **kwargs):
+        """Runs a gas command line, and returns (stdout, stderr).
+
+        Fails if the exit status isn't status (0 by default; None accepts any), or the command hangs."""
+        status = kwargs.get('status', 0)
+        output = tempfile.TemporaryFile()
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen([sys.executable, '-c', GAS_SCRIPT] + list(args), cwd=self.directory,
+                                   env=self.environment, stdout=output, stderr=errors)
+        deadline = time.time() + self.timeout
+        while process.poll() is None:
+            if time.time() > deadline:
+                process.kill()
+                process.wait()
+                raise Exception('gas %s did not finish in %d seconds.' % (' '.join(args), self.timeout))
+            time.sleep(0.05)
+        output.seek(0)
+        errors.seek(0)
+        (output, errors) = (output.read(), errors.read())
+        if status is not None and process.returncode != status:
+            raise Exception('gas %s exited with status %d:\n%s' % (' '.join(args), process.returncode, errors.strip()))
+        return (output, errors)
+
+    def calls(self, endpoint):
+        """Returns how many requests the fake server's endpoint (a handler name, e.g. retrieve_user) got."""
+        stats = json.loads(urllib2.urlopen('http://localhost:%d/fake/stats' % self.port).read())
+        return stats.get(endpoint, 0)
+
+    def write(self, name, text):
+        """Writes a file for the commands to read into the check's directory, and returns its name."""
+        input_file = open(os.path.join(self.directory, name), 'w')
+        try:
+            input_file.write(text)
+        finally:
+            input_file.close()
+        return name
+
+    def journals(self):
+        return [name for name in os.listdir(self.directory) if name.startswith('gas_journal_')]
+
+    def close(self):
+        self.server.kill()
+        self.server.wait()
+        shutil.rmtree(self.directory, True)
+
+def expect(condition, message):
+    if not condition:
+        raise Exception(message)
+
+def user_names(count, prefix='user'):
+    return ['%s%05d' % (prefix, number+1) for number in range(count)]
+
+## CHECKS ##
+# Each check is called with a SmokeRun, and raises an exception saying what went wrong if something did.
+
+def check_engines(run):
+    """Runs the same batches on the threads and async engines: every command runs once, with one request each."""
+    users = user_names(60)
+    run.write('users.csv', '\n'.join(users) + '\n')
+    for (engine, workers) in (('threads', '8'), ('async', '30')):
+        before = run.calls('retrieve_user')
+        (output, errors) = run.gas('--engine', engine, '--workers', workers, '--input', 'users.csv', 'read_user user_name={1}')
+        printed = re.findall(r'^User: (\S+)', output, re.MULTILINE)
+        expect(sorted(printed) == users, '%s engine: read_user printed %d of the %d users.' % (engine, len(printed), len(users)))
+        requests = run.calls('retrieve_user') - before
+        expect(requests == len(users), '%s engine: %d read_user commands sent %d requests.' % (engine, len(users), requests))
+        expect(not run.journals(), '%s engine: the journal of a finished run was kept.' % engine)
+        # every user is a member of one group, and the first caller builds the index while the others wait for it
+        (output, errors) = run.gas('--engine', engine, '--workers', '6', '--input', 'users.csv', 'list_user_groups user_name={1}')
+        groups = re.findall(r'^group\d+@example\.com,member$', output, re.MULTILINE)
+        expect(len(groups) == len(users), '%s engine: list_user_groups found groups for %d of %d users.' % (engine, len(groups), len(users)))
+        expect(output.count('Indexing') == 1, '%s engine: the membership index was built %d times.' % (engine, output.count('Indexing')))
+
+def check_resume(run):
+    """Resumes a batch that stopped at a failed row: every row runs exactly once in all. Journals never hold passwords."""
+    rows = user_names(3) + ['smoke00001'] + user_names(9)[3:]
+    run.write('update.csv', '\n'.join(rows) + '\n')
+    run.gas('--workers', '4', '--input', 'update.csv', 'update_user user_name={1} last_name=Resumed', status=None)
+    journals = run.journals()
+    expect(len(journals) == 1, 'A batch with a failed row left %d journals.' % len(journals))
+    run.gas('create_user', 'user_name=smoke00001', 'first_name=Smoke', 'last_name=One', 'password=Smoke-secret1')
+    before = run.calls('update_user')
+    run.gas('--resume', journals[0], '--workers', '4')
+    resumed = run.calls('update_user') - before
+    expect(resumed >= 1 and run.calls('update_user') == len(rows),
+           'The run and its resume sent %d update_user requests for %d rows (%d on resuming).' % (
+           run.calls('update_user'), len(rows), resumed))
+    expect(not run.journals(), 'The journal of a resumed run that finished was kept.')
+    # user00001 exists, so its row fails and the journal is kept
+    run.write('passwords.csv', 'user00001,Smoke-secret2\nsmoke00002,Smoke-secret2\n')
+    run.gas('--input', 'passwords.csv', 'create_user user_name={1} first_name=Smoke last_name={1} password={2}', status=None)
+    journals = run.journals()
+    expect(len(journals) == 1, 'A batch with a failed row left %d journals.' % len(journals))
+    journal_file = open(os.path.join(run.directory, journals[0]))
+    try:
+        expect('Smoke-secret2' not in journal_file.read(), 'The journal holds a password.')
+    finally:
+        journal_file.close()
+
+def check_skips(run):
+    """Repeats writes that are already done: no write reaches the API unless --always-write is given."""
+    signature = 'signature=Gr\xc3\xbc\xc3\x9fe from Jos\xc3\xa9' # non-ASCII, as UTF-8 arguments
+    run.gas('update_signature', 'user_name=user00001', signature)
+    before = run.calls('update_email_setting')
+    (output, errors) = run.gas('update_signature', 'user_name=user00001', signature)
+    expect(run.calls('update_email_setting') == before, 'Setting the same signature again wrote it again.')
+    expect('Updating signature' not in output + errors, 'A skipped signature write was logged as a write.')
+    run.gas('update_imap', 'user_name=user00001', 'enable=true')
+    before = run.calls('update_email_setting')
+    run.gas('update_imap', 'user_name=user00001', 'enable=true')
+    expect(run.calls('update_email_setting') == before, 'Enabling IMAP again wrote the setting again.')
+    run.gas('update_user', 'user_name=user00001', 'ip_whitelisted=false', 'admin=false')
+    expect(run.calls('update_user') == 0, 'update_user wrote flags that were already unset.')
+    run.gas('--always-write', 'update_imap', 'user_name=user00001', 'enable=true')
+    expect(run.calls('update_email_setting') == before + 1, '--always-write did not write the setting.')
+
+def check_sync(run):
+    """Applies users and memberships files with sync: a second plan is empty, and plans never show passwords."""
+    run.write('users.csv', 'user_name,first_name,last_name,password,admin,ip_whitelisted\n'
+                           'user00001,User,Renamed,,false,false\n'
+                           'smoke00001,Smoke,One,Smoke-secret1,true,\n')
+    run.write('memberships.csv', 'group,member,role\n'
+                                 'group0001@example.com,user00002@example.com,member\n'
+                                 'group0001@example.com,user00003@example.com,owner\n')
+    for (name, planned) in (('users.csv', '1 to create, 1 to update'), ('memberships.csv', '2 to create, 0 to update')):
+        (output, errors) = run.gas('sync', name)
+        expect(planned in output, 'sync %s did not plan %s:\n%s' % (name, planned, output))
+        expect('Smoke-secret1' not in output, 'sync %s showed a password.' % name)
+        run.gas('sync', '--apply', '--workers', '4', name)
+        (output, errors) = run.gas('sync', name)
+        expect('0 to create, 0 to update, 0 to delete' in output, 'sync %s planned changes after --apply:\n%s' % (name, output))
+    run.write('bad_users.csv', 'user_name,admin\nuser00001,maybe\n')
+    (output, errors) = run.gas('sync', 'bad_users.csv', status=1)
+    expect('line 2' in errors, 'sync did not report the line of a bad value:\n%s' % errors)
+
+def check_sync_group_members(run):
+    """Syncs a group's members with a file twice: the second time nothing is sent, and bad lines are reported."""
+    run.write('members.csv', '\n'.join(['%s@example.com' % user for user in user_names(5)]) + '\nuser00006@example.com,owner\n')
+    run.gas('sync_group_members', 'id=group0001@example.com', 'members_file=members.csv', 'remove_extra=true')
+    (output, errors) = run.gas('list_group_members', 'id=group0001@example.com')
+    wanted = ['%s@example.com,member' % user for user in user_names(5)] + ['user00006@example.com,owner']
+    listed = sorted([line for line in output.splitlines() if line.endswith(',member') or line.endswith(',owner')])
+    expect(listed == sorted(wanted), 'The group has %s after the sync, not %s.' % (listed, sorted(wanted)))
+    before = run.calls('add_member') + run.calls('remove_member')
+    (output, errors) = run.gas('sync_group_members', 'id=group0001@example.com', 'members_file=members.csv', 'remove_extra=true')
+    expect(run.calls('add_member') + run.calls('remove_member') == before, 'Syncing the same members again sent changes.')
+    run.write('bad_members.csv', 'user00001@example.com\nuser00002@example.com,boss\n')
+    (output, errors) = run.gas('sync_group_members', 'id=group0001@example.com', 'members_file=bad_members.csv', status=1)
+    expect('line 2' in errors, 'sync_group_members did not report the line of a bad role:\n%s' % errors)
+
+# check name -> (the function running it, the options of its fake server), in the order they run
+checks = [
+    ('engines', check_engines, {'users': 60, 'groups': 6, 'latency': 0.005}),
+    ('resume', check_resume, {'users': 10}),
+    ('skips', check_skips, {'users': 3}),
+    ('sync', check_sync, {'users': 5, 'groups': 2}),
+    ('sync_group_members', check_sync_group_members, {'users': 10, 'groups': 2}),
+    ]
+
+def __main__():
+    (options, names) = getopt.gnu_getopt(sys.argv[1:], '', ['port=', 'timeout='])
+    options = dict(options)
+    port = int(options.get('--port', FAKE_SERVER_PORT))
+    timeout = int(options.get('--timeout', COMMAND_TIMEOUT))
+    check_names = [name for (name, check, server_options) in checks]
+    for name in names:
+        if name not in check_names:
+            raise Exception('Unknown check %s. Use some of: %s' % (name, ', '.join(check_names)))
+    failed = 0
+    for (name, check, server_options) in checks:
+        if names and name not in names:
+            continue
+        started = time.time()
+        run = SmokeRun(port, timeout=timeout, **server_options)
+        try:
+            check(run)
+            print '%-20s ok (%.1fs)' % (name, time.time()-started)
+        except Exception, e:
+            print '%-20s FAILED: %s' % (name, e)
+            failed += 1
+        finally:
+            run.close()
+    if failed:
+        print '%d of the checks failed.' % failed
+        sys.exit(1)
+
+if __name__ == '__main__':
+    __main__()
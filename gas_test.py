@@ -0,0 +1,409 @@
+#!/usr/bin/python
+#
+# gas_test.py
+#
+# Unit tests for the parts of GAS that work without Google or gas_fake_server.py (see
+# gas_smoke_test.py for the end to end checks).
+#
+# usage:
+#   python gas_test.py [-v] [TestCase[.test_name] ...]
+#
+
+__version__ = '1.1.7'
+
+import sys, os, time, json, shutil, tempfile, subprocess, unittest, StringIO
+
+import gas
+
+GAS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """A test case with an empty directory of its own, self.directory, removed afterwards."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gas_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+## CREDENTIAL STORE ##
+
+# Run in several processes at once: each stores count tokens under its own prefix.
+STORE_WRITER_SCRIPT = """
+import sys, time
+import gas
+(path, prefix, count) = (sys.argv[1], sys.argv[2], int(sys.argv[3]))
+store = gas.CredentialStore(path)
+for number in range(count):
+    store.put('%s%d@example.com' % (prefix, number), 'token', 0, logged_in=time.time())
+"""
+
+class CredentialStoreTest(TemporaryDirectoryTestCase):
+    def test_put_and_get(self):
+        store = gas.CredentialStore(self.path('gas_credentials.json'))
+        store.put('admin@example.com', 'token1', 123)
+        entry = store.get()
+        self.assertEqual((entry['email'], entry['token'], entry['validated_until'], entry['is_current']),
+                         ('admin@example.com', 'token1', 123, True))
+        store.put('other@example.com', 'token2', 456)
+        self.assertEqual(store.get('admin@example.com')['is_current'], False)
+        store.remove('other@example.com')
+        self.assertEqual(store.get(), None)
+        self.assertEqual(store.get('admin@example.com')['token'], 'token1')
+
+    def test_remove_only_the_rejected_token(self):
+        store = gas.CredentialStore(self.path('gas_credentials.json'))
+        store.put('admin@example.com', 'token2', 123)
+        store.remove('admin@example.com', 'token1') # rejected, but another run has logged in again since
+        self.assertEqual(store.get()['token'], 'token2')
+        store.remove('admin@example.com', 'token2')
+        self.assertEqual(store.get('admin@example.com'), None)
+
+    def test_expired_tokens_are_dropped(self):
+        store = gas.CredentialStore(self.path('gas_credentials.json'))
+        store.put('old@example.com', 'token1', 0, logged_in=time.time() - gas.TOKEN_MAX_AGE - 1)
+        store.put('new@example.com', 'token2', 0)
+        self.assertEqual(store.get('old@example.com'), None)
+        self.assertEqual(store.get('new@example.com')['token'], 'token2')
+
+    def test_store_is_private(self):
+        if os.name != 'posix':
+            return
+        store = gas.CredentialStore(self.path('gas_credentials.json'))
+        store.put('admin@example.com', 'token', 0)
+        self.assertEqual(os.stat(self.path('gas_credentials.json')).st_mode & 0777, 0600)
+
+    def test_reading_creates_no_files(self):
+        store = gas.CredentialStore(self.path('gas_credentials.json'))
+        self.assertEqual(store.get(), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_processes_writing_at_once_keep_every_token(self):
+        path = self.path('gas_credentials.json')
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join([GAS_DIRECTORY, os.environ.get('PYTHONPATH', '')]))
+        writers = [subprocess.Popen([sys.executable, '-c', STORE_WRITER_SCRIPT, path, prefix, '50'], env=environment)
+                   for prefix in ('a', 'b', 'c')]
+        for writer in writers:
+            self.assertEqual(writer.wait(), 0)
+        store_file = open(path)
+        try:
+            self.assertEqual(len(json.load(store_file)['tokens']), 150)
+        finally:
+            store_file.close()
+
+## RATE LIMITING ##
+
+class FakeClock:
+    """Stands in for the time module in gas, so waits take no real time and can be checked.
+    
+    The tests use rates that are powers of two, so the waits add up exactly."""
+    def __init__(self):
+        self.now = 1024.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+class FakeResponse:
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        gas.time = self.clock
+        self.limits = dict(gas.API_RATE_LIMITS)
+        self.limiters = dict(gas.rate_limiters)
+
+    def tearDown(self):
+        gas.time = time
+        gas.API_RATE_LIMITS.update(self.limits)
+        gas.rate_limiters.clear()
+        gas.rate_limiters.update(self.limiters)
+
+    def test_burst_then_steady_rate(self):
+        limiter = gas.RateLimiter(8)
+        for i in range(8):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, 0)
+        for i in range(16):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, 2.0)
+
+    def test_backoff_halves_the_rate_down_to_the_minimum(self):
+        limiter = gas.RateLimiter(8, min_rate=1)
+        for rate in (4, 2, 1, 1):
+            limiter.backoff()
+            self.assertEqual(limiter.rate, rate)
+        self.assertEqual(limiter.tokens, 0)
+        limiter.acquire() # the emptied bucket makes the next request wait
+        self.assertEqual(self.clock.slept, 1.0)
+
+    def test_increase_grows_back_to_the_maximum(self):
+        limiter = gas.RateLimiter(4)
+        limiter.backoff()
+        limiter.increase()
+        self.assertAlmostEqual(limiter.rate, 2.5)
+        for i in range(20):
+            limiter.increase()
+        self.assertEqual(limiter.rate, 4)
+
+    def test_rates_below_one_still_send(self):
+        limiter = gas.RateLimiter(2, min_rate=0.25)
+        for i in range(3):
+            limiter.backoff()
+        self.assertEqual(limiter.rate, 0.25)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(self.clock.slept, 8.0)
+
+    def test_set_max_rate_changes_the_limiters_in_use(self):
+        limiter = gas.get_rate_limiter('groups')
+        gas.set_max_rate(500)
+        self.assertEqual((limiter.rate, limiter.max_rate, gas.API_RATE_LIMITS['provisioning']), (500, 500, 500))
+        self.assertTrue(gas.get_rate_limiter('groups') is limiter)
+
+    def test_quota_responses(self):
+        self.assertTrue(gas.is_quota_response(FakeResponse(503)))
+        self.assertTrue(gas.is_quota_response(FakeResponse(403, '<error>Quota exceeded</error>')))
+        self.assertTrue(gas.is_quota_response(FakeResponse(429, 'rateLimitExceeded')))
+        self.assertFalse(gas.is_quota_response(FakeResponse(403, 'Not authorized')))
+        self.assertFalse(gas.is_quota_response(FakeResponse(500)))
+
+## PREFETCHING ##
+
+class Listing:
+    """A listing for PagePrefetcher: pages of name and a page number, each taking delay seconds to fetch."""
+    def __init__(self, name, count, delay=0, error=None):
+        (self.name, self.count, self.delay, self.error) = (name, count, delay, error)
+        self.fetched = 0
+
+    def __call__(self):
+        for number in range(self.count):
+            time.sleep(self.delay)
+            self.fetched += 1
+            yield (self.name, number)
+        if self.error:
+            raise self.error
+
+class PagePrefetcherTest(unittest.TestCase):
+    def test_pages_come_in_listing_order(self):
+        # the later listings are faster, so they finish fetching first
+        listings = [Listing(name, 3, delay) for (name, delay) in (('a', 0.03), ('b', 0.02), ('c', 0.01), ('d', 0))]
+        pages = list(gas.PagePrefetcher(listings, workers=4))
+        self.assertEqual(pages, [(name, number) for name in 'abcd' for number in range(3)])
+
+    def test_slow_reader_gets_every_page(self):
+        listings = [Listing(name, 5) for name in 'abc']
+        pages = []
+        for page in gas.PagePrefetcher(listings, depth=1, workers=2):
+            time.sleep(0.01)
+            pages.append(page)
+        self.assertEqual(pages, [(name, number) for name in 'abc' for number in range(5)])
+
+    def test_fetching_stays_ahead_by_a_bounded_amount(self):
+        listings = [Listing(number, 10) for number in range(10)]
+        pages = iter(gas.PagePrefetcher(listings, depth=2, workers=1))
+        pages.next()
+        time.sleep(0.3)
+        # the page in use, depth pages queued, and one waiting for room; the one worker is still on the first listing
+        self.assertTrue(listings[0].fetched <= 4)
+        self.assertEqual([listing for listing in listings if listing.fetched], listings[:1])
+        pages.close()
+
+    def test_error_is_raised_in_order(self):
+        listings = [Listing('a', 2, 0.02), Listing('b', 1, error=Exception('b failed')), Listing('c', 1)]
+        pages = []
+        try:
+            for page in gas.PagePrefetcher(listings, workers=3):
+                pages.append(page)
+        except Exception, e:
+            self.assertEqual(str(e), 'b failed')
+        else:
+            self.fail('The error of listing b was not raised.')
+        self.assertEqual(pages, [('a', 0), ('a', 1), ('b', 0)])
+
+## RUN JOURNAL ##
+
+class RunJournalTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.journal_path = self.path('gas_journal_20111024093000.jsonl')
+        self.header = {'templates': ['create_user user_name={1} password={2}', 'update_user user_name={1} password=secret'],
+                       'entries': [['alice', 'alice-secret'], ['bob', 'bob-secret']]}
+
+    def reopen(self, journal):
+        journal.close()
+        return gas.RunJournal(self.journal_path)
+
+    def test_header_is_loaded_without_passwords(self):
+        journal = gas.RunJournal(self.journal_path, self.header)
+        journal.record(0, 0, 'create_user user_name=alice password=alice-secret', 'ok')
+        journal = self.reopen(journal)
+        self.assertEqual(journal.header['templates'],
+                         ['create_user user_name={1} password={2}', "update_user 'user_name={1}' 'password=%s'" % gas.REDACTED])
+        self.assertEqual(journal.entries(), [['alice', gas.REDACTED], ['bob', gas.REDACTED]])
+        self.assertTrue(isinstance(journal.header['templates'][0], str))
+        journal.close()
+        journal_file = open(self.journal_path)
+        try:
+            text = journal_file.read()
+        finally:
+            journal_file.close()
+        self.assertTrue('secret' not in text.replace('<redacted>', ''))
+
+    def test_journal_is_private(self):
+        if os.name != 'posix':
+            return
+        journal = gas.RunJournal(self.journal_path, self.header)
+        self.assertEqual(os.stat(self.journal_path).st_mode & 0777, 0600)
+        journal.close()
+
+    def test_resume_skips_what_succeeded(self):
+        journal = gas.RunJournal(self.journal_path, {'templates': ['read_user {1}'], 'entries': [['alice'], ['bob']]})
+        journal.record(0, 0, 'read_user alice', 'ok')
+        journal.record(1, 0, 'read_user bob', 'ok')
+        journal.record(1, 0, 'read_user bob', 'failed', Exception('EntityDoesNotExist'))
+        journal = self.reopen(journal)
+        self.assertTrue(journal.is_row_done(0, ['read_user alice']))
+        self.assertFalse(journal.is_row_done(1, ['read_user bob']))
+        # a different command in the same place, e.g. after the template changed, is not skipped
+        self.assertFalse(journal.is_done(0, 0, 'read_user carol'))
+        journal.close()
+
+    def test_passwords_compare_redacted(self):
+        journal = gas.RunJournal(self.journal_path, self.header)
+        journal.record(0, 0, 'create_user user_name=alice password=alice-secret', 'ok')
+        journal = self.reopen(journal)
+        self.assertTrue(journal.is_done(0, 0, 'create_user user_name=alice password=alice-secret'))
+        journal.close()
+
+    def test_cut_short_last_line_is_ignored(self):
+        journal = gas.RunJournal(self.journal_path, {'templates': ['read_user {1}'], 'entries': [['alice'], ['bob']]})
+        journal.record(0, 0, 'read_user alice', 'ok')
+        journal.close()
+        journal_file = open(self.journal_path, 'a')
+        journal_file.write('{"type": "command", "row": 1, "comm')
+        journal_file.close()
+        journal = gas.RunJournal(self.journal_path)
+        self.assertTrue(journal.is_done(0, 0, 'read_user alice'))
+        self.assertFalse(journal.is_done(1, 0, 'read_user bob'))
+        journal.close()
+
+    def test_journal_is_deleted_only_when_nothing_is_left_to_resume(self):
+        journal = gas.RunJournal(self.journal_path, self.header)
+        journal.close() # e.g. the login failed, so no command ran
+        self.assertFalse(os.path.exists(self.journal_path))
+        journal = gas.RunJournal(self.journal_path, self.header)
+        journal.record(0, 0, 'create_user user_name=alice password=alice-secret', 'failed', Exception('failed'))
+        journal = self.reopen(journal)
+        journal.close() # a resumed run that stopped early keeps its journal
+        self.assertTrue(os.path.exists(self.journal_path))
+        journal = gas.RunJournal(self.journal_path)
+        journal.close(True)
+        self.assertFalse(os.path.exists(self.journal_path))
+
+## DESIRED STATE SYNC ##
+
+class FakeCredential:
+    """Stands in for Credentials where only the logged in domain and address are needed."""
+    def get_domain(self):
+        return 'example.com'
+
+    def get_email(self):
+        return 'admin@example.com'
+
+def user(user_name, first_name, last_name, **flags):
+    """Returns a users snapshot entry, as the directory cache keeps it."""
+    entry = {'user_name': user_name, 'first_name': first_name, 'last_name': last_name,
+             'admin': None, 'suspended': None, 'ip_whitelisted': None, 'change_password': None}
+    entry.update(flags)
+    return entry
+
+class SyncPlanTest(TemporaryDirectoryTestCase):
+    def plan(self, kind, rows, snapshot, delete=False):
+        return gas.sync_planners[kind](FakeCredential(), rows, snapshot, delete)
+
+    def test_users(self):
+        snapshot = {'users': {'alice@example.com': user('alice', 'Alice', 'Smith'),
+                              'bob@example.com': user('bob', 'Bob', 'Jones', admin=True),
+                              'carol@example.com': user('carol', 'Carol', 'White'),
+                              'admin@example.com': user('admin', 'Admin', 'Admin', admin=True)}}
+        rows = [{'user_name': 'Alice', 'first_name': 'Alice', 'last_name': 'Brown', 'suspended': 'false'},
+                {'user_name': 'bob', 'first_name': 'Bob', 'admin': 'true'},
+                {'user_name': 'dave', 'first_name': 'Dave', 'last_name': 'Black', 'password': 'dave-secret', 'admin': 'true'},
+                {'user_name': 'erin', 'first_name': 'Erin'}]
+        plan = self.plan('users', rows, snapshot, delete=True)
+        self.assertEqual(plan.rows, [
+            [['update_user', 'user_name=Alice', 'last_name=Brown']], # suspended is unset, which is false
+            [['create_user', 'user_name=dave', 'first_name=Dave', 'last_name=Black', 'password=dave-secret'],
+             ['update_user', 'user_name=dave', 'admin=true']],
+            [['delete_user', 'user_name=carol@example.com']]]) # but never the logged in admin
+        self.assertEqual(plan.counts, {'create': 1, 'update': 1, 'delete': 1, 'unchanged': 1})
+        self.assertEqual(plan.warnings, ['erin does not exist, and cannot be created without last_name, password.'])
+
+    def test_memberships(self):
+        snapshot = {'members': {'staff@example.com': {'members': [{'memberId': 'alice@example.com'},
+                                                                  {'memberId': 'bob@example.com'}]}},
+                    'owners': {'staff@example.com': {'owners': [{'email': 'Carol@example.com'}]}}}
+        rows = [{'group': 'staff', 'member': 'alice'},
+                {'group': 'staff', 'member': 'dave', 'role': 'member'},
+                {'group': 'staff', 'member': 'carol', 'role': 'owner'},
+                {'group': 'staff', 'member': 'erin', 'role': 'manager'},
+                {'group': 'missing', 'member': 'alice'}]
+        plan = self.plan('memberships', rows, snapshot, delete=True)
+        self.assertEqual(plan.rows, [
+            [['add_member_to_group', 'user=dave@example.com', 'id=staff@example.com']],
+            [['remove_member_from_group', 'user=bob@example.com', 'id=staff@example.com']]])
+        self.assertEqual(plan.counts, {'create': 1, 'update': 0, 'delete': 1, 'unchanged': 2})
+        self.assertEqual(plan.warnings, ['Unknown role manager for erin in staff; use member or owner.',
+                                         'Group missing@example.com does not exist.'])
+
+    def test_nicknames_are_not_moved(self):
+        snapshot = {'nicknames': {'al@example.com': {'user_name': 'alice'}, 'bobby@example.com': {'user_name': 'bob'},
+                                  'ally@example.com': {'user_name': 'alice'}}}
+        rows = [{'nickname': 'al', 'user_name': 'alice'}, {'nickname': 'bobby', 'user_name': 'alice'},
+                {'nickname': 'lissy', 'user_name': 'alice'}]
+        plan = self.plan('nicknames', rows, snapshot, delete=True)
+        self.assertEqual(plan.rows, [[['create_nickname', 'nickname=lissy', 'user_name=alice']],
+                                     [['delete_nickname', 'nickname=ally']]])
+        self.assertEqual(plan.warnings, ['Nickname bobby belongs to bob, not alice. '
+                                         'Delete it with delete_nickname before syncing to move it.'])
+
+    def test_problems_are_reported_by_line(self):
+        path = self.path('users.csv')
+        desired_file = open(path, 'w')
+        desired_file.write('user_name,first_name,admin\nalice,Alice,true\n\n,Bob,false\ncarol,Carol,maybe\n')
+        desired_file.close()
+        try:
+            gas.read_desired_state(path)
+        except Exception, e:
+            self.assertEqual(str(e).split('\n')[1:], ['  line 4: user_name is missing',
+                                                      '  line 5: admin must be true or false, not maybe'])
+        else:
+            self.fail('The problems of %s were not reported.' % path)
+
+    def test_kind_is_found_from_the_header(self):
+        path = self.path('memberships.csv')
+        desired_file = open(path, 'w')
+        desired_file.write('Group, Member ,role\nstaff,alice,owner\n')
+        desired_file.close()
+        self.assertEqual(gas.read_desired_state(path), ('memberships', [{'group': 'staff', 'member': 'alice', 'role': 'owner'}]))
+
+    def test_written_plan_has_no_passwords(self):
+        plan = gas.SyncPlan('users')
+        plan.add('create', ['create_user', 'user_name=dave', 'first_name=Dave', 'last_name=Black', 'password=dave-secret'])
+        output = StringIO.StringIO()
+        plan.write(output)
+        self.assertTrue('dave-secret' not in output.getvalue())
+        self.assertEqual(plan.entries(), [['create_user user_name=dave first_name=Dave last_name=Black password=dave-secret', '']])
+
+if __name__ == '__main__':
+    unittest.main()
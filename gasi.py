@@ -27,6 +27,9 @@ from Tkinter import * # TODO(pickhardt) refactor this to simply "import Tkinter"
 import gas
 import gas_commands
 
+import csv
+import glob
+import itertools
 import shlex
 import time
 import tkFont
@@ -304,6 +307,9 @@ Examples:
     self.right_container.pack(side=LEFT)
     
     ## Master template container ##
+    self.input_path = '' # the loaded input file, of which input_text only shows a preview
+    self.input_preview = ''
+
     label = Label(self.left_container, text='Master Template: (optional)')
     label.pack()
     
@@ -414,58 +420,107 @@ Examples:
     self.execute_button.pack(side=RIGHT)
     self.execute_button.bind("<Button-1>", self.RunExecute)
     self.execute_button.bind("<Return>", self.RunExecute)
+    
+    self.resume_button = Button(parent_frame, text="Resume")
+    self.resume_button.pack(side=RIGHT)
+    self.resume_button.bind("<Button-1>", self.RunResume)
+    self.resume_button.bind("<Return>", self.RunResume)
+    
+    self.profile_value = IntVar()
+    self.profile_checkbox = Checkbutton(parent_frame, text="Profile", variable=self.profile_value)
+    self.profile_checkbox.pack(side=RIGHT)
+    
+    self.workers_field = Entry(parent_frame, width=3, justify=CENTER)
+    self.workers_field.insert(0, '1')
+    self.workers_field.pack(side=RIGHT)
+    Label(parent_frame, text='Workers:').pack(side=RIGHT)
   
   def RunExecute(self, event):
     """Executes the command."""
-    master_template_lines = self.input_text.get(1.0,END)
-    master_template_lines = master_template_lines.split("\n")
-    master_template = []
-    for line in master_template_lines:
-      if line:
-        # only take the lines that contain text
-        master_template.append(str(line))
+    master_template_text = self.input_text.get(1.0,END)
     raw_command = self.command_field.get()
     commands = raw_command.split(';')
-    self.RunCommands(commands, master_template)
+    if self.input_path and master_template_text.strip()==self.input_preview.strip():
+      # Only a preview of the loaded file is shown; stream every line from the file itself.
+      header = {'templates': commands, 'input': self.input_path}
+      entries = gas.read_template_entries(self.input_path)
+    else:
+      master_template_lines = master_template_text.split("\n")
+      master_template = []
+      for line in master_template_lines:
+        if line:
+          # only take the lines that contain text
+          master_template.append(str(line))
+      if not master_template:
+        # without a template, the command runs once, and there is nothing to resume
+        self.RunCommands(commands)
+        return
+      entries = list(csv.reader(master_template))
+      header = {'templates': commands, 'entries': entries}
+    # Record every finished command, so that the Resume button can pick up an interrupted run.
+    journal = gas.RunJournal(gas.new_journal_path('gasi'), header)
+    sys.stderr.write('[gasi] Recording this run in '+journal.path)
+    self.RunCommands(commands, entries, journal)
   
-  def RunCommands(self, commands, master_template=[]):
-    """Executes the command in the command field, or the commands using the master template."""
-    if not master_template:
-      master_template = ['']
-    for template in master_template:
-      mapping = template.split(',')
-      for temp_command in commands:
-        command = temp_command.strip()
-        if not command:
-          continue
-        for index in range(len(mapping)):
-          command = command.replace('{%d}' % (index+1), mapping[index].strip()) # Replace {i} with the value from the template.
-        # Command now contains the right variables.
-        # Execute it.
-        command_list = [entry for entry in shlex.split(command)]
-        sys.stderr.write('[gasi] Executing: '+command)
-        self.last_error = '';
-        engine = command_list[0].lower() # the only engine currently supported is 'gas'
-        if engine=='gas':
-          gas.execute(command_list[1:])
-        else:
-          # They probably forgot the 'gas' in the syntax.
-          # We will execute the command as if 'gas' were there.
-          # However, this is open to change in the future,
-          # to allow for the possibility of integrating GASI with
-          # other libraries.
-          gas.execute(command_list)
-        sys.stderr.write('[gasi] Finished executing: '+command)
+  def RunResume(self, event):
+    """Resumes the most recent run that did not finish, skipping the commands that already succeeded."""
+    journal = None
+    paths = glob.glob(gas.path_for_gas_file('gas*_journal_*.jsonl'))
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths:
+      journal = gas.RunJournal(path)
+      if journal.header:
+        break # a journal is deleted once its run succeeds, so any left did not finish
+      journal.close()
+      journal = None
+    if not journal:
+      self.WriteError('There is no unfinished run to resume.')
+      return
+    sys.stderr.write('[gasi] Resuming the run in '+journal.path)
+    self.RunCommands(journal.header['templates'], journal.entries(), journal)
   
-  def LoadInput(self, event):
-    """Loads an input to the input text from a file."""
+  def RunCommands(self, commands, entries=None, journal=None):
+    """Executes the command in the command field, or the commands using the master template entries (lists of columns)."""
+    # Replace {i} with the value from the template. Each template line becomes one row of commands.
+    # Rows are expanded one at a time, as the executor is ready for them.
+    rows = gas.iter_cmd_template_rows(commands, entries)
+    # The commands of a row run in order, but several rows may run at once.
+    # Every command shares gas.session, so the batch only logs in once.
+    try:
+      workers = int(self.workers_field.get())
+    except ValueError:
+      workers = 1
+    if not self.profile_value.get():
+      GasiExecutor(self, workers, journal).run(rows)
+      return
+    # Profile the run, writing gasi_profile_<time>.pstats and a report split by phase, gasi_profile_<time>.txt
+    profile_path = gas.path_for_gas_file('gasi_profile_%s' % time.strftime('%Y%m%d%H%M%S'))
+    gas.start_profile()
+    try:
+      GasiExecutor(self, workers, journal).run(rows)
+    finally:
+      gas.stop_profile(profile_path)
+    self.WriteError('Profile written to %s.pstats, report in %s.txt' % (profile_path, profile_path))
+  
+  def LoadInput(self, event, preview_lines=20):
+    """Shows the first lines of an input file in the input text. Executing then reads the whole file, a line at a time."""
     self.input_text.delete('1.0', END)
+    self.input_path = ''
+    self.input_preview = ''
     try:
-      input_file = open(PathForHomeGASI(self.input_from.get()))
-      self.input_text.insert('1.0', input_file.read())
+      path = PathForHomeGASI(self.input_from.get())
+      input_file = open(path)
+      preview = ''.join(itertools.islice(input_file, preview_lines))
+      has_more_lines = bool(input_file.readline())
       input_file.close()
     except:
       self.input_text.insert('1.0', 'Error reading file.')
+      return
+    self.input_text.insert('1.0', preview)
+    self.input_path = path
+    self.input_preview = preview
+    if has_more_lines:
+      self.WriteError('Showing the first %d lines of %s. Execute runs every line of the file.' % (preview_lines, self.input_from.get()))
   
   def ClearOutput(self, event):
     """Clears the output text."""
@@ -530,6 +585,23 @@ Examples:
     self.standard_error_label.configure(text=text)
 
   
+class GasiExecutor(gas.BatchExecutor):
+  """Runs rows of GASI commands, reporting each command in the error frame."""
+  def __init__(self, app, workers=1, journal=None):
+    gas.BatchExecutor.__init__(self, workers, journal=journal)
+    self.app = app
+  
+  def run_command(self, command):
+    """Runs one command, given as a command line."""
+    sys.stderr.write('[gasi] Executing: '+command)
+    self.app.last_error = ''
+    # The only engine currently supported is 'gas'. If they forgot the 'gas'
+    # in the syntax, we execute the command as if 'gas' were there.
+    # However, this is open to change in the future, to allow for the
+    # possibility of integrating GASI with other libraries.
+    gas.BatchExecutor.run_command(self, gas.split_command(command))
+    sys.stderr.write('[gasi] Finished executing: '+command)
+
 root = Tk()
 my_app = MyApp(root)
 